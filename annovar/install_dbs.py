@@ -1,10 +1,33 @@
 '''
 Methods for installing ANNOVAR databases.
+
+Databases are installed concurrently. Each database is downloaded into its own staging directory and its files
+are moved into the destination directory only when the download succeeds; a manifest in the destination directory
+records the size and MD5 checksum of each installed file so that installed databases are skipped on later runs.
+Failed downloads are retried and databases left partially downloaded by an earlier run are started again.
+
+Downloads are done by annotate_variation.pl, so a retried download starts again from the first byte rather than
+resuming a partial file. The installer can be run offline by pointing --annovar_dir to a directory with a stand-in
+annotate_variation.pl that writes files to the directory given as its last argument.
 '''
 
+import argparse
+import hashlib
+import json
 import os
+import shutil
 import subprocess
-import argparse
+import threading
+import time
+
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+MANIFEST_NAME = 'install_manifest.json'
+STAGING_DIR_NAME = '.staging'
+
+# Result of installing a database: status is 'installed', 'skipped' or 'failed'.
+InstallResult = namedtuple('InstallResult', 'database status attempts files seconds error')
 
 # ANNOVAR databases to install.
 ANNOVAR_DATABASES = [
@@ -56,36 +79,156 @@ ANNOVAR_DATABASES = [
     { 'name': 'ljb26_pp2hdiv', 'host': 'annovar' }
 ]
 
-def install_annovar_dbs(annovar_dir='.', build='hg19', dest_dir='humandb'):
+def get_database_entries(databases=None):
     '''
-    Installs all ANNOVAR databases.
+    Returns (name, host) for each database in ANNOVAR_DATABASES or in a list of database names.
     '''
-
+    entries = []
     for entry in ANNOVAR_DATABASES:
         if isinstance( entry, dict ):
-            database = entry['name']
-            host = entry['host']
+            entries.append( (entry['name'], entry['host']) )
         else:
-            database = entry
-            host = 'ucsc'
+            entries.append( (entry, 'ucsc') )
+    if databases:
+        hosts = dict(entries)
+        entries = [ (database, hosts.get(database, 'annovar')) for database in databases ]
+    return entries
 
-        install_annovar_db(database=database, annovar_dir=annovar_dir, build=build, host=host, dest_dir=dest_dir)
+def get_md5(path, block_size=1 << 20):
+    '''
+    Returns MD5 checksum of a file.
+    '''
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), ''):
+            md5.update(block)
+    return md5.hexdigest()
 
-def install_annovar_db(database, annovar_dir='.', build='hg19', host='annovar', dest_dir='humandb'):
+class Manifest(object):
     '''
-    Install an ANNOVAR database.
+    Record of installed databases and the size and checksum of their files, stored as JSON in the destination
+    directory.
     '''
-    annovar = os.path.join(annovar_dir, 'annotate_variation.pl')
-    subprocess.call('%s -build %s -downdb %s -webfrom %s %s' % (annovar, build, database, host, dest_dir), shell=True)
+    def __init__(self, dest_dir):
+        self.dest_dir = dest_dir
+        self.path = os.path.join(dest_dir, MANIFEST_NAME)
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.entries = json.load(f)
+
+    def is_installed(self, database, build, verify=False):
+        '''
+        Returns True if database is recorded and all of its files are present with the recorded size (and
+        checksum, if verify is set).
+        '''
+        entry = self.entries.get('%s_%s' % (build, database))
+        if not entry or not entry['files']:
+            return False
+        for name, info in entry['files'].items():
+            path = os.path.join(self.dest_dir, name)
+            if not os.path.exists(path) or os.path.getsize(path) != info['size']:
+                return False
+            if verify and get_md5(path) != info['md5']:
+                return False
+        return True
+
+    def add(self, database, build, host, files):
+        '''
+        Records an installed database and saves the manifest.
+        '''
+        with self.lock:
+            self.entries['%s_%s' % (build, database)] = { 'database': database, 'build': build, 'host': host,
+                                                          'installed': time.strftime('%Y-%m-%d %H:%M:%S'),
+                                                          'files': files }
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(self.entries, f, indent=2, sort_keys=True)
+            os.rename(self.path + '.tmp', self.path)
+
+def install_annovar_dbs(annovar_dir='.', build='hg19', dest_dir='humandb', databases=None, jobs=4, retries=2,
+                        mirror=None, force=False, verify=False):
+    '''
+    Installs ANNOVAR databases, by default all in ANNOVAR_DATABASES, using jobs concurrent downloads. Returns a
+    list of InstallResult, one for each database.
+    '''
+    if not os.path.exists(dest_dir):
+        os.makedirs(dest_dir)
+    manifest = Manifest(dest_dir)
+
+    def install(entry):
+        database, host = entry
+        return install_annovar_db(database=database, annovar_dir=annovar_dir, build=build, host=mirror or host,
+                                  dest_dir=dest_dir, manifest=manifest, retries=retries, force=force, verify=verify)
+
+    entries = get_database_entries(databases)
+    pool = ThreadPool( max(1, min(jobs, len(entries))) )
+    try:
+        return pool.map(install, entries, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def install_annovar_db(database, annovar_dir='.', build='hg19', host='annovar', dest_dir='humandb', manifest=None,
+                       retries=2, force=False, verify=False):
+    '''
+    Install an ANNOVAR database unless it is already installed. The download is attempted up to retries + 1
+    times. Returns an InstallResult.
+    '''
+    start = time.time()
+    manifest = manifest or Manifest(dest_dir)
+    if not force and manifest.is_installed(database, build, verify):
+        return InstallResult(database, 'skipped', 0, [], 0.0, None)
 
+    annovar = os.path.join(annovar_dir, 'annotate_variation.pl')
+    staging_dir = os.path.join(dest_dir, STAGING_DIR_NAME, '%s_%s' % (build, database))
+    error = None
+    for attempt in range(1, retries + 2):
+        # Start from an empty staging directory so that partial files from failed attempts or runs are not used.
+        if os.path.exists(staging_dir):
+            shutil.rmtree(staging_dir)
+        os.makedirs(staging_dir)
+
+        log_path = os.path.join(dest_dir, STAGING_DIR_NAME, '%s_%s.log' % (build, database))
+        with open(log_path, 'w') as log:
+            returncode = subprocess.call([annovar, '-build', build, '-downdb', database, '-webfrom', host,
+                                          staging_dir], stdout=log, stderr=subprocess.STDOUT)
+        files = sorted(os.listdir(staging_dir))
+        if returncode == 0 and files:
+            break
+        error = 'annotate_variation.pl exited with %i%s; see %s' % \
+                ( returncode, '' if files else ' and downloaded no files', log_path )
+    else:
+        shutil.rmtree(staging_dir)
+        return InstallResult(database, 'failed', attempt, [], time.time() - start, error)
+
+    # Move files into place and record them.
+    installed = {}
+    for name in files:
+        path = os.path.join(dest_dir, name)
+        os.rename(os.path.join(staging_dir, name), path)
+        installed[name] = { 'size': os.path.getsize(path), 'md5': get_md5(path) }
+    shutil.rmtree(staging_dir)
+    os.remove(log_path)
+    manifest.add(database, build, host, installed)
+    return InstallResult(database, 'installed', attempt, files, time.time() - start, None)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Install ANNOVAR databases.')
-    parser.add_argument('--database', help='Database to install')
+    parser.add_argument('--database', action='append', help='Database to install; may be repeated (default: all)')
+    parser.add_argument('--annovar_dir', default='.', help='Directory with annotate_variation.pl')
+    parser.add_argument('--build', default='hg19', help='Genome build')
+    parser.add_argument('--dest_dir', default='humandb', help='Directory to install databases into')
+    parser.add_argument('--jobs', type=int, default=4, help='Number of concurrent downloads')
+    parser.add_argument('--retries', type=int, default=2, help='Number of retries for a failed download')
+    parser.add_argument('--mirror', help='Download all databases from this URL rather than their hosts')
+    parser.add_argument('--force', action='store_true', help='Install databases even if already installed')
+    parser.add_argument('--verify', action='store_true', help='Verify checksums of installed databases')
     args = parser.parse_args()
 
-    # Bare-bones database installation.
-    if args.database:
-        install_annovar_db(database=args.database)
-    else:
-        install_annovar_dbs()
+    results = install_annovar_dbs(annovar_dir=args.annovar_dir, build=args.build, dest_dir=args.dest_dir,
+                                  databases=args.database, jobs=args.jobs, retries=args.retries, mirror=args.mirror,
+                                  force=args.force, verify=args.verify)
+    for result in results:
+        print '%s\t%s\t%i\t%.1f\t%s' % ( result.database, result.status, result.attempts, result.seconds,
+                                          result.error or ','.join(result.files) )
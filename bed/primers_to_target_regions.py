@@ -1,7 +1,8 @@
 #!/bin/python
 
 #
-# Produce a list of target regions from a primer bed. Primer bed has the form:
+# Produce a list of target regions from a primer bed and, optionally, annotate variants with the amplicons that
+# contain them. Primer bed has the form:
 #
 # chr19 1206861 1206878 STK11_t1_2_FPrimer
 # chr19 1206957 1206978 STK11_t1_2_RPrimer
@@ -13,34 +14,146 @@
 # chr19 1206878 1206957 STK11_t1_2
 # chr19 1206924 1206996 STK11_t1_3
 #
+# Primers are paired by name (with an _FPrimer/_RPrimer or _F/_R suffix removed), so they may be in any order.
+# Primers without a suffix are paired by identical names, with strand (column 6) or position deciding which is
+# forward.
+#
 # Usage:
 #   python primers_to_target_regions.py < primer_locations.bed
+#   python primers_to_target_regions.py --annotate_vcf variants.vcf < primer_locations.bed > annotated.vcf
+#   python primers_to_target_regions.py --gemini_db variants.db < primer_locations.bed
 
+import argparse
+import bisect
+import gzip
+import re
+import sqlite3
 import sys
 
-def iterblocks(iter, n):
-    while 1:
-        rval = []
-        for i in range(n):
-            rval.append(iter.next())
-        yield rval
-
-block_count = 0
-for block in iterblocks(sys.stdin, 2):
-    # Split lines into fields.
-    fwd_primer_fields = block[0].split('\t')
-    rvs_primer_fields = block[1].split('\t')
-
-    # Validate that block makes sense.
-    if fwd_primer_fields[0] != rvs_primer_fields[0] or \
-       fwd_primer_fields[3] != rvs_primer_fields[3]:
-        print "Error: mismatched block:"
-        print "\t", block[0],
-        print "\t", block[1],
-        break
-
-    # Print target region for primers.
-    print "\t".join([fwd_primer_fields[0], 
-                     fwd_primer_fields[2], 
-                     rvs_primer_fields[1], 
-                     fwd_primer_fields[3]]),
+from collections import OrderedDict, defaultdict
+
+PRIMER_NAME_RE = re.compile(r'^(.+?)_(FPrimer|RPrimer|F|R)$')
+
+AMPLICON_INFO_HEADER = '##INFO=<ID=AMPLICON,Number=.,Type=String,Description="Amplicons that contain variant">\n'
+
+def read_primers(lines):
+    """
+    Returns ordered dictionary of amplicon name to list of (chrom, start, end, direction) for its primers, where
+    direction is 'F', 'R' or None if unknown.
+    """
+    primers = OrderedDict()
+    for line in lines:
+        fields = line.rstrip('\r\n').split('\t')
+        if len(fields) < 4 or line.startswith(('#', 'track', 'browser')):
+            continue
+        match = PRIMER_NAME_RE.match(fields[3])
+        if match:
+            name, direction = match.group(1), match.group(2)[0]
+        else:
+            name, direction = fields[3], None
+            if len(fields) > 5 and fields[5] in ['+', '-']:
+                direction = 'F' if fields[5] == '+' else 'R'
+        primers.setdefault(name, []).append( (fields[0], int(fields[1]), int(fields[2]), direction) )
+    return primers
+
+def pair_primers(primers, include_primers=False):
+    """
+    Yields (chrom, start, end, name) target region between each pair of primers, or the whole amplicon if
+    include_primers is set. Amplicons without exactly one forward and one reverse primer on the same chromosome
+    are skipped with a warning.
+    """
+    for name, pair in primers.items():
+        if len(pair) != 2 or pair[0][0] != pair[1][0]:
+            sys.stderr.write("Error: cannot pair primers for %s: %s\n" % (name, pair))
+            continue
+
+        # Use direction when known and position otherwise.
+        directions = [primer[3] for primer in pair]
+        if directions == ['R', 'F'] or (directions not in [['F', 'R'], ['R', 'F']] and pair[1][1] < pair[0][1]):
+            pair = [pair[1], pair[0]]
+        fwd, rvs = pair
+        if include_primers:
+            yield (fwd[0], fwd[1], rvs[2], name)
+        else:
+            yield (fwd[0], fwd[2], rvs[1], name)
+
+class AmpliconIndex(object):
+    """
+    Sorted per-chromosome index of (possibly overlapping) amplicon regions.
+    """
+    def __init__(self, regions):
+        self.regions = defaultdict(list)
+        for chrom, start, end, name in regions:
+            self.regions[chrom].append( (start, end, name) )
+        self.starts = {}
+        self.max_lengths = {}
+        for chrom, regions in self.regions.items():
+            regions.sort()
+            self.starts[chrom] = [region[0] for region in regions]
+            self.max_lengths[chrom] = max(region[1] - region[0] for region in regions)
+
+    def get_amplicons(self, chrom, start, end):
+        """
+        Returns names of amplicons that overlap a 0-based, half-open interval.
+        """
+        if chrom not in self.starts:
+            return []
+        starts = self.starts[chrom]
+        regions = self.regions[chrom]
+        return [ regions[i][2] for i in xrange( bisect.bisect_right(starts, start - self.max_lengths[chrom]),
+                                                bisect.bisect_left(starts, end) )
+                 if regions[i][1] > start ]
+
+def annotate_vcf(vcf_lines, index, output):
+    """
+    Writes VCF lines with an AMPLICON INFO field listing the amplicons that contain each variant.
+    """
+    for line in vcf_lines:
+        if line.startswith('#'):
+            if line.startswith('#CHROM'):
+                output.write(AMPLICON_INFO_HEADER)
+            output.write(line)
+            continue
+        fields = line.rstrip('\r\n').split('\t')
+        start = int(fields[1]) - 1
+        amplicons = index.get_amplicons(fields[0], start, start + len(fields[3]))
+        if amplicons:
+            amplicon_info = 'AMPLICON=' + ','.join(amplicons)
+            fields[7] = amplicon_info if fields[7] in ['', '.'] else fields[7] + ';' + amplicon_info
+        output.write('\t'.join(fields) + '\n')
+
+def annotate_gemini_db(gemini_db, index):
+    """
+    Sets amplicon column of variants table in a GEMINI database to the amplicons that contain each variant.
+    Returns number of variants in an amplicon.
+    """
+    conn = sqlite3.connect(gemini_db)
+    if 'amplicon' not in [ row[1] for row in conn.execute("pragma table_info(variants)") ]:
+        conn.execute("ALTER TABLE variants ADD COLUMN amplicon text DEFAULT NULL")
+    updates = []
+    for variant_id, chrom, start, end in conn.execute("SELECT variant_id, chrom, start, end FROM variants"):
+        amplicons = index.get_amplicons(chrom, start, end)
+        updates.append( (','.join(amplicons) if amplicons else None, variant_id) )
+    conn.executemany("UPDATE variants SET amplicon = ? WHERE variant_id = ?", updates)
+    conn.commit()
+    conn.close()
+    return sum(1 for amplicon, variant_id in updates if amplicon)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Produce target regions from primers and annotate variants.')
+    parser.add_argument("--include_primers", action="store_true", help="Include primers in target regions")
+    parser.add_argument("--annotate_vcf", help="Print this VCF (plain or gzip'ed) annotated with amplicons")
+    parser.add_argument("--gemini_db", help="Set amplicon column in this GEMINI database")
+    args = parser.parse_args()
+
+    regions = list( pair_primers(read_primers(sys.stdin), args.include_primers) )
+    if args.annotate_vcf or args.gemini_db:
+        index = AmpliconIndex(regions)
+        if args.annotate_vcf:
+            vcf_file = gzip.open(args.annotate_vcf) if args.annotate_vcf.endswith('.gz') else open(args.annotate_vcf)
+            annotate_vcf(vcf_file, index, sys.stdout)
+        if args.gemini_db:
+            sys.stderr.write( "%i variants in amplicons\n" % annotate_gemini_db(args.gemini_db, index) )
+    else:
+        for chrom, start, end, name in regions:
+            print "%s\t%i\t%i\t%s" % (chrom, start, end, name)
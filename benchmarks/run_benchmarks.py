@@ -0,0 +1,343 @@
+"""
+Benchmarks for the somatic, replicate and primer hot paths on synthetic data (see synthetic_data.py).
+
+Each scenario runs a tree's command-line scripts (or, where a script has no operation for it, a module function)
+on the same data in a child process, so that any commit can be benchmarked, including ones from before this suite,
+and each run's time, CPU time and peak RSS are its own. Times include starting Python and importing modules.
+Setup (e.g. copying and indexing a database) is not timed. Scenarios that use options a tree does not have, or that
+need GEMINI when it is not installed, are skipped. Results are printed as a table and appended as JSON lines to an
+output file, one line per scenario and size with the commit, timings and memory, so that runs for different commits
+can be compared:
+
+    git worktree add ../base <base commit>
+    python run_benchmarks.py run --home_dir ../base --output base.jsonl
+    python run_benchmarks.py run --output new.jsonl
+    python run_benchmarks.py compare base.jsonl new.jsonl
+
+Sizes are preset names or <variants>x<samples>x<annotations>, e.g. 50000x12x4. Everything runs offline.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from collections import OrderedDict, namedtuple
+
+import synthetic_data
+
+HOME_DIR = os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) )
+
+SIZES = OrderedDict([
+    ('small', (2000, 6, 3)),
+    ('medium', (20000, 12, 5)),
+    ('large', (200000, 24, 10))
+])
+
+def get_size(size):
+    """
+    Returns (variants, samples, annotations) for a preset name or <variants>x<samples>x<annotations>.
+    """
+    if size in SIZES:
+        return SIZES[size]
+    try:
+        num_variants, num_samples, num_annotations = [ int(value) for value in size.split('x') ]
+    except ValueError:
+        raise ValueError("Size must be one of %s or <variants>x<samples>x<annotations>: %s" %
+                         (', '.join(SIZES), size))
+    return num_variants, num_samples, num_annotations
+
+#
+# Scenarios: command functions take the data dictionary from synthetic_data.make_data, a temporary directory and
+# the home directory of the tree being benchmarked and return (arguments to Python, file to read standard input from
+# or None, output files). The number of lines written to standard output plus the number of records in output files
+# is recorded to check that runs did the same work. Setup functions take the same arguments and are run before each
+# run without being timed.
+#
+
+# Scenario: requires is (script, text) where text must be in the script for the scenario to run, or None.
+Scenario = namedtuple('Scenario', ['command', 'setup', 'requires', 'needs_gemini'])
+
+GEMINI_OPERATIONS = os.path.join('vcf', 'gemini_operations.py')
+
+def get_script(home_dir, script):
+    return os.path.join(home_dir, script)
+
+def get_somatic_command(data, tmp_dir, home_dir, gemini_db=None):
+    output_vcf = os.path.join(tmp_dir, 'somatic.vcf')
+    return ( [ get_script(home_dir, GEMINI_OPERATIONS), 'find_somatic', gemini_db or data['gemini_db'],
+               '--annotations', ','.join(data['annotations']), '--output_vcf', output_vcf ], None, [output_vcf] )
+
+def setup_somatic_prepared(data, tmp_dir, home_dir):
+    gemini_db = os.path.join(tmp_dir, 'prepared.db')
+    shutil.copyfile(data['gemini_db'], gemini_db)
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call( [ sys.executable, get_script(home_dir, GEMINI_OPERATIONS), 'prepare', gemini_db,
+                                 '--annotations', ','.join(data['annotations']), '--no_timings' ], stdout=devnull )
+
+def get_somatic_prepared_command(data, tmp_dir, home_dir):
+    return get_somatic_command(data, tmp_dir, home_dir, os.path.join(tmp_dir, 'prepared.db'))
+
+def get_query_sample_command(data, tmp_dir, home_dir, query_engine=None):
+    sample = synthetic_data.get_sample_names(1)[0]
+    args = [ get_script(home_dir, GEMINI_OPERATIONS), 'query_sample', data['gemini_db'], '--sample', sample,
+             '--cols', 'chrom, start, end, ref, alt, gt_depths.%s' % sample, '--gt_count', '1' ]
+    if query_engine:
+        args += ['--query_engine', query_engine]
+    return args, None, []
+
+def get_query_sample_fast_command(data, tmp_dir, home_dir):
+    return get_query_sample_command(data, tmp_dir, home_dir, 'fast')
+
+def get_query_sample_parity_command(data, tmp_dir, home_dir):
+    return get_query_sample_command(data, tmp_dir, home_dir, 'parity')
+
+def get_function_command(module, function, *args):
+    """
+    Returns arguments to Python to call a function of a module in the vcf directory.
+    """
+    return ['-c', 'import %s; %s.%s(%s)' % ( module, module, function, ', '.join(repr(arg) for arg in args) )]
+
+def get_amplicons_command(data, tmp_dir, home_dir):
+    # gemini_operations.py has no operation for amplicons.
+    return get_function_command('gemini_operations', 'get_amplicons', data['gemini_db']), None, []
+
+def get_replicates_command(data, tmp_dir, home_dir):
+    # Call the function because the compare_replicates operation was not connected to it at the baseline commit.
+    return get_function_command('gemini_operations', 'compare_replicates', data['gemini_db']), None, []
+
+def get_concordance_command(data, tmp_dir, home_dir):
+    return [ get_script(home_dir, os.path.join('vcf', 'replicates', 'replicates_vs_nonreplicates.py')) ], \
+           data['genotypes'], []
+
+def get_primers_command(data, tmp_dir, home_dir, annotate=False):
+    args = [ get_script(home_dir, os.path.join('bed', 'primers_to_target_regions.py')) ]
+    if annotate:
+        args += ['--annotate_vcf', data['vcf']]
+    return args, data['primers'], []
+
+def get_primers_annotate_command(data, tmp_dir, home_dir):
+    return get_primers_command(data, tmp_dir, home_dir, True)
+
+SCENARIOS = OrderedDict([
+    ('somatic', Scenario(get_somatic_command, None, None, True)),
+    ('somatic_prepared', Scenario(get_somatic_prepared_command, setup_somatic_prepared,
+                                  (GEMINI_OPERATIONS, 'operation == "prepare"'), True)),
+    ('query_sample', Scenario(get_query_sample_command, None, None, True)),
+    ('query_sample_fast', Scenario(get_query_sample_fast_command, None, (GEMINI_OPERATIONS, '--query_engine'), True)),
+    ('query_sample_parity', Scenario(get_query_sample_parity_command, None, (GEMINI_OPERATIONS, '--query_engine'),
+                                     True)),
+    ('amplicons', Scenario(get_amplicons_command, None, None, True)),
+    ('replicates', Scenario(get_replicates_command, None, None, True)),
+    ('concordance', Scenario(get_concordance_command, None, None, False)),
+    ('primers', Scenario(get_primers_command, None, None, False)),
+    ('primers_annotate', Scenario(get_primers_annotate_command, None,
+                                  (os.path.join('bed', 'primers_to_target_regions.py'), '--annotate_vcf'), False))
+])
+
+def get_skip_reason(scenario, home_dir, gemini_installed):
+    """
+    Returns why a scenario cannot run in a tree, or None if it can.
+    """
+    scenario = SCENARIOS[scenario]
+    if scenario.needs_gemini and not gemini_installed:
+        return 'GEMINI is not installed'
+    if scenario.requires:
+        script, text = scenario.requires
+        path = get_script(home_dir, script)
+        if not os.path.exists(path) or text not in open(path).read():
+            return '%s does not support %s' % (script, text)
+    return None
+
+def count_records(path):
+    """
+    Returns number of lines in a file that are not headers, or 0 if it does not exist.
+    """
+    if not os.path.exists(path):
+        return 0
+    return sum( 1 for line in open(path) if not line.startswith('#') )
+
+def run_command(args, stdin_path, tmp_dir, home_dir):
+    """
+    Runs Python with arguments in a child process and returns (seconds, CPU seconds, peak RSS in KB, lines written
+    to standard output), or an error message if it fails.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join( [os.path.join(home_dir, 'vcf')] +
+                                         ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []) )
+    stdin = open(stdin_path) if stdin_path else open(os.devnull)
+    stderr = open(os.path.join(tmp_dir, 'stderr.txt'), 'w+')
+    start = time.time()
+    process = subprocess.Popen([sys.executable] + args, stdin=stdin, stdout=subprocess.PIPE, stderr=stderr,
+                               cwd=tmp_dir, env=env)
+    lines = sum(1 for line in process.stdout)
+    # wait4 gives resource usage of this child only, unlike getrusage(RUSAGE_CHILDREN).
+    pid, status, usage = os.wait4(process.pid, 0)
+    seconds = time.time() - start
+    process.returncode = status
+    stdin.close()
+
+    if not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0:
+        stderr.seek(0)
+        errors = [ line.strip() for line in stderr if line.strip() ]
+        stderr.close()
+        if os.WIFSIGNALED(status):
+            reason = 'killed by signal %i' % os.WTERMSIG(status)
+        else:
+            reason = 'exit status %i' % os.WEXITSTATUS(status)
+        return '%s: %s' % (reason, errors[-1] if errors else '')
+    stderr.close()
+    peak_rss_kb = usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+    return seconds, usage.ru_utime + usage.ru_stime, peak_rss_kb, lines
+
+def run_scenario(scenario, data, home_dir):
+    """
+    Returns (seconds, CPU seconds, peak RSS in KB, result) for one run of a scenario, or an error message.
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        command, setup, requires, needs_gemini = SCENARIOS[scenario]
+        if setup:
+            setup(data, tmp_dir, home_dir)
+        args, stdin_path, outputs = command(data, tmp_dir, home_dir)
+        run = run_command(args, stdin_path, tmp_dir, home_dir)
+        if isinstance(run, str):
+            return run
+        seconds, cpu_seconds, peak_rss_kb, lines = run
+        return seconds, cpu_seconds, peak_rss_kb, lines + sum( count_records(output) for output in outputs )
+    except (OSError, subprocess.CalledProcessError) as e:
+        return '%s: %s' % (type(e).__name__, e)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def has_gemini():
+    try:
+        import gemini
+    except ImportError:
+        return False
+    return True
+
+def get_commit(home_dir):
+    """
+    Returns current git commit of a tree, or None.
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=home_dir, stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(scenarios, sizes, data_dir, repeats=3, seed=0, home_dir=HOME_DIR):
+    """
+    Yields a result dictionary for each scenario and size, running scripts of the tree in home_dir.
+    """
+    commit = get_commit(home_dir)
+    gemini_installed = has_gemini()
+    for size in sizes:
+        num_variants, num_samples, num_annotations = get_size(size)
+        data = synthetic_data.make_data(data_dir, num_variants, num_samples, num_annotations, seed)
+        for scenario in scenarios:
+            record = OrderedDict([ ('commit', commit), ('timestamp', time.time()), ('scenario', scenario),
+                                   ('size', size), ('variants', num_variants), ('samples', num_samples),
+                                   ('annotations', num_annotations), ('seed', seed),
+                                   ('python', platform.python_version()), ('status', 'ok') ])
+            skip_reason = get_skip_reason(scenario, home_dir, gemini_installed)
+            if skip_reason:
+                record['status'] = 'skipped: %s' % skip_reason
+                yield record
+                continue
+
+            runs = []
+            for i in range(repeats):
+                run = run_scenario(scenario, data, home_dir)
+                if isinstance(run, str):
+                    record['status'] = 'error: %s' % run
+                    break
+                runs.append(run)
+            if runs:
+                seconds = sorted(run[0] for run in runs)
+                record['seconds'] = [run[0] for run in runs]
+                record['min_seconds'] = seconds[0]
+                record['median_seconds'] = seconds[len(seconds) // 2]
+                record['min_cpu_seconds'] = min(run[1] for run in runs)
+                record['peak_rss_kb'] = max(run[2] for run in runs)
+                record['result'] = runs[0][3]
+                if any(run[3] != runs[0][3] for run in runs):
+                    record['status'] = 'error: results differ between runs'
+            yield record
+
+def read_results(path):
+    """
+    Returns dictionary of (scenario, size) to the last result in a results file.
+    """
+    results = OrderedDict()
+    for line in open(path):
+        if line.strip():
+            record = json.loads(line)
+            results[ (record['scenario'], record['size']) ] = record
+    return results
+
+def print_record(record):
+    if record['status'] == 'ok':
+        print '%-20s %-18s %10.3f %10.3f %10.3f %12i %12s' % \
+              ( record['scenario'], record['size'], record['min_seconds'], record['median_seconds'],
+                record['min_cpu_seconds'], record['peak_rss_kb'], record['result'] )
+    else:
+        print '%-20s %-18s %s' % ( record['scenario'], record['size'], record['status'] )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run benchmarks on synthetic data.')
+    parser.add_argument("operation", choices=['run', 'compare'], help="Operation to perform")
+    parser.add_argument("results", nargs="*", help="Results files to compare: <base> <new>")
+    parser.add_argument("--scenarios", default=','.join(SCENARIOS),
+                        help="Comma-separated scenarios (default: all of %s)" % ', '.join(SCENARIOS))
+    parser.add_argument("--sizes", default="small,medium",
+                        help="Comma-separated sizes: %s or <variants>x<samples>x<annotations>" % ', '.join(SIZES))
+    parser.add_argument("--repeats", type=int, default=3, help="Number of runs of each scenario at each size")
+    parser.add_argument("--data_dir", help="Directory for synthetic data, reused between runs (default: temporary)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for synthetic data")
+    parser.add_argument("--output", default="benchmark_results.jsonl", help="Append results to this file")
+    parser.add_argument("--home_dir", default=HOME_DIR,
+                        help="Benchmark scripts of the tree in this directory, e.g. a git worktree of another commit "
+                             "(default: this tree)")
+    args = parser.parse_args()
+
+    if args.operation == 'run':
+        scenarios = args.scenarios.split(',')
+        for scenario in scenarios:
+            if scenario not in SCENARIOS:
+                parser.error("Unknown scenario: %s" % scenario)
+        data_dir = os.path.abspath(args.data_dir) if args.data_dir else tempfile.mkdtemp()
+
+        print '%-20s %-18s %10s %10s %10s %12s %12s' % ('scenario', 'size', 'min_s', 'median_s', 'min_cpu_s',
+                                                        'peak_rss_kb', 'result')
+        with open(args.output, 'a') as output:
+            for record in run_benchmarks(scenarios, args.sizes.split(','), data_dir, args.repeats, args.seed,
+                                         os.path.abspath(args.home_dir)):
+                output.write(json.dumps(record) + '\n')
+                output.flush()
+                print_record(record)
+
+        if not args.data_dir:
+            shutil.rmtree(data_dir)
+    elif args.operation == 'compare':
+        if len(args.results) != 2:
+            parser.error("compare requires two results files: <base> <new>")
+        base = read_results(args.results[0])
+        new = read_results(args.results[1])
+        print '%-20s %-18s %10s %10s %8s %12s %12s' % ('scenario', 'size', 'base_s', 'new_s', 'ratio',
+                                                       'base_rss_kb', 'new_rss_kb')
+        for key in base:
+            if key not in new or base[key]['status'] != 'ok' or new[key]['status'] != 'ok':
+                continue
+            base_seconds, new_seconds = base[key]['min_seconds'], new[key]['min_seconds']
+            print '%-20s %-18s %10.3f %10.3f %8.2f %12i %12i' % \
+                  ( key[0], key[1], base_seconds, new_seconds, new_seconds / base_seconds if base_seconds else 0,
+                    base[key]['peak_rss_kb'], new[key]['peak_rss_kb'] )
+            if base[key]['result'] != new[key]['result']:
+                print '  Warning: results differ (%s, %s)' % (base[key]['result'], new[key]['result'])
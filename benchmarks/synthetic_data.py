@@ -0,0 +1,293 @@
+"""
+Deterministic synthetic data for benchmarks: GEMINI-shaped SQLite databases, genotype TSVs (as read by
+replicates_vs_nonreplicates.py), primer BEDs and VCFs, all scalable by variants x samples x annotations.
+
+Data for the same size and seed is identical across runs. Samples are replicate pairs named
+S<i>_FirstBatch_A/S<i>_Repeats_A, as compare_replicates and replicates_vs_nonreplicates.py pair them, where the
+repeat shares most genotypes with the original. Variants have all of GEMINI's per-sample genotype columns (gts,
+gt_types, gt_phases, gt_depths, gt_ref_depths, gt_alt_depths, gt_quals, gt_copy_numbers and gt_phred_ll_*), so
+genotype filters on any of them can be run, and an amplicon column. Genotype blobs are packed like GEMINI's
+compression.pack_blob (zlib-compressed pickles of NumPy arrays), so GEMINI is not needed to create databases.
+
+Data is written in the formats the scripts read at the baseline commit too (e.g. variants only on chr1-chr22,
+because baseline find_somatic sorts chromosomes as numbers, and primers with the same name on adjacent lines), so
+that benchmarks can compare old and new code on the same data.
+
+Usage:
+    python synthetic_data.py <output_dir> [--variants N] [--samples N] [--annotations N] [--seed N]
+"""
+
+import argparse
+import cPickle
+import os
+import random
+import sqlite3
+import zlib
+
+import numpy
+
+from collections import OrderedDict
+
+CHROMS = ['chr%i' % i for i in range(1, 23)]
+BASES = 'ACGT'
+
+# GEMINI genotype types.
+HOM_REF, HET, UNKNOWN, HOM_ALT = 0, 1, 2, 3
+
+# Fraction of genotypes that a repeat sample shares with its original sample.
+REPLICATE_CONCORDANCE = 0.8
+
+VARIANTS_SCHEMA = [
+    ('variant_id', 'integer primary key'), ('chrom', 'text'), ('start', 'integer'), ('end', 'integer'),
+    ('vcf_id', 'text'), ('ref', 'text'), ('alt', 'text'), ('qual', 'float'), ('filter', 'text'), ('type', 'text'),
+    ('gene', 'text'), ('allele_bal', 'float'), ('impact_severity', 'text'), ('sift_pred', 'text'),
+    ('polyphen_pred', 'text'), ('in_1kg', 'bool'), ('aaf_1kg_all', 'float'), ('in_exac', 'bool'),
+    ('aaf_exac_all', 'float'), ('in_esp', 'bool'), ('aaf_esp_all', 'float'), ('amplicon', 'text'), ('info', 'blob'),
+    ('gts', 'blob'), ('gt_types', 'blob'), ('gt_phases', 'blob'), ('gt_depths', 'blob'), ('gt_ref_depths', 'blob'),
+    ('gt_alt_depths', 'blob'), ('gt_quals', 'blob'), ('gt_copy_numbers', 'blob'), ('gt_phred_ll_homref', 'blob'),
+    ('gt_phred_ll_het', 'blob'), ('gt_phred_ll_homalt', 'blob')
+]
+
+# Fraction of alternate reads for each genotype type.
+ALT_FRACTIONS = { HOM_REF: 0.0, HET: 0.5, UNKNOWN: 0.0, HOM_ALT: 1.0 }
+
+# Number of variants in each amplicon.
+AMPLICON_VARIANTS = 10
+
+# Indexes that gemini load creates (gemini.database.create_indices) on columns that synthetic databases have.
+GEMINI_INDEXES = [
+    ('var_chr_start_idx', 'variants', 'chrom, start'), ('var_type_idx', 'variants', 'type'),
+    ('var_gene_idx', 'variants', 'gene'), ('var_impact_severity_idx', 'variants', 'impact_severity'),
+    ('var_esp_idx', 'variants', 'aaf_esp_all'), ('var_1kg_idx', 'variants', 'aaf_1kg_all'),
+    ('var_qual_idx', 'variants', 'qual'), ('sample_name_idx', 'samples', 'name')
+]
+
+# Version of generated data, part of data names so that data cached by an older generator (e.g. without the
+# S<i>_FirstBatch_A sample names or the amplicon column) is not reused. Increase whenever generated data changes.
+DATA_VERSION = 2
+
+def pack_blob(obj):
+    """
+    Returns blob for an object, packed as GEMINI packs it.
+    """
+    return sqlite3.Binary(zlib.compress(cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL), 9))
+
+def get_sample_names(num_samples):
+    """
+    Returns sample names: replicate pairs S<i>_FirstBatch_A, S<i>_Repeats_A.
+    """
+    return [ 'S%i_%s_A' % (i // 2, 'FirstBatch' if i % 2 == 0 else 'Repeats') for i in range(num_samples) ]
+
+def get_annotation_names(num_annotations):
+    """
+    Returns annotation (column) names.
+    """
+    return [ 'ANNO%i' % i for i in range(num_annotations) ]
+
+def get_variant_sites(num_variants, seed=0):
+    """
+    Returns list of (chrom, start, ref, alt, type) for variants spread over chromosomes in sorted order, with
+    0-based starts.
+    """
+    rng = random.Random(seed)
+    sites = []
+    start = 0
+    chrom_idx = -1
+    for i in range(num_variants):
+        if i * len(CHROMS) // num_variants != chrom_idx:
+            chrom_idx = i * len(CHROMS) // num_variants
+            start = 10000
+        start += rng.randint(1, 400)
+        ref = rng.choice(BASES)
+        if rng.random() < 0.8:
+            sites.append( (CHROMS[chrom_idx], start, ref, rng.choice([b for b in BASES if b != ref]), 'snp') )
+        else:
+            sites.append( (CHROMS[chrom_idx], start, ref, ref + rng.choice(BASES), 'indel') )
+    return sites
+
+def get_genotype_types(num_variants, num_samples, seed=0):
+    """
+    Returns (variants x samples) int8 array of GEMINI genotype types where each repeat sample shares most
+    genotypes with its original sample.
+    """
+    random_state = numpy.random.RandomState(seed)
+    gt_types = random_state.choice( [HOM_REF, HET, UNKNOWN, HOM_ALT], size=(num_variants, num_samples),
+                                    p=[0.3, 0.4, 0.1, 0.2] ).astype(numpy.int8)
+    for j in range(1, num_samples, 2):
+        shared = random_state.random_sample(num_variants) < REPLICATE_CONCORDANCE
+        gt_types[shared, j] = gt_types[shared, j - 1]
+    return gt_types
+
+def get_genotype(gt_type, ref, alt):
+    """
+    Returns VCF-style genotype string for a GEMINI genotype type.
+    """
+    if gt_type == HOM_REF:
+        return '%s/%s' % (ref, ref)
+    elif gt_type == HET:
+        return '%s/%s' % (ref, alt)
+    elif gt_type == HOM_ALT:
+        return '%s/%s' % (alt, alt)
+    return './.'
+
+def get_depths(gt_types, rng):
+    """
+    Returns (depths, ref depths, alt depths) arrays for the genotype types of a variant, with -1 for unknown
+    genotypes as in GEMINI.
+    """
+    depths = numpy.array([ rng.randint(20, 500) for gt_type in gt_types ], dtype=numpy.int32)
+    alt_depths = numpy.array([ int(depth * ALT_FRACTIONS[gt_type]) for depth, gt_type in zip(depths, gt_types) ],
+                             dtype=numpy.int32)
+    ref_depths = depths - alt_depths
+    unknown = gt_types == UNKNOWN
+    for array in (depths, ref_depths, alt_depths):
+        array[unknown] = -1
+    return depths, ref_depths, alt_depths
+
+def get_amplicon(i, rng):
+    """
+    Returns amplicon column of the i'th variant: the amplicon AMP<n> it is in, and sometimes also the next,
+    overlapping amplicon.
+    """
+    amplicon = 'AMP%i' % (i // AMPLICON_VARIANTS)
+    if rng.random() < 0.1:
+        amplicon += ',AMP%i' % (i // AMPLICON_VARIANTS + 1)
+    return amplicon
+
+def make_gemini_db(path, num_variants, num_samples, num_annotations, seed=0):
+    """
+    Creates a GEMINI-shaped database with samples, vcf_header and variants tables. Variants have boolean
+    annotation columns, an amplicon column and compressed blobs for all genotype columns. Tables have the indexes
+    that gemini load creates on their columns.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    rng = random.Random(seed)
+    samples = get_sample_names(num_samples)
+    annotations = get_annotation_names(num_annotations)
+    sites = get_variant_sites(num_variants, seed)
+    gt_types = get_genotype_types(num_variants, num_samples, seed)
+
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE samples (sample_id integer, family_id text, name text, paternal_id text, "
+                 "maternal_id text, sex text, phenotype text)")
+    conn.executemany("INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     [ (i + 1, '0', name, '0', '0', '-9', '-9') for i, name in enumerate(samples) ])
+    conn.execute("CREATE TABLE vcf_header (vcf_header text)")
+    conn.execute("INSERT INTO vcf_header VALUES (?)",
+                 ('##fileformat=VCFv4.1\n' + ''.join('##contig=<ID=%s>\n' % chrom for chrom in CHROMS) +
+                  '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t%s' % '\t'.join(samples),))
+    columns = VARIANTS_SCHEMA + [ (anno, 'bool') for anno in annotations ]
+    conn.execute("CREATE TABLE variants (%s)" % ', '.join('%s %s' % column for column in columns))
+
+    def rows():
+        for i, (chrom, start, ref, alt, var_type) in enumerate(sites):
+            gts = numpy.array([ get_genotype(gt_type, ref, alt) for gt_type in gt_types[i] ], dtype=object)
+            rare = rng.random() < 0.7
+            row = [ i + 1, chrom, start, start + len(ref), None, ref, alt, rng.uniform(20, 100), None, var_type,
+                    'GENE%i' % (start // 50000), rng.choice([None, 0.01, 0.05, 0.2, 0.5]),
+                    rng.choice(['HIGH', 'MED', 'LOW']), rng.choice(['deleterious', 'tolerated', None]),
+                    rng.choice(['probably_damaging', 'possibly_damaging', 'benign', None]) ]
+            for db in range(3):
+                in_db = 0 if rare else rng.choice([0, 1])
+                row += [ in_db, rng.uniform(0.1, 0.5) if in_db else None ]
+            depths, ref_depths, alt_depths = get_depths(gt_types[i], rng)
+            quals = numpy.array([ rng.uniform(10, 99) for j in range(num_samples) ], dtype=numpy.float32)
+            unknown = numpy.full(num_samples, -1, dtype=numpy.int32)
+            row += [ get_amplicon(i, rng), pack_blob(OrderedDict([ ('DP', int(depths.clip(0).sum())) ])),
+                     pack_blob(gts), pack_blob(gt_types[i]), pack_blob(numpy.zeros(num_samples, dtype=numpy.bool_)),
+                     pack_blob(depths), pack_blob(ref_depths), pack_blob(alt_depths), pack_blob(quals),
+                     pack_blob(unknown), pack_blob(unknown), pack_blob(unknown), pack_blob(unknown) ]
+            row += [ int(rng.random() < 0.1) for anno in annotations ]
+            yield row
+
+    conn.executemany( "INSERT INTO variants VALUES (%s)" % ', '.join('?' * len(columns)), rows() )
+    for name, table, index_columns in GEMINI_INDEXES:
+        conn.execute("CREATE INDEX %s ON %s (%s)" % (name, table, index_columns))
+    conn.commit()
+    conn.close()
+    return annotations
+
+def write_genotype_tsv(path, num_variants, num_samples, seed=0):
+    """
+    Writes genotypes as a TSV with a header line and variant_id, chrom, start and sample genotype columns.
+    """
+    samples = get_sample_names(num_samples)
+    sites = get_variant_sites(num_variants, seed)
+    gt_types = get_genotype_types(num_variants, num_samples, seed)
+    with open(path, 'w') as output:
+        output.write( '\t'.join(['variant_id', 'chrom', 'start'] + ['gts.%s' % sample for sample in samples]) + '\n' )
+        for i, (chrom, start, ref, alt, var_type) in enumerate(sites):
+            genotypes = [ get_genotype(gt_type, ref, alt) for gt_type in gt_types[i] ]
+            output.write( '\t'.join([str(i + 1), chrom, str(start)] + genotypes) + '\n' )
+
+def write_vcf(path, num_variants, seed=0):
+    """
+    Writes variant sites as a sites-only VCF.
+    """
+    with open(path, 'w') as output:
+        output.write('##fileformat=VCFv4.1\n')
+        output.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+        for chrom, start, ref, alt, var_type in get_variant_sites(num_variants, seed):
+            output.write('%s\t%i\t.\t%s\t%s\t50\tPASS\t.\n' % (chrom, start + 1, ref, alt))
+
+def write_primer_bed(path, num_variants, seed=0):
+    """
+    Writes a primer BED for amplicons tiled over the variant sites, one amplicon AMP<n> for every
+    AMPLICON_VARIANTS variants. Both primers of an amplicon have its name and are on adjacent lines, forward primer
+    first, which both the baseline and the name-pairing primers_to_target_regions.py read.
+    """
+    rng = random.Random(seed)
+    sites = get_variant_sites(num_variants, seed)
+    primers = []
+    for i in range(0, len(sites), AMPLICON_VARIANTS):
+        chrom, start = sites[i][:2]
+        amplicon_start = max(0, start - rng.randint(20, 80))
+        amplicon_end = amplicon_start + rng.randint(150, 250)
+        name = 'AMP%i' % (i // AMPLICON_VARIANTS)
+        primers.append( (chrom, amplicon_start, amplicon_start + 20, name) )
+        primers.append( (chrom, amplicon_end - 20, amplicon_end, name) )
+    with open(path, 'w') as output:
+        for primer in primers:
+            output.write('%s\t%i\t%i\t%s\n' % primer)
+
+def get_data_name(num_variants, num_samples, num_annotations, seed=0):
+    """
+    Returns name for data of a size and seed from the current DATA_VERSION.
+    """
+    return 'v%i_s%i_a%i_seed%i_gen%i' % (num_variants, num_samples, num_annotations, seed, DATA_VERSION)
+
+def make_data(output_dir, num_variants, num_samples, num_annotations, seed=0):
+    """
+    Creates all data for a size in output_dir unless it already exists. Returns dictionary of data type to path
+    and 'annotations' to annotation names.
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    base = os.path.join(output_dir, get_data_name(num_variants, num_samples, num_annotations, seed))
+    data = OrderedDict([ ('gemini_db', base + '.db'), ('genotypes', base + '_genotypes.tsv'),
+                         ('vcf', base + '.vcf'), ('primers', base + '_primers.bed') ])
+    makers = { 'gemini_db': lambda path: make_gemini_db(path, num_variants, num_samples, num_annotations, seed),
+               'genotypes': lambda path: write_genotype_tsv(path, num_variants, num_samples, seed),
+               'vcf': lambda path: write_vcf(path, num_variants, seed),
+               'primers': lambda path: write_primer_bed(path, num_variants, seed) }
+    for data_type, path in data.items():
+        if not os.path.exists(path):
+            # Write to a temporary file so that interrupted runs do not leave partial data.
+            makers[data_type](path + '.tmp')
+            os.rename(path + '.tmp', path)
+    data['annotations'] = get_annotation_names(num_annotations)
+    return data
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Create synthetic benchmark data.')
+    parser.add_argument("output_dir", help="Directory to write data to")
+    parser.add_argument("--variants", type=int, default=10000, help="Number of variants")
+    parser.add_argument("--samples", type=int, default=6, help="Number of samples")
+    parser.add_argument("--annotations", type=int, default=3, help="Number of annotations")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    for data_type, value in make_data(args.output_dir, args.variants, args.samples, args.annotations,
+                                      args.seed).items():
+        print '%s\t%s' % (data_type, value if isinstance(value, str) else ','.join(value))
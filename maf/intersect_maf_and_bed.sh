@@ -1,7 +1,5 @@
 #!/bin/sh
 
-# Script requires BEDtools.
-
 # Arguments check.
 if [ $# -ne "2" ]
 then
@@ -11,9 +9,7 @@ fi
 
 MAF=$1
 BED=$2
+DIR="$( cd "$( dirname "$0" )" && pwd )"
 
-# Use awk to create interval (BED-like file from MAF),
-# then print MAF header, intersect MAF with BED to get overlaps,
-# and remove the initial columns to get back to a MAF.
-awk '(NR > 2) {print "chr" $5, $6 -1, $7, $0;}' OFS='\t' $MAF \
-| (head -n 2 $MAF; bedtools intersect -a stdin -b $BED | cut -f4-)
+# Print MAF header and MAF records that overlap BED regions.
+python ${DIR}/maf_tools.py $MAF --bed $BED --maf -
@@ -5,10 +5,7 @@ then
   exit -1
 fi
 
-# Add header.
-echo '##fileformat=VCFv4.1' > $2
-echo '#CHROM	POS	ID	REF	ALT	QUAL	FILTER	INFO' >> $2
+DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )"
 
-# Convert MAF to VCF by printing VCF columns and sorting and removing duplicates.
-BASE=$(basename "$1" .maf)
-tail -n +3 $1 | awk -v FS='	' -v OFS='	' "{print \"chr\"\$5, \$6, \".\", \$11, \$13, \".\", \".\", \"${BASE}=TRUE\"}" | sort -k1,1 -k2,2n | uniq >> $2
+# Convert MAF to VCF, sorting and removing duplicates; records are annotated with <input_maf name>=TRUE.
+python ${DIR}/maf_tools.py $1 --vcf $2
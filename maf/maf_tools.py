@@ -0,0 +1,191 @@
+"""
+Stream MAF files (e.g. from TCGA) once to intersect them with target regions and convert them to VCF and ANNOVAR
+annotation files.
+
+Columns are found by name in the MAF header, so MAFs with different column orders, version lines or comment lines
+can be combined. Records from all MAFs are deduplicated, and all requested outputs are written from the same pass.
+
+Usage:
+    python maf_tools.py <input.maf> [<input.maf> ...] [--bed <targets.bed>] [--maf <output.maf>]
+                        [--vcf <output.vcf>] [--annovar <hg19_NAME.txt>] [--name NAME]
+
+An output of '-' is written to standard output, so wrappers can be redirected or appended to.
+"""
+
+import argparse
+import bisect
+import os
+import sys
+
+from collections import defaultdict
+
+# Columns used, with alternative names used by some MAFs.
+COLUMNS = {
+    'chrom': ['Chromosome'],
+    'start': ['Start_Position', 'Start_position'],
+    'end': ['End_Position', 'End_position'],
+    'ref': ['Reference_Allele'],
+    'alt': ['Tumor_Seq_Allele2']
+}
+
+def get_column_indices(header_fields):
+    """
+    Returns dictionary of column key to index in MAF header fields.
+    """
+    names = dict( (name.lower(), i) for i, name in enumerate(header_fields) )
+    indices = {}
+    for key, alternatives in COLUMNS.items():
+        for name in alternatives:
+            if name.lower() in names:
+                indices[key] = names[name.lower()]
+                break
+        else:
+            raise ValueError("MAF header has no %s column" % alternatives[0])
+    return indices
+
+def read_maf(maf_file):
+    """
+    Yields (line, record) for each record in a MAF, where record is (chrom, start, end, ref, alt) with 1-based
+    start and end and chrom prefixed with 'chr'. The first yielded line is the header, with record None; comment
+    lines before it are yielded the same way.
+    """
+    indices = None
+    for line in maf_file:
+        if indices is None:
+            yield (line, None)
+            if not line.startswith('#'):
+                fields = line.rstrip('\r\n').split('\t')
+                indices = get_column_indices(fields)
+                num_fields = max(indices.values()) + 1
+            continue
+        fields = line.rstrip('\r\n').split('\t')
+        if len(fields) < num_fields:
+            continue
+        chrom = fields[indices['chrom']]
+        if not chrom.startswith('chr'):
+            chrom = 'chr' + chrom
+        yield ( line, (chrom, int(fields[indices['start']]), int(fields[indices['end']]),
+                       fields[indices['ref']], fields[indices['alt']]) )
+
+class RegionIndex(object):
+    """
+    Sorted per-chromosome index of BED regions.
+    """
+    def __init__(self, bed_file):
+        self.regions = defaultdict(list)
+        for line in open(bed_file):
+            if line.startswith(('#', 'track', 'browser')) or not line.strip():
+                continue
+            fields = line.split('\t')
+            self.regions[fields[0]].append( (int(fields[1]), int(fields[2])) )
+        self.starts = {}
+        self.max_lengths = {}
+        for chrom, regions in self.regions.items():
+            regions.sort()
+            self.starts[chrom] = [region[0] for region in regions]
+            self.max_lengths[chrom] = max(region[1] - region[0] for region in regions)
+
+    def overlaps(self, chrom, start, end):
+        """
+        Returns True if a 0-based, half-open interval overlaps a region.
+        """
+        if chrom not in self.starts:
+            return False
+        starts = self.starts[chrom]
+        regions = self.regions[chrom]
+        for i in xrange( bisect.bisect_right(starts, start - self.max_lengths[chrom]),
+                         bisect.bisect_left(starts, end) ):
+            if regions[i][1] > start:
+                return True
+        return False
+
+def process_mafs(maf_files, region_index=None, maf_output=None):
+    """
+    Reads MAFs once, writing records that overlap regions (all records if region_index is None) to maf_output if
+    given. Returns set of unique (chrom, start, end, ref, alt) records.
+    """
+    records = set()
+    wrote_header = False
+    for maf_file in maf_files:
+        for line, record in read_maf(maf_file):
+            if record is None:
+                # Write header lines of the first MAF only.
+                if maf_output and not wrote_header:
+                    maf_output.write(line)
+                continue
+            if region_index and not region_index.overlaps(record[0], record[1] - 1, record[2]):
+                continue
+            if maf_output:
+                maf_output.write(line)
+            records.add(record)
+        wrote_header = True
+    return records
+
+def get_maf_name(path):
+    """
+    Returns name of a MAF file without directory and .maf extension.
+    """
+    name = os.path.basename(path)
+    return name[:-len('.maf')] if name.endswith('.maf') else name
+
+def write_vcf(records, name, output):
+    """
+    Writes records as a sorted VCF with INFO <name>=TRUE.
+    """
+    output.write('##fileformat=VCFv4.1\n')
+    output.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+    for chrom, start, ref, alt in sorted( set( (r[0], r[1], r[3], r[4]) for r in records ) ):
+        output.write('%s\t%i\t.\t%s\t%s\t.\t.\t%s=TRUE\n' % (chrom, start, ref, alt, name))
+
+def write_annovar(records, output):
+    """
+    Writes records that change the reference as a sorted ANNOVAR annotation file.
+    """
+    for chrom, start, end, ref, alt in sorted(records):
+        if ref != alt:
+            output.write('%s\t%i\t%i\t%s\t%s\tTRUE\n' % (chrom, start, end, ref, alt))
+
+def open_output(path):
+    """
+    Returns file to write output to: standard output if path is '-', otherwise path opened for writing.
+    """
+    return sys.stdout if path == '-' else open(path, 'w')
+
+def close_output(output):
+    """
+    Closes an output file unless it is standard output.
+    """
+    if output is sys.stdout:
+        output.flush()
+    else:
+        output.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Intersect, merge and convert MAF files.')
+    parser.add_argument("mafs", nargs="*", help="MAF files (default: standard input)")
+    parser.add_argument("--bed", help="Keep only records that overlap regions in this BED file")
+    parser.add_argument("--maf", help="Write (intersected) MAF records to this file ('-' for standard output)")
+    parser.add_argument("--vcf", help="Write unique records to this VCF ('-' for standard output)")
+    parser.add_argument("--annovar",
+                        help="Write unique records to this ANNOVAR annotation file ('-' for standard output)")
+    parser.add_argument("--name", help="Annotation name for VCF INFO (default: name of first MAF)")
+    args = parser.parse_args()
+    if [args.maf, args.vcf, args.annovar].count('-') > 1:
+        parser.error("Only one output can be written to standard output")
+
+    maf_files = [ open(path) for path in args.mafs ] or [sys.stdin]
+    region_index = RegionIndex(args.bed) if args.bed else None
+    maf_output = open_output(args.maf) if args.maf else None
+    records = process_mafs(maf_files, region_index, maf_output)
+    if maf_output:
+        close_output(maf_output)
+
+    if args.vcf:
+        name = args.name or (get_maf_name(args.mafs[0]) if args.mafs else 'MAF')
+        output = open_output(args.vcf)
+        write_vcf(records, name, output)
+        close_output(output)
+    if args.annovar:
+        output = open_output(args.annovar)
+        write_annovar(records, output)
+        close_output(output)
@@ -0,0 +1,277 @@
+"""
+Content-hashed cache for pipeline stages.
+
+A stage is a command with input files, output files and parameters. Its key is a hash of the stage name, the
+command, the parameters and the contents of the inputs, so a stage is rerun only when something it depends on has
+changed. On a miss, the command is run and its outputs are stored under <cache_dir>/<stage>/<key>/; on a hit, the
+stored outputs are copied into place and the command is not run. Because outputs of one stage are inputs of the
+next, stages downstream of a change miss and stages upstream of it hit.
+
+File hashes are remembered by path, size and modification time in <cache_dir>/hashes.json so that large inputs
+(e.g. the reference) are hashed once. Each stage run is reported to stderr and logged to <cache_dir>/log.tsv.
+Entries are evicted least recently used first when the cache is larger than --max_bytes, or explicitly with the
+evict command.
+
+Usage:
+    python stage_cache.py --cache_dir <dir> run <stage> --input=<file> [...] --output=<file> [...]
+                          [--param=<param> ...] -- <command> [<arg> ...]
+    python stage_cache.py --cache_dir <dir> report
+    python stage_cache.py --cache_dir <dir> evict [--stage <stage>] [--older_than <days>] [--max_bytes <bytes>]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from collections import OrderedDict, defaultdict
+
+ENTRY_FILE = 'entry.json'
+
+def hash_file(path, block_size=1 << 20):
+    """
+    Returns SHA1 hex digest of a file's contents.
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), ''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def write_json(path, data):
+    """
+    Writes data as JSON to path atomically.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f, indent=1)
+    os.rename(tmp_path, path)
+
+class StageCache(object):
+    """
+    Cache of stage outputs keyed on content hashes of inputs.
+
+    cache_dir - directory for cache entries, file hashes and log
+    max_bytes - maximum total size of cache entries; if None, entries are only evicted explicitly
+    """
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.hashes_path = os.path.join(cache_dir, 'hashes.json')
+        self.log_path = os.path.join(cache_dir, 'log.tsv')
+        self.hashes = {}
+        if os.path.exists(self.hashes_path):
+            with open(self.hashes_path) as f:
+                self.hashes = json.load(f)
+
+    def get_file_hash(self, path):
+        """
+        Returns content hash of a file, hashing it only if it has changed since it was last hashed.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        known = self.hashes.get(path)
+        if known and known[0] == stat.st_size and known[1] == stat.st_mtime:
+            return known[2]
+        file_hash = hash_file(path)
+        self.set_file_hash(path, file_hash)
+        return file_hash
+
+    def set_file_hash(self, path, file_hash):
+        """
+        Records content hash of a file, e.g. one just restored from the cache.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        self.hashes[path] = [stat.st_size, stat.st_mtime, file_hash]
+
+    def save_hashes(self):
+        # Merge with hashes saved by concurrent runs; losing an update only means a file is hashed again.
+        if os.path.exists(self.hashes_path):
+            with open(self.hashes_path) as f:
+                saved = json.load(f)
+            saved.update(self.hashes)
+            self.hashes = saved
+        write_json(self.hashes_path, self.hashes)
+
+    def get_key(self, stage, command, inputs, params):
+        """
+        Returns key for a stage from its name, command, parameters and input contents.
+        """
+        sha1 = hashlib.sha1()
+        sha1.update(json.dumps( [stage, list(command), list(params), [self.get_file_hash(path) for path in inputs]] ))
+        return sha1.hexdigest()
+
+    def _get_entry_dir(self, stage, key):
+        return os.path.join(self.cache_dir, stage, key)
+
+    def restore(self, stage, key, outputs):
+        """
+        Copies stored outputs of a stage into place. Returns True if there is a complete entry for key.
+        """
+        entry_dir = self._get_entry_dir(stage, key)
+        entry_path = os.path.join(entry_dir, ENTRY_FILE)
+        if not os.path.exists(entry_path):
+            return False
+        with open(entry_path) as f:
+            entry = json.load(f)
+        if len(entry['outputs']) != len(outputs):
+            return False
+        for i, (output, output_hash) in enumerate( zip(outputs, entry['output_hashes']) ):
+            shutil.copyfile(os.path.join(entry_dir, str(i)), output)
+            self.set_file_hash(output, output_hash)
+        os.utime(entry_path, None)
+        return True
+
+    def store(self, stage, key, inputs, outputs, params):
+        """
+        Stores outputs of a stage under key. The entry is written to a temporary directory and renamed so that
+        concurrent runs never see a partial entry.
+        """
+        stage_dir = os.path.join(self.cache_dir, stage)
+        if not os.path.exists(stage_dir):
+            os.makedirs(stage_dir)
+        tmp_dir = tempfile.mkdtemp(dir=stage_dir, prefix='.tmp')
+        output_hashes = []
+        for i, output in enumerate(outputs):
+            shutil.copyfile(output, os.path.join(tmp_dir, str(i)))
+            output_hashes.append(self.get_file_hash(output))
+        entry = OrderedDict([ ('stage', stage), ('key', key), ('created', time.time()),
+                              ('inputs', [os.path.abspath(path) for path in inputs]), ('params', list(params)),
+                              ('outputs', [os.path.abspath(path) for path in outputs]),
+                              ('output_hashes', output_hashes) ])
+        write_json(os.path.join(tmp_dir, ENTRY_FILE), entry)
+        try:
+            os.rename(tmp_dir, self._get_entry_dir(stage, key))
+        except OSError:
+            # Another run stored the same entry first.
+            shutil.rmtree(tmp_dir)
+
+    def run(self, stage, command, inputs, outputs, params=()):
+        """
+        Runs a stage unless its outputs are cached. Returns (status, exit code), where status is 'hit' or 'miss'.
+        """
+        start = time.time()
+        key = self.get_key(stage, command, inputs, params)
+        if self.restore(stage, key, outputs):
+            status, returncode = 'hit', 0
+        else:
+            status = 'miss'
+            returncode = subprocess.call(command)
+            missing = [output for output in outputs if not os.path.exists(output)]
+            if returncode == 0 and missing:
+                sys.stderr.write("Error: stage %s did not create %s\n" % (stage, ', '.join(missing)))
+                returncode = 1
+            if returncode == 0:
+                self.store(stage, key, inputs, outputs, params)
+                if self.max_bytes is not None:
+                    self.evict(max_bytes=self.max_bytes)
+        self.save_hashes()
+
+        seconds = time.time() - start
+        sys.stderr.write( "stage_cache\t%s\t%s\t%s\t%.1fs\n" % (stage, status, key[:12], seconds) )
+        with open(self.log_path, 'a') as log:
+            log.write( "%f\t%s\t%s\t%s\t%i\t%f\n" % (start, stage, status, key, returncode, seconds) )
+        return status, returncode
+
+    def get_entries(self):
+        """
+        Returns list of (last used, size, stage, entry directory) for all cache entries.
+        """
+        entries = []
+        for stage in os.listdir(self.cache_dir):
+            stage_dir = os.path.join(self.cache_dir, stage)
+            if not os.path.isdir(stage_dir):
+                continue
+            for key in os.listdir(stage_dir):
+                entry_dir = os.path.join(stage_dir, key)
+                entry_path = os.path.join(entry_dir, ENTRY_FILE)
+                if key.startswith('.') or not os.path.exists(entry_path):
+                    continue
+                size = sum( os.path.getsize(os.path.join(entry_dir, name)) for name in os.listdir(entry_dir) )
+                entries.append( (os.path.getmtime(entry_path), size, stage, entry_dir) )
+        return entries
+
+    def evict(self, stage=None, older_than=None, max_bytes=None):
+        """
+        Removes entries for a stage (all stages if None), entries last used more than older_than days ago and,
+        least recently used first, entries until the cache is no larger than max_bytes. Returns number of entries
+        removed.
+        """
+        removed = 0
+        kept = []
+        now = time.time()
+        for last_used, size, entry_stage, entry_dir in sorted( self.get_entries() ):
+            if (stage is not None and entry_stage == stage) or \
+               (older_than is not None and now - last_used > older_than * 86400):
+                shutil.rmtree(entry_dir)
+                removed += 1
+            else:
+                kept.append( (size, entry_dir) )
+        if max_bytes is not None:
+            total = sum(size for size, entry_dir in kept)
+            for size, entry_dir in kept:
+                if total <= max_bytes:
+                    break
+                shutil.rmtree(entry_dir)
+                total -= size
+                removed += 1
+        return removed
+
+    def get_report(self):
+        """
+        Returns list of (stage, hits, misses, entries, bytes) for stages in the log or the cache.
+        """
+        counts = defaultdict(lambda: [0, 0, 0, 0])
+        if os.path.exists(self.log_path):
+            for line in open(self.log_path):
+                fields = line.rstrip('\n').split('\t')
+                counts[fields[1]][0 if fields[2] == 'hit' else 1] += 1
+        for last_used, size, stage, entry_dir in self.get_entries():
+            counts[stage][2] += 1
+            counts[stage][3] += size
+        return [ tuple([stage] + counts[stage]) for stage in sorted(counts) ]
+
+if __name__ == "__main__":
+    # Command for run follows '--'.
+    argv = sys.argv[1:]
+    command = []
+    if '--' in argv:
+        command = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+
+    parser = argparse.ArgumentParser(description='Run pipeline stages with a content-hashed cache.')
+    parser.add_argument("--cache_dir", required=True, help="Cache directory")
+    parser.add_argument("--max_bytes", type=int, help="Evict least recently used entries above this total size")
+    parser.add_argument("operation", choices=['run', 'report', 'evict'], help="Operation to perform")
+    parser.add_argument("stage", nargs="?", help="Stage name (run)")
+    parser.add_argument("--input", dest="inputs", action="append", default=[],
+                        help="Input file of stage; repeat for each file")
+    parser.add_argument("--output", dest="outputs", action="append", default=[],
+                        help="Output file of stage; repeat for each file")
+    parser.add_argument("--param", dest="params", action="append", default=[],
+                        help="Parameter of stage, e.g. a tool version; repeat for each parameter")
+    parser.add_argument("--stage", dest="evict_stage", help="Evict all entries for this stage")
+    parser.add_argument("--older_than", type=float, help="Evict entries last used more than this many days ago")
+    args = parser.parse_args(argv)
+
+    cache = StageCache(args.cache_dir, args.max_bytes)
+    if args.operation == 'run':
+        if not args.stage or not command:
+            parser.error("run requires a stage and a command after '--'")
+        status, returncode = cache.run(args.stage, command, args.inputs, args.outputs, args.params)
+        sys.exit(returncode)
+    elif args.operation == 'report':
+        print '\t'.join(['stage', 'hits', 'misses', 'entries', 'bytes'])
+        for row in cache.get_report():
+            print '\t'.join(str(value) for value in row)
+    elif args.operation == 'evict':
+        removed = cache.evict(args.evict_stage, args.older_than, args.max_bytes)
+        sys.stderr.write("%i entries evicted\n" % removed)
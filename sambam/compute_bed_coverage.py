@@ -0,0 +1,232 @@
+"""
+Compute mean0, min and max read coverage over BED regions for a set of BAMs.
+
+This gives the same values as bigWigAverageOverBed -minMax on a genome-wide bigWig made with 'bedtools genomecov
+-bg -split' (compute_bam_coverage.sh), but only depths in the BED regions are read: from 'samtools depth', which is
+run for each BAM, or from a bedGraph. As with a bigWig made from a bedGraph, mean0 counts uncovered bases as 0 and
+min/max are over covered bases only (0 if no base is covered).
+
+samtools depth filters reads differently from genomecov by default, so it is run with options that match
+genomecov -split: only unmapped reads are excluded (-G UNMAP; secondary, QC-fail and duplicate reads are counted),
+there are no mapping or base quality thresholds (-Q 0 -q 0), and deletions are counted as covered (-J) while
+reference skips (N) are not. These options need samtools 1.13 or later, which also has no maximum depth. With
+--check, coverage is also computed from 'bedtools genomecov -bg -split' and regions where the two differ are
+reported.
+
+Output is the all_coverage.tabular matrix: a Region column with columns 4-6 of the BED, then <sample>_mean0,
+<sample>_min and <sample>_max columns for each input, where sample is the input file name up to the first '.'.
+
+Usage:
+    python compute_bed_coverage.py <regions.bed> <input.bam> [<input.bam> ...] > all_coverage.tabular
+    python compute_bed_coverage.py --bedgraph <regions.bed> <coverage.bedgraph> [...] > all_coverage.tabular
+    python compute_bed_coverage.py --check <regions.bed> <input.bam> [...] > all_coverage.tabular
+"""
+
+import argparse
+import bisect
+import multiprocessing
+import os
+import subprocess
+import sys
+
+import numpy
+
+from collections import defaultdict
+
+# samtools depth options that count reads as 'bedtools genomecov -split' does.
+SAMTOOLS_DEPTH_OPTIONS = ['-G', 'UNMAP', '-Q', '0', '-q', '0', '-J']
+
+def read_regions(bed_file):
+    """
+    Returns list of (chrom, start, end, fields) for regions in a BED file.
+    """
+    regions = []
+    for line in open(bed_file):
+        if line.startswith(('#', 'track', 'browser')) or not line.strip():
+            continue
+        fields = line.rstrip('\r\n').split('\t')
+        regions.append( (fields[0], int(fields[1]), int(fields[2]), fields) )
+    return regions
+
+def merge_regions(regions):
+    """
+    Returns dictionary of chrom to sorted list of merged [start, end) intervals for regions.
+    """
+    by_chrom = defaultdict(list)
+    for chrom, start, end, fields in regions:
+        by_chrom[chrom].append( (start, end) )
+    merged = {}
+    for chrom, intervals in by_chrom.items():
+        intervals.sort()
+        merged[chrom] = [ list(intervals[0]) ]
+        for start, end in intervals[1:]:
+            if start <= merged[chrom][-1][1]:
+                merged[chrom][-1][1] = max(merged[chrom][-1][1], end)
+            else:
+                merged[chrom].append( [start, end] )
+    return merged
+
+def read_samtools_depth(lines):
+    """
+    Yields (chrom, 0-based position, depth) for covered bases in 'samtools depth' output.
+    """
+    for line in lines:
+        chrom, pos, depth = line.split('\t')[:3]
+        depth = int(depth)
+        if depth > 0:
+            yield (chrom, int(pos) - 1, depth)
+
+def read_bedgraph(lines, merged):
+    """
+    Yields (chrom, 0-based position, depth) for covered bases in a bedGraph that are in merged regions.
+    """
+    for line in lines:
+        if line.startswith(('#', 'track', 'browser')):
+            continue
+        chrom, start, end, value = line.split('\t')[:4]
+        value = float(value)
+        if value <= 0 or chrom not in merged:
+            continue
+        start, end = int(start), int(end)
+        intervals = merged[chrom]
+        i = max(0, bisect.bisect_right(intervals, [start]) - 1)
+        while i < len(intervals) and intervals[i][0] < end:
+            for pos in xrange( max(start, intervals[i][0]), min(end, intervals[i][1]) ):
+                yield (chrom, pos, value)
+            i += 1
+
+def get_depth_arrays(depths):
+    """
+    Returns dictionary of chrom to (sorted positions, depths) arrays for (chrom, position, depth) tuples.
+    """
+    positions = defaultdict(list)
+    values = defaultdict(list)
+    for chrom, pos, depth in depths:
+        positions[chrom].append(pos)
+        values[chrom].append(depth)
+    arrays = {}
+    for chrom in positions:
+        chrom_positions = numpy.array(positions[chrom], dtype=numpy.int64)
+        order = numpy.argsort(chrom_positions, kind='mergesort')
+        chrom_positions = chrom_positions[order]
+        chrom_values = numpy.array(values[chrom], dtype=numpy.float64)[order]
+
+        # Positions in overlapping regions may be reported more than once.
+        unique = numpy.concatenate( ([True], chrom_positions[1:] != chrom_positions[:-1]) )
+        arrays[chrom] = ( chrom_positions[unique], chrom_values[unique] )
+    return arrays
+
+def get_region_coverage(regions, depth_arrays):
+    """
+    Returns (mean0, min, max) arrays of coverage for regions. Sums come from cumulative sums of depths and
+    min/max from reductions over each region's slice of covered positions.
+    """
+    mean0 = numpy.zeros(len(regions))
+    mins = numpy.zeros(len(regions))
+    maxs = numpy.zeros(len(regions))
+    by_chrom = defaultdict(list)
+    for i, (chrom, start, end, fields) in enumerate(regions):
+        by_chrom[chrom].append(i)
+
+    for chrom, indices in by_chrom.items():
+        if chrom not in depth_arrays:
+            continue
+        positions, values = depth_arrays[chrom]
+        indices = numpy.array(indices)
+        starts = numpy.array([regions[i][1] for i in indices])
+        ends = numpy.array([regions[i][2] for i in indices])
+        lo = numpy.searchsorted(positions, starts, side='left')
+        hi = numpy.searchsorted(positions, ends, side='left')
+        cumsum = numpy.concatenate( ([0], numpy.cumsum(values)) )
+        sizes = ends - starts
+        mean0[indices] = numpy.where(sizes > 0, (cumsum[hi] - cumsum[lo]) / numpy.maximum(sizes, 1), 0)
+
+        # Reduce over [lo, hi) slices; a sentinel value keeps hi in bounds and empty slices are ignored.
+        covered = hi > lo
+        if covered.any():
+            bounds = numpy.column_stack( (lo[covered], hi[covered]) ).ravel()
+            padded = numpy.append(values, 0)
+            mins[indices[covered]] = numpy.minimum.reduceat(padded, bounds)[::2]
+            maxs[indices[covered]] = numpy.maximum.reduceat(padded, bounds)[::2]
+    return mean0, mins, maxs
+
+def get_sample_name(path):
+    """
+    Returns sample name for an input file, i.e. its name up to the first '.'.
+    """
+    return os.path.basename(path).split('.')[0]
+
+def get_bedgraph_coverage(bed_file, path):
+    """
+    Returns (mean0, min, max) coverage arrays over BED regions for a BAM using 'bedtools genomecov -bg -split'.
+    """
+    regions = read_regions(bed_file)
+    genomecov = subprocess.Popen(['bedtools', 'genomecov', '-bg', '-split', '-ibam', path], stdout=subprocess.PIPE)
+    depth_arrays = get_depth_arrays( read_bedgraph(genomecov.stdout, merge_regions(regions)) )
+    if genomecov.wait() != 0:
+        raise RuntimeError("bedtools genomecov failed for %s" % path)
+    return get_region_coverage(regions, depth_arrays)
+
+def compute_coverage(args):
+    """
+    Returns sample name, (mean0, min, max) coverage arrays over BED regions for a BAM or bedGraph, and, if check is
+    set, indices of regions where coverage differs from 'bedtools genomecov -bg -split'.
+    """
+    bed_file, path, bedgraph, check = args
+    regions = read_regions(bed_file)
+    if bedgraph:
+        depths = read_bedgraph(open(path), merge_regions(regions))
+        depth_arrays = get_depth_arrays(depths)
+    else:
+        samtools = subprocess.Popen(['samtools', 'depth'] + SAMTOOLS_DEPTH_OPTIONS + ['-b', bed_file, path],
+                                    stdout=subprocess.PIPE)
+        depth_arrays = get_depth_arrays( read_samtools_depth(samtools.stdout) )
+        if samtools.wait() != 0:
+            raise RuntimeError("samtools depth failed for %s" % path)
+    coverage = get_region_coverage(regions, depth_arrays)
+
+    differences = []
+    if check and not bedgraph:
+        expected = get_bedgraph_coverage(bed_file, path)
+        differs = numpy.zeros(len(regions), dtype=bool)
+        for values, expected_values in zip(coverage, expected):
+            differs |= ~numpy.isclose(values, expected_values)
+        differences = list(numpy.nonzero(differs)[0])
+    return get_sample_name(path), coverage, differences
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compute mean0, min and max coverage over BED regions.')
+    parser.add_argument("bed", help="BED file of regions")
+    parser.add_argument("inputs", nargs="+", help="BAMs, or bedGraphs with --bedgraph")
+    parser.add_argument("--bedgraph", action="store_true", help="Inputs are bedGraphs rather than BAMs")
+    parser.add_argument("--check", action="store_true",
+                        help="Also compute coverage of BAMs with bedtools genomecov -split and report differences")
+    parser.add_argument("--processes", type=int, default=4, help="Number of inputs to process in parallel")
+    args = parser.parse_args()
+
+    tasks = [ (args.bed, path, args.bedgraph, args.check) for path in args.inputs ]
+    if args.processes > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool( min(args.processes, len(tasks)) )
+        results = pool.map(compute_coverage, tasks, chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        results = [ compute_coverage(task) for task in tasks ]
+
+    # Report regions where coverage differs from genomecov.
+    regions = read_regions(args.bed)
+    for sample, coverage, differences in results:
+        for i in differences:
+            sys.stderr.write( "Warning: coverage of %s in %s:%i-%i differs from bedtools genomecov\n" %
+                              (sample, regions[i][0], regions[i][1], regions[i][2]) )
+
+    # Print matrix.
+    header = ['Region']
+    for sample, coverage, differences in results:
+        header += [ sample + '_mean0', sample + '_min', sample + '_max' ]
+    print '\t'.join(header)
+    for i, (chrom, start, end, fields) in enumerate(regions):
+        row = fields[3:6]
+        for sample, (mean0, mins, maxs), differences in results:
+            row += [ '%g' % mean0[i], '%g' % mins[i], '%g' % maxs[i] ]
+        print '\t'.join(row)
@@ -0,0 +1,196 @@
+"""
+Allele frequency (AF) lookup in per-sample VCFs.
+
+Each VCF (plain, gzip'ed or bgzip'ed, e.g. from bgzip_and_tabix.sh) is read when one of its samples is first looked
+up into an in-memory index of numpy arrays of positions, alt ids and AFs per block of positions for all of its
+samples. Only the most recently used indexes are kept in memory. Tabix indexes are not used. AF is
+read from the sample's FORMAT field if present and otherwise from INFO; for multi-allelic records, the value for the
+queried allele is used.
+"""
+
+import gzip
+
+import numpy
+
+from collections import defaultdict, OrderedDict
+
+def get_vcf_samples(path):
+    """
+    Returns sample names in the header of a VCF (plain or gzip'ed).
+    """
+    vcf_file = gzip.open(path) if path.endswith('.gz') else open(path)
+    try:
+        for line in vcf_file:
+            if line.startswith('#CHROM'):
+                return line.rstrip('\r\n').split('\t')[9:]
+            if not line.startswith('#'):
+                break
+    finally:
+        vcf_file.close()
+    return []
+
+def get_sample_files(paths):
+    """
+    Returns dictionary of sample name to VCF for VCFs; each VCF is used for all samples in its header. Raises
+    ValueError if a sample is in more than one VCF, as its AFs would otherwise come from whichever was listed last.
+    """
+    sample_files = {}
+    for path in paths:
+        for sample in get_vcf_samples(path):
+            if sample in sample_files and sample_files[sample] != path:
+                raise ValueError("Sample %s is in both %s and %s" % (sample, sample_files[sample], path))
+            sample_files[sample] = path
+    return sample_files
+
+def get_record_afs(fields, sample_col, af_field):
+    """
+    Returns list of (alt, AF) for a VCF record, or an empty list if it has no AF.
+    """
+    alts = fields[4].split(',')
+    values = None
+    if len(fields) > sample_col:
+        format_keys = fields[8].split(':')
+        if af_field in format_keys:
+            sample_values = fields[sample_col].split(':')
+            idx = format_keys.index(af_field)
+            if idx < len(sample_values):
+                values = sample_values[idx].split(',')
+    if values is None:
+        for entry in fields[7].split(';'):
+            if entry.startswith(af_field + '='):
+                values = entry[len(af_field) + 1:].split(',')
+                break
+    if values is None:
+        return []
+
+    afs = []
+    for i, alt in enumerate(alts):
+        value = values[i] if i < len(values) else values[0]
+        try:
+            afs.append( (alt, float(value)) )
+        except ValueError:
+            pass
+    return afs
+
+class AFLookup(object):
+    """
+    Lookup of (sample, chrom, pos, alt) -> AF, with 1-based positions, for samples in per-sample VCFs.
+
+    block_size - number of positions in a block of the index
+    max_files - maximum number of VCF indexes held in memory; the least recently used is evicted beyond this
+    """
+    def __init__(self, sample_files, af_field='AF', block_size=100000, max_files=8):
+        self.sample_files = dict(sample_files)
+        self.af_field = af_field
+        self.block_size = block_size
+        self.max_files = max_files
+        self.indexes = OrderedDict()
+        self.alt_ids = {}
+
+    def _get_alt_id(self, alt):
+        """
+        Returns integer id of an alt allele, shared by all indexes.
+        """
+        return self.alt_ids.setdefault(alt, len(self.alt_ids))
+
+    def _build_index(self, path):
+        """
+        Returns (dictionary of sample to column, dictionary of (chrom, block) to (positions, alt ids, AFs)) for all
+        records in a VCF and all of its samples that are looked up. Positions and alt ids are numpy arrays with one
+        entry per (record, alt) sorted by position; AFs is a numpy array of entries by sample column, with NaN where
+        a sample has no AF.
+        """
+        samples = get_vcf_samples(path)
+        sample_cols = [ (sample, 9 + i) for i, sample in enumerate(samples) if self.sample_files.get(sample) == path ]
+        entries = defaultdict(lambda: ( [], [], [] ))
+        vcf_file = gzip.open(path) if path.endswith('.gz') else open(path)
+        for line in vcf_file:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\r\n').split('\t')
+            pos = int(fields[1])
+            alts = fields[4].split(',')
+            alt_afs = None
+            for i, (sample, sample_col) in enumerate(sample_cols):
+                for alt, af in get_record_afs(fields, sample_col, self.af_field):
+                    if alt_afs is None:
+                        alt_afs = [ [numpy.nan] * len(sample_cols) for record_alt in alts ]
+                    alt_afs[alts.index(alt)][i] = af
+            if alt_afs is None:
+                continue
+            positions, alt_ids, afs = entries[ (fields[0], (pos - 1) // self.block_size) ]
+            for alt, sample_afs in zip(alts, alt_afs):
+                positions.append(pos)
+                alt_ids.append(self._get_alt_id(alt))
+                afs.append(sample_afs)
+        vcf_file.close()
+
+        index = {}
+        for key, (positions, alt_ids, afs) in entries.items():
+            positions = numpy.array(positions, dtype=numpy.int64)
+            order = numpy.argsort(positions, kind='mergesort')
+            index[key] = ( positions[order], numpy.array(alt_ids, dtype=numpy.int32)[order],
+                           numpy.array(afs, dtype=numpy.float64).reshape(len(positions), len(sample_cols))[order] )
+        return dict( (sample, i) for i, (sample, sample_col) in enumerate(sample_cols) ), index
+
+    def _get_index(self, path):
+        """
+        Returns index of a VCF, building it if it is not in memory and evicting least recently used indexes.
+        """
+        if path in self.indexes:
+            index = self.indexes.pop(path)
+        else:
+            index = self._build_index(path)
+            while self.indexes and len(self.indexes) >= self.max_files:
+                self.indexes.popitem(last=False)
+        self.indexes[path] = index
+        return index
+
+    def _get_block_af(self, block, j, pos, alt, col):
+        """
+        Returns AF of an allele at a position in a column of a block, starting at entry j, the first entry at or after
+        the position, or None if the allele is not found.
+        """
+        positions, alt_ids, afs = block
+        alt_id = self.alt_ids.get(alt)
+        while j < len(positions) and positions[j] == pos:
+            if alt_ids[j] == alt_id and afs[j, col] == afs[j, col]:
+                return float(afs[j, col])
+            j += 1
+        return None
+
+    def get_af(self, sample, chrom, pos, alt):
+        """
+        Returns AF of an allele in a sample, or None if the sample has no file or the allele is not found.
+        """
+        path = self.sample_files.get(sample)
+        if path is None:
+            return None
+        sample_idx, index = self._get_index(path)
+        block = index.get( (chrom, (pos - 1) // self.block_size) )
+        if block is None:
+            return None
+        return self._get_block_af(block, block[0].searchsorted(pos), pos, alt, sample_idx[sample])
+
+    def get_afs(self, queries):
+        """
+        Returns list of AFs (or None) for a batch of (sample, chrom, pos, alt) queries. Queries are answered by VCF
+        and block, so each VCF is indexed once and each block is searched once for all of its positions.
+        """
+        afs = [None] * len(queries)
+        blocks = defaultdict(list)
+        for i, (sample, chrom, pos, alt) in enumerate(queries):
+            path = self.sample_files.get(sample)
+            if path is not None:
+                blocks[ (path, chrom, (pos - 1) // self.block_size) ].append(i)
+        for path, chrom, block_id in sorted(blocks):
+            sample_idx, index = self._get_index(path)
+            block = index.get( (chrom, block_id) )
+            if block is None:
+                continue
+            query_ids = blocks[ (path, chrom, block_id) ]
+            starts = block[0].searchsorted( [queries[i][2] for i in query_ids] )
+            for i, j in zip(query_ids, starts):
+                sample, chrom, pos, alt = queries[i]
+                afs[i] = self._get_block_af(block, j, pos, alt, sample_idx[sample])
+        return afs
@@ -0,0 +1,190 @@
+"""
+Add boolean annotations from many VCFs to a GEMINI database in a single pass.
+
+This is equivalent to running 'gemini annotate -a boolean -c <name> -f <name>.vcf.gz' for each annotation VCF:
+a variant is annotated (1) if an annotation record overlaps it and has the same reference allele and a shared
+alternate allele (or '.' as its alternate); otherwise it is not (0). Rather than one read-modify-write pass over
+the variants table per annotation, all annotation VCFs are loaded into one sorted position index and the variants
+table is read and updated once, in a single transaction.
+
+Usage:
+    python annotate_gemini_db.py <gemini_db> <annotation.vcf.gz> [<annotation.vcf.gz> ...]
+    python annotate_gemini_db.py --annotations_dir <annotations_dir> <gemini_db>
+"""
+
+import argparse
+import bisect
+import glob
+import gzip
+import os
+import sqlite3
+import sys
+
+from collections import defaultdict
+
+def get_annotation_name(path):
+    """
+    Returns annotation (column) name for an annotation VCF, i.e. its name without .vcf/.vcf.gz
+    """
+    name = os.path.basename(path)
+    for ext in ['.gz', '.vcf']:
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    return name
+
+def get_annotation_files(annotations_dir):
+    """
+    Returns annotation VCFs in subdirectories of a directory, i.e. <annotations_dir>/*/*.vcf.gz
+    """
+    return sorted( glob.glob(os.path.join(annotations_dir, '*', '*.vcf.gz')) )
+
+def get_canonical_chrom(chrom):
+    """
+    Returns chromosome name without 'chr' prefix so that UCSC and GRCh37 names match.
+    """
+    if chrom == 'chrM':
+        return 'MT'
+    return chrom[3:] if chrom.startswith('chr') else chrom
+
+class AnnotationIndex(object):
+    """
+    Sorted position index of records from many annotation VCFs. Each record has a bit for the annotation it
+    came from so that all annotations for a variant can be found with one lookup.
+    """
+    def __init__(self):
+        self.names = []
+        self.records = defaultdict(list)
+        self.starts = {}
+        self.max_lengths = {}
+
+    def add_vcf(self, path, name=None):
+        """
+        Adds records from an annotation VCF (plain or bgzip'ed) to the index.
+        """
+        bit = 1 << len(self.names)
+        self.names.append(name or get_annotation_name(path))
+        vcf_file = gzip.open(path) if path.endswith('.gz') else open(path)
+        for line in vcf_file:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\r\n').split('\t', 5)
+            start = int(fields[1]) - 1
+            ref = fields[3]
+            self.records[get_canonical_chrom(fields[0])].append( (start, start + len(ref), ref,
+                                                                   frozenset(fields[4].split(',')), bit) )
+        vcf_file.close()
+        self.starts = {}
+
+    def build(self):
+        """
+        Sorts records; must be called after adding VCFs and before lookups.
+        """
+        for chrom, records in self.records.items():
+            records.sort()
+            self.starts[chrom] = [record[0] for record in records]
+            self.max_lengths[chrom] = max(record[1] - record[0] for record in records)
+
+    def get_mask(self, chrom, start, end, ref, alt, region_only=False):
+        """
+        Returns bitmask of annotations that a variant matches.
+        """
+        chrom = get_canonical_chrom(chrom)
+        if chrom not in self.starts:
+            return 0
+
+        # Find records that overlap variant.
+        starts = self.starts[chrom]
+        records = self.records[chrom]
+        alts = set(alt.split(','))
+        mask = 0
+        for i in xrange( bisect.bisect_right(starts, start - self.max_lengths[chrom]),
+                         bisect.bisect_left(starts, end) ):
+            record_start, record_end, record_ref, record_alts, bit = records[i]
+            if record_end <= start:
+                continue
+            if region_only or ( record_ref == ref and (alts & record_alts or record_alts == frozenset('.')) ):
+                mask |= bit
+        return mask
+
+def add_annotation_columns(conn, names):
+    """
+    Adds boolean annotation columns to variants table, resetting values of columns that already exist.
+    """
+    existing = set( row[1] for row in conn.execute("pragma table_info(variants)") )
+    for name in names:
+        if name in existing:
+            sys.stderr.write("WARNING: Column \"(%s)\" already exists in variants table. Overwriting values.\n" % name)
+        else:
+            conn.execute('ALTER TABLE variants ADD COLUMN "%s" integer DEFAULT NULL' % name)
+
+def get_annotation_index(annotation_files):
+    """
+    Returns built AnnotationIndex for annotation files.
+    """
+    index = AnnotationIndex()
+    for path in annotation_files:
+        index.add_vcf(path)
+    index.build()
+    return index
+
+def annotate_gemini_db(gemini_db, annotation_files, region_only=False, chunk_size=100000):
+    """
+    Annotates a GEMINI database with boolean columns for all annotation files in a single pass over the variants
+    table. Returns dictionary of annotation name to number of annotated variants.
+    """
+    return annotate_gemini_db_with_index(gemini_db, get_annotation_index(annotation_files), region_only, chunk_size)
+
+def annotate_gemini_db_with_index(gemini_db, index, region_only=False, chunk_size=100000):
+    """
+    Annotates a GEMINI database using an AnnotationIndex, so that an index can be loaded once for many databases.
+    Returns dictionary of annotation name to number of annotated variants.
+    """
+    names = index.names
+    bits = [1 << i for i in range(len(names))]
+
+    conn = sqlite3.connect(gemini_db)
+    conn.isolation_level = None
+    conn.execute("BEGIN TRANSACTION")
+    add_annotation_columns(conn, names)
+
+    # Read and update variants in chunks of variant ids so that reads and updates do not overlap.
+    update_query = 'UPDATE variants SET %s WHERE variant_id = ?' % ", ".join('"%s" = ?' % name for name in names)
+    counts = [0] * len(names)
+    last_id = -1
+    while True:
+        rows = conn.execute("SELECT variant_id, chrom, start, end, ref, alt FROM variants WHERE variant_id > ? "
+                            "ORDER BY variant_id LIMIT ?", (last_id, chunk_size)).fetchall()
+        if not rows:
+            break
+        updates = []
+        for variant_id, chrom, start, end, ref, alt in rows:
+            mask = index.get_mask(chrom, start, end, ref, alt, region_only)
+            values = [1 if mask & bit else 0 for bit in bits]
+            for i, value in enumerate(values):
+                counts[i] += value
+            updates.append(values + [variant_id])
+        conn.executemany(update_query, updates)
+        last_id = rows[-1][0]
+
+    conn.execute("COMMIT")
+    conn.close()
+    return dict(zip(names, counts))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Add boolean annotations from VCFs to a GEMINI database.')
+    parser.add_argument("gemini_db", help="Gemini database to annotate")
+    parser.add_argument("annotation_files", nargs="*", help="Annotation VCFs (bgzip'ed or plain)")
+    parser.add_argument("--annotations_dir", help="Use all <annotations_dir>/*/*.vcf.gz annotation VCFs")
+    parser.add_argument("--region_only", action="store_true", help="Match by region only, not ref and alt")
+    args = parser.parse_args()
+
+    annotation_files = list(args.annotation_files)
+    if args.annotations_dir:
+        annotation_files += get_annotation_files(args.annotations_dir)
+    if not annotation_files:
+        parser.error("no annotation files given")
+
+    counts = annotate_gemini_db(args.gemini_db, annotation_files, args.region_only)
+    for path in annotation_files:
+        name = get_annotation_name(path)
+        print "annotated", counts[name], "variants with", name
@@ -18,14 +18,5 @@ source ${HOME_DIR}/settings.sh
 GEMINI_DB=$1
 ANNOTATIONS_DIR=${2:-${SHARED_ANNOTATIONS_DIR}}
 
-# Annotate.
-for d in ${ANNOTATIONS_DIR}/*/ ; do
-	for f in $d/*.vcf.gz ; do
-		ANNO=$(basename "$f" .vcf.gz)
-		gemini annotate \
-			-f $f \
-			-a boolean \
-			-c ${ANNO} \
-			${GEMINI_DB}
-	done
-done
+# Annotate with all annotation sets in a single pass.
+python ${HOME_DIR}/annotate_gemini_db.py --annotations_dir ${ANNOTATIONS_DIR} ${GEMINI_DB}
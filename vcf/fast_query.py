@@ -0,0 +1,310 @@
+"""
+Fast-path GEMINI queries that evaluate genotype filters with NumPy.
+
+Variants are read directly from a GEMINI SQLite database. gt_types blobs are decoded in batches into a
+(variants x samples) int8 array and gt_filter strings are compiled into functions that compute a boolean mask
+over that array, rather than being eval'ed for each row. The gt_filter grammar used by gemini_operations is
+supported:
+
+    gt_types.<sample> <op> <genotype>
+    (gt_types).(<sample wildcard>).(<op> <genotype>).(all|any|none|count <op> <n>)
+
+combined with and, or, not, and parentheses. Anything else raises ValueError so that callers can fall back
+to GeminiQuery.
+"""
+
+import operator
+import re
+import sqlite3
+
+from collections import Counter, OrderedDict
+
+import numpy
+
+from gemini import GeminiQuery
+from gemini.compression import unpack_genotype_blob
+from gemini.gemini_constants import HOM_REF, HET, UNKNOWN, HOM_ALT
+
+GENOTYPES = { 'HOM_REF': HOM_REF, 'HET': HET, 'UNKNOWN': UNKNOWN, 'HOM_ALT': HOM_ALT }
+OPERATORS = { '==': operator.eq, '!=': operator.ne, '>=': operator.ge, '<=': operator.le,
+              '>': operator.gt, '<': operator.lt }
+
+# Wildcard filters, e.g. (gt_types).(*).(==HET).(count > 1)
+WILDCARD_RE = re.compile(r'\(\s*(gt\w*)\s*\)\.\((.+?)\)\.\((.+?)\)\.\((.+?)\)')
+TOKEN_RE = re.compile(r'\s*(?:(@\d+)|(gt\w*\.[^\s()=!<>]+)|(==|!=|>=|<=|>|<)|([()])|(\w+))')
+RULE_RE = re.compile(r'^\s*(==|!=|>=|<=|>|<)\s*(\w+)\s*$')
+COUNT_RE = re.compile(r'^\s*count\s*(==|!=|>=|<=|>|<)\s*(\d+)\s*$')
+
+class FastRow(OrderedDict):
+    """
+    Query result; prints like a GEMINI row in the default format.
+    """
+    def __str__(self):
+        return '\t'.join(str(v) for v in self.itervalues())
+
+def get_genotype_value(token):
+    """
+    Returns integer value for a genotype name (e.g. HET) or number.
+    """
+    if token.upper() in GENOTYPES:
+        return GENOTYPES[token.upper()]
+    if token.isdigit():
+        return int(token)
+    raise ValueError("Unsupported genotype value: %s" % token)
+
+def get_sample_to_idx(conn):
+    """
+    Returns dictionary mapping sample names to genotype array indices.
+    """
+    return dict( (str(name), sample_id - 1) for sample_id, name in conn.execute("SELECT sample_id, name FROM samples") )
+
+def get_wildcard_samples(conn, wildcard):
+    """
+    Returns list of genotype array indices for samples matching a wildcard.
+    """
+    query = "SELECT sample_id FROM samples"
+    if wildcard.strip() != '*':
+        query += " WHERE %s" % wildcard
+    return [sample_id - 1 for (sample_id,) in conn.execute(query)]
+
+def compile_wildcard(conn, column, wildcard, rule, op):
+    """
+    Returns mask function for a wildcard filter.
+    """
+    if column != 'gt_types':
+        raise ValueError("Unsupported wildcard column: %s" % column)
+    rule_match = RULE_RE.match(rule)
+    if not rule_match:
+        raise ValueError("Unsupported wildcard rule: %s" % rule)
+    rule_op = OPERATORS[rule_match.group(1)]
+    rule_value = get_genotype_value(rule_match.group(2))
+    indices = numpy.array(get_wildcard_samples(conn, wildcard), dtype=numpy.intp)
+
+    def matches(gt_types):
+        return rule_op(gt_types[:, indices], rule_value)
+
+    op = op.strip()
+    count_match = COUNT_RE.match(op)
+    if op == 'all':
+        return lambda gt_types: matches(gt_types).all(axis=1)
+    elif op == 'any':
+        return lambda gt_types: matches(gt_types).any(axis=1)
+    elif op == 'none':
+        return lambda gt_types: ~matches(gt_types).any(axis=1)
+    elif count_match:
+        count_op = OPERATORS[count_match.group(1)]
+        count = int(count_match.group(2))
+        return lambda gt_types: count_op(matches(gt_types).sum(axis=1), count)
+    raise ValueError("Unsupported wildcard operation: %s" % op)
+
+def tokenize_gt_filter(gt_filter):
+    """
+    Returns a tuple of <tokens> <wildcards>; wildcards are replaced by @<index> tokens.
+    """
+    wildcards = []
+    def replace_wildcard(match):
+        wildcards.append(match.groups())
+        return ' @%i ' % (len(wildcards) - 1)
+    text = WILDCARD_RE.sub(replace_wildcard, gt_filter).rstrip()
+
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        match = TOKEN_RE.match(text, pos)
+        if not match or match.end() == pos:
+            raise ValueError("Unsupported gt_filter near: %s" % text[pos:])
+        tokens.append( [g for g in match.groups() if g is not None][0] )
+        pos = match.end()
+    return tokens, wildcards
+
+def compile_gt_filter(gt_filter, conn, sample_to_idx=None):
+    """
+    Compiles a gt_filter into a function that takes a (variants x samples) gt_types array and returns a boolean
+    mask of the variants that pass the filter.
+    """
+    if sample_to_idx is None:
+        sample_to_idx = get_sample_to_idx(conn)
+    tokens, wildcards = tokenize_gt_filter(gt_filter)
+    compiled_wildcards = [compile_wildcard(conn, *wildcard) for wildcard in wildcards]
+    pos = [0]
+
+    def peek():
+        return tokens[pos[0]] if pos[0] < len(tokens) else None
+
+    def take():
+        token = peek()
+        if token is None:
+            raise ValueError("Unexpected end of gt_filter: %s" % gt_filter)
+        pos[0] += 1
+        return token
+
+    def parse_or():
+        terms = [parse_and()]
+        while peek() is not None and peek().lower() == 'or':
+            take()
+            terms.append(parse_and())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda gt_types: reduce(numpy.logical_or, [term(gt_types) for term in terms])
+
+    def parse_and():
+        terms = [parse_not()]
+        while peek() is not None and peek().lower() == 'and':
+            take()
+            terms.append(parse_not())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda gt_types: reduce(numpy.logical_and, [term(gt_types) for term in terms])
+
+    def parse_not():
+        if peek() is not None and peek().lower() == 'not':
+            take()
+            term = parse_not()
+            return lambda gt_types: ~term(gt_types)
+        return parse_atom()
+
+    def parse_atom():
+        token = take()
+        if token == '(':
+            term = parse_or()
+            if take() != ')':
+                raise ValueError("Unbalanced parentheses in gt_filter: %s" % gt_filter)
+            return term
+        if token.startswith('@'):
+            return compiled_wildcards[int(token[1:])]
+        if '.' in token:
+            column, sample = token.split('.', 1)
+            if column.lower() != 'gt_types':
+                raise ValueError("Unsupported gt_filter column: %s" % column)
+            if sample not in sample_to_idx:
+                raise ValueError("Unknown sample in gt_filter: %s" % sample)
+            op = take()
+            if op not in OPERATORS:
+                raise ValueError("Unsupported operator in gt_filter: %s" % op)
+            idx = sample_to_idx[sample]
+            value = get_genotype_value(take())
+            return lambda gt_types: OPERATORS[op](gt_types[:, idx], value)
+        raise ValueError("Unsupported gt_filter token: %s" % token)
+
+    mask_fn = parse_or()
+    if peek() is not None:
+        raise ValueError("Unsupported gt_filter near: %s" % ' '.join(tokens[pos[0]:]))
+    return mask_fn
+
+def split_query(query):
+    """
+    Returns a tuple of <selected columns> <rest of query> for a SELECT query.
+    """
+    match = re.match(r'^\s*select\s+(.+?)\s+(from\s.*)$', query, re.IGNORECASE | re.DOTALL)
+    if not match:
+        raise ValueError("Unsupported query: %s" % query)
+    return [col.strip() for col in match.group(1).split(',')], match.group(2)
+
+def decode_gt_types(blobs):
+    """
+    Decodes a batch of gt_types blobs into a (variants x samples) int8 array.
+    """
+    return numpy.vstack([unpack_genotype_blob(blob) for blob in blobs]).astype(numpy.int8)
+
+def decode_genotypes(blobs, column):
+    """
+    Decodes a batch of blobs for a genotype column (e.g. gts, gt_types) into a (variants x samples) array.
+    """
+    if column == 'gt_types':
+        return decode_gt_types(blobs)
+    return numpy.vstack([unpack_genotype_blob(blob) for blob in blobs])
+
+def get_sample_indices(gemini_db):
+    """
+    Returns dictionary mapping sample names to genotype array indices for a database.
+    """
+    conn = sqlite3.connect(gemini_db)
+    sample_to_idx = get_sample_to_idx(conn)
+    conn.close()
+    return sample_to_idx
+
+def get_genotype_batches(gemini_db, cols, genotype_columns=('gt_types',), where=None, batch_size=10000):
+    """
+    Yields tuples of <rows> <genotypes> for batches of variants read in a single scan of the variants table.
+    rows are the selected columns and genotypes maps each genotype column to a (variants x samples) array.
+    """
+    conn = sqlite3.connect(gemini_db)
+    conn.row_factory = sqlite3.Row
+    sql_cols = list(cols) + ['%s AS "__%s"' % (column, column) for column in genotype_columns]
+    query = "SELECT %s FROM variants" % ", ".join(sql_cols)
+    if where:
+        query += " WHERE %s" % where
+    cursor = conn.execute(query)
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        genotypes = dict( (column, decode_genotypes([row['__%s' % column] for row in rows], column))
+                          for column in genotype_columns )
+        yield rows, genotypes
+    conn.close()
+
+def run(gemini_db, query, gt_filter=None, batch_size=10000):
+    """
+    Runs a query with an optional gt_filter and returns an iterator of FastRows. Genotype columns for a sample,
+    e.g. gts.<sample>, can be selected. Raises ValueError if the query or gt_filter is not supported.
+    """
+    conn = sqlite3.connect(gemini_db)
+    conn.row_factory = sqlite3.Row
+    sample_to_idx = get_sample_to_idx(conn)
+    mask_fn = compile_gt_filter(gt_filter, conn, sample_to_idx) if gt_filter else None
+
+    # Separate sample genotype columns from columns that SQLite can return directly.
+    cols, rest = split_query(query)
+    plain_cols = []
+    genotype_cols = []
+    for col in cols:
+        if col.lower().startswith('gt') and '.' in col:
+            column, sample = col.split('.', 1)
+            if sample not in sample_to_idx:
+                raise ValueError("Unknown sample in query: %s" % sample)
+            genotype_cols.append( (col, column.lower(), sample_to_idx[sample]) )
+        elif col.lower().startswith('gt') or col.startswith('('):
+            raise ValueError("Unsupported genotype column: %s" % col)
+        else:
+            plain_cols.append(col)
+    blob_cols = sorted( set([column for col, column, idx in genotype_cols] + (['gt_types'] if mask_fn else [])) )
+    sql_cols = plain_cols + ['%s AS "__%s"' % (column, column) for column in blob_cols]
+    cursor = conn.execute("SELECT %s %s" % (", ".join(sql_cols), rest))
+    num_plain = len(plain_cols)
+    names = [d[0] for d in cursor.description[:num_plain]]
+
+    def results():
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            if mask_fn:
+                mask = mask_fn(decode_gt_types([row['__gt_types'] for row in rows]))
+                rows = [row for row, keep in zip(rows, mask) if keep]
+            for row in rows:
+                result = FastRow(zip(names, tuple(row)[:num_plain]))
+                decoded = {}
+                for col, column, idx in genotype_cols:
+                    if column not in decoded:
+                        decoded[column] = unpack_genotype_blob(row['__%s' % column])
+                    value = decoded[column][idx]
+                    result[col] = value.item() if isinstance(value, numpy.generic) and column != 'gts' else value
+                yield result
+        conn.close()
+
+    return results()
+
+def check_parity(gemini_db, query, gt_filter=None, fast_results=None):
+    """
+    Runs a query with both the fast path and GeminiQuery. Returns a tuple of <fast only> <gemini only> lists
+    with rows (as strings) returned by one but not the other. fast_results, if given, are rows already returned by
+    the fast path for the query, which is then not run again.
+    """
+    if fast_results is None:
+        fast_results = run(gemini_db, query, gt_filter)
+    fast_rows = Counter(str(row) for row in fast_results)
+    gemini = GeminiQuery(gemini_db)
+    gemini.run(query, gt_filter=gt_filter)
+    gemini_rows = Counter(str(row) for row in gemini)
+    return sorted((fast_rows - gemini_rows).elements()), sorted((gemini_rows - fast_rows).elements())
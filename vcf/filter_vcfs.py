@@ -0,0 +1,294 @@
+"""
+Filter annotated VCFs into named subsets and count them, reading each VCF once.
+
+Filters use vcffilter-style expressions over INFO fields, e.g. 'AB > 0.02', '!( TCGA = TRUE )' or
+'( TYPE = ins | TYPE = del )'. As with vcffilter, each alternate allele is tested and a record passes if the
+expression is true for any allele. Numeric comparisons treat missing ('.' or absent) and non-numeric values as 0.
+
+Usage:
+    python filter_vcfs.py find_somatic <depth> <ab_novel> <annotated.vcf> [<annotated.vcf> ...]
+    python filter_vcfs.py count_final <somatic_final.vcf> [<somatic_final.vcf> ...]
+"""
+
+import argparse
+import multiprocessing
+import operator
+import os
+import re
+
+from collections import OrderedDict
+
+OPERATORS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge
+}
+
+TOKEN_RE = re.compile(r'\s*(\(|\)|!=|<=|>=|=|<|>|!|&|\||[^\s()!=<>&|]+)')
+
+ANNOTATIONS = ['TCGA', 'DOCM', 'DOCM_LUNG_OR_NSCLC', 'DOCM_LUAD']
+
+class Record(object):
+    """
+    VCF data line with lazily parsed INFO fields.
+    """
+    def __init__(self, line):
+        self.line = line
+        self.fields = line.rstrip('\r\n').split('\t', 8)
+        self.num_alleles = len(self.fields[4].split(','))
+        self._info = None
+
+    @property
+    def info(self):
+        if self._info is None:
+            self._info = {}
+            for entry in self.fields[7].split(';'):
+                key, sep, value = entry.partition('=')
+                self._info[key] = value.split(',') if sep else [True]
+        return self._info
+
+    def get_value(self, field, allele):
+        """
+        Returns value of field for an alternate allele or None if field is missing.
+        """
+        if field == 'QUAL':
+            return self.fields[5]
+        values = self.info.get(field)
+        if values is None:
+            return None
+        if len(values) == self.num_alleles:
+            return values[allele]
+        if len(values) == self.num_alleles + 1:
+            # Number=R field with reference value first.
+            return values[allele + 1]
+        return values[0]
+
+def to_float(value):
+    """
+    Returns value as float; missing and non-numeric values are 0.
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+def compile_comparison(field, op, value):
+    """
+    Returns function(record, allele) for a comparison of a field to a value.
+    """
+    compare = OPERATORS[op]
+    if op in ['=', '!=']:
+        return lambda record, allele: compare(record.get_value(field, allele), value)
+    value = float(value)
+    return lambda record, allele: compare(to_float(record.get_value(field, allele)), value)
+
+def compile_expression(expression):
+    """
+    Returns function(record, allele) for a vcffilter-style expression with comparisons, flags, !, &, | and
+    parentheses.
+    """
+    tokens = TOKEN_RE.findall(expression)
+    pos = [0]
+
+    def peek():
+        return tokens[pos[0]] if pos[0] < len(tokens) else None
+
+    def take(expected=None):
+        token = peek()
+        if token is None or (expected and token != expected):
+            raise ValueError("invalid filter expression: %s" % expression)
+        pos[0] += 1
+        return token
+
+    def parse_or():
+        terms = [parse_and()]
+        while peek() == '|':
+            take()
+            terms.append(parse_and())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda record, allele: any(term(record, allele) for term in terms)
+
+    def parse_and():
+        terms = [parse_not()]
+        while peek() == '&':
+            take()
+            terms.append(parse_not())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda record, allele: all(term(record, allele) for term in terms)
+
+    def parse_not():
+        if peek() == '!':
+            take()
+            term = parse_not()
+            return lambda record, allele: not term(record, allele)
+        if peek() == '(':
+            take()
+            term = parse_or()
+            take(')')
+            return term
+        field = take()
+        if peek() in OPERATORS:
+            op = take()
+            return compile_comparison(field, op, take())
+        # Flag: passes if present and not missing.
+        return lambda record, allele: record.get_value(field, allele) not in [None, '.']
+
+    function = parse_or()
+    if peek() is not None:
+        raise ValueError("invalid filter expression: %s" % expression)
+    return function
+
+class VcfFilter(object):
+    """
+    Named filter. A record passes if it passes the parent filter and, for each allele, all expressions (or any
+    expression if any_expression is set) are true for some allele. A union filter passes records that pass any
+    of its union filters.
+    """
+    def __init__(self, name, expressions=(), parent=None, any_expression=False, union=()):
+        self.name = name
+        self.parent = parent
+        self.union = list(union)
+        terms = [compile_expression(expression) for expression in expressions]
+        if any_expression:
+            self.test = lambda record, allele: any(term(record, allele) for term in terms)
+        else:
+            self.test = lambda record, allele: all(term(record, allele) for term in terms)
+
+    def passes(self, record, results):
+        """
+        Returns True if record passes filter; results holds results of earlier filters.
+        """
+        if self.parent and not results[self.parent]:
+            return False
+        if self.union:
+            return any(results[name] for name in self.union)
+        return any(self.test(record, allele) for allele in xrange(record.num_alleles))
+
+def filter_vcf(input_path, filters, output_paths=None):
+    """
+    Reads a VCF once and evaluates filters, in order, on each record. Records that pass a filter are written to
+    its file in output_paths, if any, with the input header. Returns ordered dictionary of filter name to number
+    of passing records.
+    """
+    output_paths = output_paths or {}
+    outputs = dict( (name, open(path, 'w')) for name, path in output_paths.items() )
+    counts = OrderedDict( (f.name, 0) for f in filters )
+    for line in open(input_path):
+        if line.startswith('#'):
+            for output in outputs.values():
+                output.write(line)
+            continue
+        record = Record(line)
+        results = {}
+        for f in filters:
+            passed = f.passes(record, results)
+            results[f.name] = passed
+            if passed:
+                counts[f.name] += 1
+                if f.name in outputs:
+                    outputs[f.name].write(line)
+    for output in outputs.values():
+        output.close()
+    return counts
+
+def get_somatic_filters(depth, ab_novel):
+    """
+    Returns filters for somatic variants: remove common, low allele balance, low depth and homopolymer variants,
+    then find annotated (hotspot) and novel variants.
+    """
+    not_annotated = ['!( TCGA = TRUE )', '!( DOCM = TRUE )']
+    filters = [ VcfFilter('AB2pct_no_common', ['AB > 0.02', 'HP < 5', 'DP > %s' % depth, '1000g2014oct_all < 0.01',
+                                               'esp6500si_all < 0.01', 'exac03 < 0.01']) ]
+    filters += [ VcfFilter(anno, ['%s = TRUE' % anno], parent='AB2pct_no_common') for anno in ANNOTATIONS ]
+    filters += [
+        VcfFilter('novel_snps', ['ExonicFunc.refGene != .', 'ExonicFunc.refGene != synonymous_SNV',
+                                 'AB > %s' % ab_novel] + not_annotated + ['SIFT_pred = D', 'Polyphen2_HDIV_pred = D'],
+                  parent='AB2pct_no_common'),
+        VcfFilter('novel_indels', ['AB > %s' % ab_novel] + not_annotated + ['( TYPE = ins | TYPE = del )'],
+                  parent='AB2pct_no_common'),
+        VcfFilter('somatic', union=['TCGA', 'DOCM_LUNG_OR_NSCLC', 'DOCM_LUAD', 'novel_snps', 'novel_indels'])
+    ]
+    return filters
+
+def get_final_somatic_filters():
+    """
+    Returns filters for counting final somatic variants.
+    """
+    not_annotated = ['!( %s = TRUE )' % anno for anno in ANNOTATIONS]
+    filters = [ VcfFilter(anno, ['%s = TRUE' % anno]) for anno in ANNOTATIONS ]
+    filters += [
+        VcfFilter('novel_snps', ['TYPE = snp'] + not_annotated),
+        VcfFilter('novel_indels', ['!( TYPE = snp )'] + not_annotated),
+        VcfFilter('somatic')
+    ]
+    return filters
+
+def get_base_name(path):
+    """
+    Returns file name without directory and last extension.
+    """
+    return os.path.splitext(os.path.basename(path))[0]
+
+def find_somatic(args):
+    """
+    Writes no-common, annotation, novel and somatic subsets of an annotated VCF to the working directory. Returns
+    sample name and subset counts.
+    """
+    input_path, depth, ab_novel = args
+    name = get_base_name(input_path)
+    filters = get_somatic_filters(depth, ab_novel)
+    output_paths = { 'AB2pct_no_common': '%s_AB2pct_no_common.vcf' % name }
+    for f in filters[1:]:
+        output_paths[f.name] = '%s_AB2pct_no_common_%s.vcf' % (name, f.name)
+    return (name, filter_vcf(input_path, filters, output_paths))
+
+def count_final(input_path):
+    """
+    Returns sample name and subset counts of a final somatic VCF.
+    """
+    return (get_base_name(input_path), filter_vcf(input_path, get_final_somatic_filters()))
+
+def write_counts(counts_path, sample_counts):
+    """
+    Writes table of subset counts for each sample.
+    """
+    columns = ['TCGA', 'novel_snps', 'novel_indels', 'DOCM', 'DOCM_LUNG_OR_NSCLC', 'DOCM_LUAD', 'somatic']
+    output = open(counts_path, 'w')
+    output.write('#Sample TCGA Novel_SNP Novel_Indel DOCM DOCM_lung DOCM_luad Total\n')
+    for name, counts in sorted(sample_counts):
+        output.write('%s %s\n' % ( name, ' '.join(str(counts[column]) for column in columns) ))
+    output.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Filter annotated VCFs into somatic subsets and count them.')
+    subparsers = parser.add_subparsers(dest="operation")
+    somatic_parser = subparsers.add_parser("find_somatic", help="Write somatic subsets of annotated VCFs")
+    somatic_parser.add_argument("depth", help="Minimum depth (exclusive)")
+    somatic_parser.add_argument("ab_novel", help="Minimum allele balance (exclusive) for novel variants")
+    somatic_parser.add_argument("vcfs", nargs="+", help="Annotated VCFs")
+    somatic_parser.add_argument("--counts", default="total_counts.txt", help="Write subset counts to this file")
+    somatic_parser.add_argument("--processes", type=int, default=4, help="Number of VCFs to filter in parallel")
+    final_parser = subparsers.add_parser("count_final", help="Count subsets of final somatic VCFs")
+    final_parser.add_argument("vcfs", nargs="+", help="Final somatic VCFs")
+    final_parser.add_argument("--counts", default="final_total_counts.txt", help="Write subset counts to this file")
+    final_parser.add_argument("--processes", type=int, default=4, help="Number of VCFs to count in parallel")
+    args = parser.parse_args()
+
+    if args.operation == "find_somatic":
+        worker, tasks = find_somatic, [ (vcf, args.depth, args.ab_novel) for vcf in args.vcfs ]
+    else:
+        worker, tasks = count_final, args.vcfs
+
+    if args.processes > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(args.processes, len(tasks)))
+        sample_counts = pool.map(worker, tasks, chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        sample_counts = [ worker(task) for task in tasks ]
+    write_counts(args.counts, sample_counts)
@@ -14,12 +14,14 @@
 #   depth - minimum variant depth [CURRENTLY IGNORED]
 #   ab_novel - minimum allelic balance for novel variants. [CURRENTLY IGNORED]
 #   counts file - file to write counts data to.
+#   cache_dir - [optional] directory to cache stage outputs in; stages whose inputs, reference, annotations and
+#               parameters are unchanged are not rerun
 #
 
 # Arguments check.
-if [ $# -ne "8" ]
+if [ $# -ne "8" ] && [ $# -ne "9" ]
 then
-  echo "Usage: `basename $0` <vcf> <genome_fasta> <annotator_dir> <annotations_dir> <gemini_pythonpath> <depth> <ab_novel> <counts_file>"
+  echo "Usage: `basename $0` <vcf> <genome_fasta> <annotator_dir> <annotations_dir> <gemini_pythonpath> <depth> <ab_novel> <counts_file> [cache_dir]"
   exit -1
 fi
 
@@ -32,30 +34,74 @@ GEMINI_PYTHONPATH=$5
 DEPTH=$6
 AB_NOVEL=$7
 COUNTS_FILE=$8
+CACHE_DIR=$9
 HOME_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && cd .. && pwd )"
 CREATE_GEMINI_DB="${HOME_DIR}/pipelines/create_gemini_db.sh"
-BASE=$(basename "$1" .vcf)
+BASE="$(basename "$1" .vcf)"
 FIND_SOMATIC_SCRIPT="${HOME_DIR}/vcf/gemini_operations.py"
+FIND_SOMATIC_MODULES=( af_lookup.py annotate_gemini_db.py fast_query.py query_advisor.py query_cache.py \
+	query_profiler.py vcf_merge.py )
+FILTER="INFO.AB>0.02&&INFO.DP>50&&INFO.HP<5"
+ANNOTATION_FILES=( "${ANNOTATIONS_DIR}"/*/*.vcf.gz )
+
+# Run a stage: run_stage <stage> [--input=<file> ...] [--output=<file> ...] [--param=<param> ...] -- <command> [<arg> ...]
+# Each input, output and parameter is its own argument, so values may contain spaces or glob characters. With a
+# cache directory, the stage is skipped if its outputs are cached.
+run_stage() {
+	local STAGE=$1
+	local CACHE_ARGS=()
+	shift
+	while [ "$1" != "--" ]; do
+		CACHE_ARGS+=( "$1" )
+		shift
+	done
+	shift
+	if [ -z "${CACHE_DIR}" ]; then
+		"$@"
+	else
+		python "${HOME_DIR}/pipelines/stage_cache.py" --cache_dir "${CACHE_DIR}" run "${STAGE}" "${CACHE_ARGS[@]}" -- "$@"
+	fi
+}
 
 # Remove cruft (low AB, low DP, or high HP), then decompose and normalize.
-(grep ^# ${INPUT_VCF}; vt view -f "INFO.AB>0.02&&INFO.DP>50&&INFO.HP<5" ${INPUT_VCF}) | vt decompose -s - | vt normalize -r ${REFERENCE} -o ${BASE}_decnorm.vcf -
+run_stage decnorm --input="${INPUT_VCF}" --input="${REFERENCE}" --output="${BASE}_decnorm.vcf" --param="${FILTER}" -- \
+	sh -c '(grep ^# "$1"; vt view -f "$2" "$1") | vt decompose -s - | vt normalize -r "$3" -o "$4" -' \
+	_ "${INPUT_VCF}" "${FILTER}" "${REFERENCE}" "${BASE}_decnorm.vcf" || exit 1
 
 # Annotate and create GEMINI db.
-${CREATE_GEMINI_DB} ${BASE}_decnorm.vcf ${BASE}.db VEP ${ANNOTATOR_DIR}
+run_stage create --input="${BASE}_decnorm.vcf" --input="${CREATE_GEMINI_DB}" --output="${BASE}.db" --param=VEP \
+	--param="${ANNOTATOR_DIR}" -- \
+	"${CREATE_GEMINI_DB}" "${BASE}_decnorm.vcf" "${BASE}.db" VEP "${ANNOTATOR_DIR}" || exit 1
 
-# Add annotations.
+# Add annotations in a single pass.
 ANNOS=""
-for d in ${ANNOTATIONS_DIR}/*/ ; do
-	for f in $d/*.vcf.gz ; do
+for d in "${ANNOTATIONS_DIR}"/*/ ; do
+	for f in "$d"/*.vcf.gz ; do
 		ANNO=$(basename "$f" .vcf.gz)
 		ANNOS="${ANNOS},${ANNO}"
-		gemini annotate \
-			-f $f \
-			-a boolean \
-			-c ${ANNO} \
-			${BASE}.db
 	done
 done
+ANNOS_PARAM=()
+if [ -n "${ANNOS}" ]; then
+	ANNOS_PARAM=( --param="${ANNOS:1}" )
+fi
+ANNOTATION_INPUTS=()
+for f in "${ANNOTATION_FILES[@]}" ; do
+	ANNOTATION_INPUTS+=( --input="$f" )
+done
+export PYTHONPATH="${GEMINI_PYTHONPATH}"
+run_stage annotate --input="${BASE}.db" --input="${HOME_DIR}/vcf/annotate_gemini_db.py" "${ANNOTATION_INPUTS[@]}" \
+	--output="${BASE}.db" "${ANNOS_PARAM[@]}" -- \
+	python "${HOME_DIR}/vcf/annotate_gemini_db.py" --annotations_dir "${ANNOTATIONS_DIR}" "${BASE}.db" || exit 1
 
-# Create VCF of somatic variants.
-PYTHONPATH=${GEMINI_PYTHONPATH} python ${FIND_SOMATIC_SCRIPT} --header --annotations ${ANNOS:1} --output_vcf ${BASE}_somatic.vcf find_somatic ${BASE}.db >> ${COUNTS_FILE}
+# Create VCF of somatic variants. The script and every module it imports are stage inputs, so a change to any of
+# them reruns the stage.
+FIND_SOMATIC_INPUTS=( --input="${FIND_SOMATIC_SCRIPT}" )
+for m in "${FIND_SOMATIC_MODULES[@]}" ; do
+	FIND_SOMATIC_INPUTS+=( --input="${HOME_DIR}/vcf/$m" )
+done
+run_stage find_somatic --input="${BASE}.db" "${FIND_SOMATIC_INPUTS[@]}" --output="${BASE}_somatic.vcf" \
+	--output="${BASE}_counts.txt" "${ANNOS_PARAM[@]}" -- \
+	sh -c 'python "$1" --header --annotations "$2" --output_vcf "$3" find_somatic "$4" > "$5"' \
+	_ "${FIND_SOMATIC_SCRIPT}" "${ANNOS:1}" "${BASE}_somatic.vcf" "${BASE}.db" "${BASE}_counts.txt" || exit 1
+cat "${BASE}_counts.txt" >> "${COUNTS_FILE}"
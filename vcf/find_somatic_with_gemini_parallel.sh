@@ -6,7 +6,6 @@
 # Dependencies that should be in your PATH:
 #   GEMINI (https://github.com/arq5x/gemini, See ./install/install_gemini.sh for installation instructions)
 #	vt (https://github.com/atks/vt, see http://genome.sph.umich.edu/wiki/Vt#Installation for installation instructions)
-#   bcftools (https://github.com/samtools/bcftools, see http://www.htslib.org/download/ for installation instructions)
 #
 # Arguments:
 #   genome_fasta - fasta file for genome
@@ -17,6 +16,9 @@
 #   ab_novel - minimum allelic balance for novel variants. [CURRENTLY IGNORED]
 #   counts file - file to write counts data to.
 #
+# Unlike find_somatic_with_gemini.sh, this script does not cache stage outputs: every run filters, normalizes,
+# creates and annotates all databases from scratch.
+#
 
 # Arguments check.
 if [ $# -ne "7" ]
@@ -35,22 +37,27 @@ COUNTS_FILE=$7
 
 JOBS=2
 HOME_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )"
-TEMP="temp.txt"
 
-# Set up directory and file for results.
+# Set up directory for results.
 mkdir find_somatic
 pushd find_somatic
-touch ${TEMP}
-
-# Find somatic variants for all VCFs.
-parallel -j ${JOBS} "${HOME_DIR}/find_somatic_with_gemini.sh {} ${REFERENCE} ${ANNOTATOR_DIR} ${ANNOTATIONS_DIR} ${GEMINI_PYTHONPATH} ${DEPTH} ${AB_NOVEL} ${TEMP}" ::: ../*.vcf
 
-# Create final counts file.
-(head -n 1 ${TEMP}; grep -v ^# ${TEMP} | sort -k1,1) > ${COUNTS_FILE}
+# Remove cruft (low AB, low DP, or high HP), decompose and normalize, and create GEMINI db for all VCFs. Paths reach
+# each job through the environment rather than the command string, so they are not re-split by the job's shell.
+decnorm_create() {
+	local BASE="$(basename "$1" .vcf)"
+	(grep ^# "$1"; vt view -f 'INFO.AB>0.02&&INFO.DP>50&&INFO.HP<5' "$1") | vt decompose -s - | \
+		vt normalize -r "${REFERENCE}" -o "${BASE}_decnorm.vcf" - && \
+		"${HOME_DIR}/../pipelines/create_gemini_db.sh" "${BASE}_decnorm.vcf" "${BASE}.db" VEP "${ANNOTATOR_DIR}"
+}
+export -f decnorm_create
+export REFERENCE HOME_DIR ANNOTATOR_DIR
+parallel -j ${JOBS} decnorm_create {} ::: ../*.vcf
 
-# Merge all somatic variants into single file.
-parallel -j ${JOBS} "bgzip {} && tabix -p vcf {}.gz" ::: *_somatic.vcf
-bcftools merge *.vcf.gz > all_somatic.vcf
+# Add annotations to all databases, loading annotations once, then find somatic variants in all databases in
+# parallel and write counts file and merged somatic variants.
+PYTHONPATH="${GEMINI_PYTHONPATH}" python "${HOME_DIR}/gemini_operations.py" --header --annotations_dir "${ANNOTATIONS_DIR}" \
+	--output_vcf all_somatic.vcf find_somatic_all *.db > "${COUNTS_FILE}"
 
 # Create GEMINI database.
 # TODO: annotate with TCGA, DOCM annotations.
@@ -58,6 +65,6 @@ bcftools merge *.vcf.gz > all_somatic.vcf
 # Because of the INFO bug in GEMINI v0.15.1, need to create gemini database (annotation + create)
 # rather than just create.
 #gemini load -v all_somatic.vcf -t VEP all_somatic.db
-${HOME_DIR}/../pipelines/create_gemini_db.sh all_somatic.vcf all_somatic.db VEP ${ANNOTATOR_DIR}
+"${HOME_DIR}/../pipelines/create_gemini_db.sh" all_somatic.vcf all_somatic.db VEP "${ANNOTATOR_DIR}"
 
 popd
\ No newline at end of file
@@ -3,17 +3,51 @@ Library for using GEMINI's API for somatic variant calling.
 """
 
 import argparse
+import itertools
+import multiprocessing
 import os
+import sqlite3
+import sys
 
-from collections import namedtuple
+import numpy
+
+from collections import OrderedDict, namedtuple
 from gemini import GeminiQuery, DefaultRowFormat, VCFRowFormat
+from gemini.gemini_constants import HET, HOM_ALT
+
+import af_lookup
+import annotate_gemini_db
+import fast_query
+import query_advisor
+import query_cache
+import query_profiler
+import vcf_merge
 
 COMMON_DATABASES = ["1kg", "exac", "esp"]
 BASE_VARIANT_QUERY = "select chrom, start, end, ref, alt from variants"
 
+# Prefix for names of indexes created by prepare_gemini_db.
+PREPARE_INDEX_PREFIX = "prepare_"
+
+# Engine for queries with a gt_filter: 'gemini' (GeminiQuery), 'fast' (fast_query, falling back to GeminiQuery
+# for unsupported filters), or 'parity' (fast_query, checked against GeminiQuery).
+QUERY_ENGINE = 'gemini'
+
+# Cache for query results; None disables caching.
+QUERY_CACHE = None
+
+# Profiler for queries; None disables profiling.
+QUERY_PROFILER = None
+
 class Variant(object):
+    """
+    Compact variant with 0-based, half-open coordinates. genotypes, if given, is a sequence of per-sample VCF
+    genotypes (e.g. '0/1' or '0|1') used to check that adjacent variants can be combined.
+    """
+    __slots__ = ('chrom', 'start', 'end', 'ref', 'alt', 'transcript', 'codon_change', 'genotypes')
+
     def __init__(self, chrom=None, start=None, end=None, ref=None, alt=None, transcript=None,
-                 codon_change=None):
+                 codon_change=None, genotypes=None):
         self.chrom = chrom
         self.start = start
         self.end = end
@@ -21,6 +55,13 @@ class Variant(object):
         self.alt = alt
         self.transcript = transcript
         self.codon_change = codon_change
+        self.genotypes = genotypes
+
+    def is_snv(self):
+        """
+        Returns true if this variant is a single-nucleotide variant.
+        """
+        return len(self.ref) == 1 and len(self.alt) == 1 and self.alt not in ['.', '*']
 
     def is_adjacent(self, variant):
         """
@@ -28,11 +69,23 @@ class Variant(object):
         """
         return self.chrom == variant.chrom and (self.start == variant.end or self.end == variant.start)
 
+    def has_consistent_genotypes(self, variant):
+        """
+        Returns true if every sample has the same genotype for this variant and another variant, so that both
+        are on the same haplotypes; phased genotypes must match exactly. True if either variant has no genotypes.
+        """
+        if self.genotypes is None or variant.genotypes is None:
+            return True
+        if len(self.genotypes) != len(variant.genotypes):
+            return False
+        return all( get_genotype_key(gt1) == get_genotype_key(gt2)
+                    for gt1, gt2 in zip(self.genotypes, variant.genotypes) )
+
     def combine_adjacent(self, variant):
         """
         Combine adjacent variants into a single variant.
         """
-        if not self._is_adjecent(variant):
+        if not self.is_adjacent(variant):
             return None
 
         if self.start < variant.start:
@@ -43,7 +96,72 @@ class Variant(object):
             second = self
 
         return Variant(chrom=self.chrom, start=first.start, end=second.end, ref=(first.ref + second.ref),
-                       alt=(first.alt + second.alt))
+                       alt=(first.alt + second.alt), genotypes=first.genotypes)
+
+def get_genotype_key(genotype):
+    """
+    Returns comparable form of a VCF genotype: phased genotypes as is, unphased genotypes as sorted alleles.
+    """
+    if '|' in genotype:
+        return genotype
+    return '/'.join(sorted(genotype.split('/')))
+
+def merge_adjacent_snvs(variants):
+    """
+    Yields (variant, items) for a coordinate-sorted stream of (Variant, item) tuples, where runs of adjacent SNVs
+    with consistent genotypes are merged into a single MNP and items are the items of the merged variants. Runs
+    are merged in a single pass.
+    """
+    run = []
+
+    def flush():
+        first, last = run[0][0], run[-1][0]
+        if len(run) == 1:
+            return (first, [run[0][1]])
+        return ( Variant(chrom=first.chrom, start=first.start, end=last.end,
+                         ref=''.join(v.ref for v, item in run), alt=''.join(v.alt for v, item in run),
+                         genotypes=first.genotypes), [item for v, item in run] )
+
+    for variant, item in variants:
+        if run:
+            last = run[-1][0]
+            if variant.is_snv() and last.chrom == variant.chrom and last.end == variant.start and \
+               last.has_consistent_genotypes(variant):
+                run.append( (variant, item) )
+                continue
+            yield flush()
+        run = [ (variant, item) ] if variant.is_snv() else []
+        if not run:
+            yield (variant, [item])
+    if run:
+        yield flush()
+
+def get_vcf_variant(line):
+    """
+    Returns Variant for a VCF line, with the genotypes of its samples.
+    """
+    fields = line.split('\t')
+    start = int(fields[1]) - 1
+    genotypes = [ sample.split(':', 1)[0] for sample in fields[9:] ] or None
+    return Variant(chrom=fields[0], start=start, end=start + len(fields[3]), ref=fields[3], alt=fields[4],
+                   genotypes=genotypes)
+
+def merge_somatic_mnps(results, categories):
+    """
+    Yields (VCF line, categories) for coordinate-sorted (VCF line, categories) tuples, with runs of adjacent SNVs
+    that have consistent genotypes merged into MNPs. An MNP has the other VCF columns of its first SNV and the
+    categories of all of its SNVs.
+    """
+    for variant, items in merge_adjacent_snvs( (get_vcf_variant(line), (line, line_categories))
+                                               for line, line_categories in results ):
+        if len(items) == 1:
+            yield items[0]
+            continue
+        fields = items[0][0].split('\t')
+        fields[3] = variant.ref
+        fields[4] = variant.alt
+        merged = set( category for line, line_categories in items for category in line_categories )
+        yield ( '\t'.join(fields), [category for category in categories if category in merged] )
 
 def get_gt_filter(sample, gt_type):
     """
@@ -86,23 +204,32 @@ def get_annotation_and_no_common_clause(anno_col_name, has_anno=True, aaf=0.01):
         val = 0
     return '%s AND %s' % ( get_annotation_clause(anno_col_name, val), get_no_common_vars_clause() )
 
+def get_novel_clause(annotations, var_type='snp', allele_freq=0.1):
+    """
+    Returns clause for selecting novel variants of a type: variants without any annotation and above an
+    allele_bal threshold; novel SNPs also need high impact or med impact + SIFT/PolyPhen.
+    """
+    clauses = ["type = '%s'" % var_type, "allele_bal >= %f" % allele_freq]
+    clauses += [get_annotation_clause(anno, has_anno=False) for anno in annotations]
+    if var_type == 'snp':
+        #TODO: be more precise about which impacts in HIGH (e.g., stop_gain, stop_loss) and MED (e.g. non-synonymous)
+        # should be selected
+        clauses.append( "impact_severity = 'HIGH' or (impact_severity = 'MED' AND sift_pred = 'deleterious' AND "
+                        "polyphen_pred = 'probably_damaging')" )
+    return ' AND '.join('(%s)' % clause for clause in clauses)
+
 def get_novel_query(annotations, var_type='snp', allele_freq=0.1):
     """
     Return query to get novel variants.
     """
+    return "%s WHERE %s AND %s" % ( BASE_VARIANT_QUERY, get_novel_clause(annotations, var_type, allele_freq),
+                                     get_no_common_vars_clause() )
 
-    add_clause = ""
-    if var_type is 'snp':
-        #TODO: be more precise about which impacts in HIGH (e.g., stop_gain, stop_loss) and MED (e.g. non-synonymous) 
-        # should be selected
-        # Add clause for novel SNPs to require high impact or med impact + SIFT/PolyPhen to be true.
-        add_clause = "AND (impact_severity = 'HIGH' or (impact_severity = 'MED' AND " \
-                     "sift_pred = 'deleterious' AND polyphen_pred = 'probably_damaging'))"
-    
-    # Set up query.
-    no_anno = [get_annotation_clause(anno, has_anno=False) for anno in annotations]
-    return "%s WHERE (type = '%s') AND (allele_bal >= %f) AND %s AND %s %s" \
-           % ( BASE_VARIANT_QUERY, var_type, allele_freq, " AND ".join(no_anno), get_no_common_vars_clause(), add_clause)
+def get_hotspot_clause(annotation, allele_bal=0.02):
+    """
+    Returns clause for selecting hotspot variants, i.e. those with an annotation and minimum allele_bal.
+    """
+    return "(%s) AND (allele_bal >= %f)" % ( get_annotation_clause(annotation), allele_bal )
 
 def get_hotspot_variants(annotation, allele_bal=0.02):
     """
@@ -111,61 +238,142 @@ def get_hotspot_variants(annotation, allele_bal=0.02):
     return "%s WHERE (allele_bal >= %f) AND %s" % \
           ( BASE_VARIANT_QUERY, allele_bal, get_annotation_and_no_common_clause(annotation) )
 
-def get_somatic_variants(gemini_db, annotations, out_format=DefaultRowFormat(None)):
+def get_somatic_query(annotations, hotspot_allele_bal=0.02, novel_allele_bal=0.1, aaf=0.01):
     """
-    Returns counts for all hotspot and novel variants and a list of variants.
+    Returns query that selects, in a single pass, all hotspot and novel variants together with the columns needed
+    to classify them. Common variants are removed and the hotspot and novel clauses of all categories are combined
+    with OR in the query itself, so only somatic variants are returned; classify_somatic_variant then finds the
+    categories of each one.
     """
+    cols = ["variant_id", "chrom", "start", "end", "ref", "alt", "type", "allele_bal",
+            "impact_severity", "sift_pred", "polyphen_pred"] + list(annotations)
+    categories = [ get_hotspot_clause(anno, hotspot_allele_bal) for anno in annotations ]
+    categories += [ get_novel_clause(annotations, var_type, novel_allele_bal) for var_type in ['snp', 'indel'] ]
+    return "SELECT %s FROM variants WHERE (allele_bal >= %f) AND %s AND (%s)" % \
+           ( ", ".join(cols), min(hotspot_allele_bal, novel_allele_bal), get_no_common_vars_clause(aaf),
+             " OR ".join('(%s)' % clause for clause in categories) )
+
+def is_hotspot_variant(row, annotation, allele_bal=0.02):
+    """
+    Returns true if row is a hotspot variant for an annotation; row predicate equivalent to get_hotspot_clause.
+    """
+    return row[annotation] == 1 and row['allele_bal'] is not None and row['allele_bal'] >= allele_bal
 
-    variants = []
-    var_counts = []
-
-    def add_variants(results):
-        count = 0
-        for result in results:
-            result = str(result)
-            if result not in variants:
-                variants.append(result)
-            else:
-                pass
-                #print "******************* Result already in variants:"
-                #print result.split('\t')[0:3]
-            count += 1
-        return count
+def is_novel_variant(row, annotations, var_type='snp', allele_freq=0.1):
+    """
+    Returns true if row is a novel variant of the given type; row predicate equivalent to get_novel_clause.
+    """
+    if row['type'] != var_type or row['allele_bal'] is None or row['allele_bal'] < allele_freq:
+        return False
 
-    # Get variants in hotspots.
+    # Novel variants cannot appear in any annotation.
     for anno in annotations:
-        results = get_query_results(gemini_db, get_hotspot_variants(anno), out_format=out_format)
-        count = add_variants(results)
-        var_counts.append(count)
+        if row[anno] != 0:
+            return False
+
+    # Novel SNPs require high impact or med impact + SIFT/PolyPhen to be true.
+    if var_type == 'snp':
+        return row['impact_severity'] == 'HIGH' or \
+               ( row['impact_severity'] == 'MED' and row['sift_pred'] == 'deleterious' and \
+                 row['polyphen_pred'] == 'probably_damaging' )
+    return True
+
+def get_somatic_categories(annotations):
+    """
+    Returns names of somatic categories in the order that counts are reported.
+    """
+    return list(annotations) + ['novel_snp', 'novel_indel']
 
-    # Get novel counts.
+def classify_somatic_variant(row, annotations, hotspot_allele_bal=0.02, novel_allele_bal=0.1):
+    """
+    Returns list of somatic categories (annotation names, novel_snp, novel_indel) that a row belongs to.
+    """
+    categories = [anno for anno in annotations if is_hotspot_variant(row, anno, hotspot_allele_bal)]
     for var_type in ['snp', 'indel']:
-        results = get_query_results(gemini_db, get_novel_query(annotations, var_type), out_format=out_format)
-        count = add_variants(results)
-        var_counts.append(count)
-    return var_counts, variants
+        if is_novel_variant(row, annotations, var_type, novel_allele_bal):
+            categories.append('novel_%s' % var_type)
+    return categories
 
-def get_amplicons(gemini_db):
+def get_prepare_indexes(annotations):
     """
-    Returns a tuple of amplicon, variants for all samples and amplicons that share more than one variant.
+    Returns indexes for somatic queries. All are partial indexes over rare variants, i.e. those selected by
+    get_no_common_vars_clause: a covering index for get_somatic_query, an index for get_hotspot_variants for each
+    annotation, and an index for get_novel_query.
     """
+    rare = get_no_common_vars_clause()
+    rare_cols = [ col % db for db in COMMON_DATABASES for col in ['in_%s', 'aaf_%s_all'] ]
+    somatic_cols = ["allele_bal", "chrom", "start", "end", "ref", "alt", "type", "impact_severity", "sift_pred",
+                    "polyphen_pred"] + list(annotations) + rare_cols
+    indexes = [ query_advisor.Index(PREPARE_INDEX_PREFIX + "somatic", "variants", somatic_cols, rare) ]
+    indexes += [ query_advisor.Index(PREPARE_INDEX_PREFIX + "hotspot_" + anno, "variants", [anno, "allele_bal"], rare)
+                 for anno in annotations ]
+    indexes.append( query_advisor.Index(PREPARE_INDEX_PREFIX + "novel", "variants",
+                                        ["type", "allele_bal", "impact_severity"], rare) )
+    return indexes
+
+def get_prepare_queries(annotations, hotspot_allele_bal=0.02, novel_allele_bal=0.1):
+    """
+    Returns list of (name, query) for the somatic queries that prepare_gemini_db creates indexes for.
+    """
+    queries = [ ("somatic", get_somatic_query(annotations, hotspot_allele_bal, novel_allele_bal)) ]
+    queries += [ ("hotspot_%s" % anno, get_hotspot_variants(anno, hotspot_allele_bal)) for anno in annotations ]
+    queries += [ ("novel_%s" % var_type, get_novel_query(annotations, var_type, novel_allele_bal))
+                 for var_type in ['snp', 'indel'] ]
+    return queries
+
+def prepare_gemini_db(gemini_db, annotations, timings=True):
+    """
+    Creates indexes for somatic queries in a database, replacing indexes created for other annotations. Returns
+    a query_advisor.QueryReport for each somatic query with its plan and timing before and after.
+    """
+    return query_advisor.prepare_db(gemini_db, get_prepare_indexes(annotations), get_prepare_queries(annotations),
+                                    PREPARE_INDEX_PREFIX, timings)
 
-    query = "SELECT gene, amplicon, gts.%s FROM variants"
-    gt_filter = "(gt_types).(*).(==HET).(count > 1) and gt_types.%s == HET or gt_types.%s == HOM_ALT"
+def get_amplicon_counts(gemini_db):
+    """
+    Returns a tuple of <amplicons> <counts> where counts is an (amplicons x samples) array with the number of
+    variants in each amplicon for each sample. A variant is counted for a sample if it is HOM_ALT in the sample
+    or HET in the sample and more than one sample. All samples are counted in a single scan of the variants table.
+    """
+    sample_to_idx = fast_query.get_sample_indices(gemini_db)
+    amplicon_idx = {}
+    counts = numpy.zeros((0, len(sample_to_idx)), dtype=numpy.int64)
+
+    for rows, genotypes in fast_query.get_genotype_batches(gemini_db, ['amplicon']):
+        gt_types = genotypes['gt_types']
+        is_het = gt_types == HET
+        has_variant = ( (is_het.sum(axis=1) > 1)[:, numpy.newaxis] & is_het ) | (gt_types == HOM_ALT)
+
+        # Get (variant, amplicon) pairs for batch.
+        variant_indices = []
+        amplicon_indices = []
+        for i, row in enumerate(rows):
+            for amplicon in row['amplicon'].split(','):
+                if amplicon not in amplicon_idx:
+                    amplicon_idx[amplicon] = len(amplicon_idx)
+                variant_indices.append(i)
+                amplicon_indices.append(amplicon_idx[amplicon])
+
+        # Add counts for batch.
+        if len(amplicon_idx) > len(counts):
+            counts = numpy.vstack( [counts, numpy.zeros( (max(len(amplicon_idx), 2 * len(counts)) - len(counts),
+                                                          counts.shape[1]), dtype=numpy.int64 )] )
+        numpy.add.at(counts, amplicon_indices, has_variant[variant_indices])
+
+    amplicons = sorted(amplicon_idx, key=amplicon_idx.get)
+    return amplicons, counts[:len(amplicons)]
 
-    for sample in get_samples(gemini_db):
-        variants = get_query_results(gemini_db, query % sample, gt_filter % (sample, sample))
-        amplicons_count = {}
-        for variant in variants:
-            #print variant
-            amplicons = variant['amplicon'].split(',')
-            for amplicon in amplicons:
-                if amplicon not in amplicons_count:
-                    amplicons_count[amplicon] = 0
-                amplicons_count[amplicon] += 1
+def get_amplicons(gemini_db):
+    """
+    Prints sample, amplicon, count for all samples and amplicons that share more than one variant.
+    """
 
+    amplicons, counts = get_amplicon_counts(gemini_db)
+    sample_to_idx = fast_query.get_sample_indices(gemini_db)
+    for sample in get_samples(gemini_db):
         amplicons_with_multiple_variants = False
-        for amplicon, count in amplicons_count.items():
+        for i, amplicon in enumerate(amplicons):
+            count = counts[i, sample_to_idx[sample]]
             if count > 1:
                 print sample, amplicon, count
                 amplicons_with_multiple_variants = True
@@ -180,58 +388,92 @@ def get_samples(gemini_db):
     return [str(sample['name']) for sample in get_query_results(gemini_db, "select name from samples")]
 
 def has_sample(gemini_db, sample):
-    return int( str( get_query_results(gemini_db, "select count(*) from samples where name='%s'" % sample).next() ) ) != 0
+    return int( str( list( get_query_results(gemini_db, "select count(*) from samples where name='%s'" % sample) )[0] ) ) != 0
 
-def compare_replicates(gemini_db):
+def get_replicate_pairs(samples):
     """
-    Compare all replicates for shared variants and variants likely caused by deamination.
+    Returns list of (original, repeat) sample pairs, where repeat samples have '_Repeats_' in their name and
+    original samples have '_FirstBatch_' in its place.
     """
-
-    query = "SELECT chrom, start, ref, alt, gene, %s, %s FROM variants" 
-    gt_filter = "gt_types.%s == HET or gt_types.%s == HET or gt_types.%s == HOM_ALT or gt_types.%s == HOM_ALT"
-
-    # Loop through samples, querying replicates.
-    samples = get_samples(gemini_db)
+    pairs = []
     for sample in samples:
-        # Only compare repeats.
+        # Only compare repeats that have an original sample.
         if '_Repeats_' not in sample:
             continue
+        sample_original = sample.replace('_Repeats_', '_FirstBatch_')
+        if sample_original in samples:
+            pairs.append( (sample_original, sample) )
+    return pairs
 
-        # Query for variants where one or both samples are alternate.
-        sample_repeat = sample
-        sample_original = sample_repeat.replace('_Repeats_', '_FirstBatch_')
-        sample_repeat_gts = "gts." + sample_repeat
-        sample_original_gts = "gts." + sample_original
-
-        # If original sample is not present, skip.
-        if sample_original not in samples:
-            #print 'No original:', sample_original
-            continue
-
-        #print sample_repeat, sample_original
-        #print query % (sample_original_gts, sample_repeat_gts), gt_filter % (sample_original, sample_repeat, sample_original, sample_repeat)
-
-        variants = get_query_results(gemini_db, query % (sample_original_gts, sample_repeat_gts),
-                                     gt_filter % (sample_original, sample_repeat, sample_original, sample_repeat))
-
-        shared_count = 0
-        unique_count = 0
-        deamination_count = 0
-        for variant in variants:
-            #print variant
-            if variant[sample_original_gts] == variant[sample_repeat_gts]:
-                shared_count += 1
-            elif ( variant['ref'] == 'C' and (variant[sample_original_gts] == 'C/T' or variant[sample_repeat_gts] == 'C/T') ) or \
-                 ( variant['ref'] == 'G' and (variant[sample_original_gts] == 'G/A' or variant[sample_repeat_gts] == 'G/A') ):
-                deamination_count += 1
-            else:
-                # TODO: go back to original sample databases and see if variant exists at some AF (e.g. 5%); if so,
-                # keep variant. Example: 'chr7  116435999' for NATCH_FirstBatch_MRO10434-0022-M01-36124R3 where
-                # FirstBatch AF = 0.06 and Repeats AF = 0.12
-                #print variant
-                unique_count += 1
+def get_replicate_comparisons(gemini_db, lookup=None, min_af=0.05):
+    """
+    Compare all replicates for shared variants and variants likely caused by deamination. Returns a list of
+    (original sample, shared count, deamination count, unique count, rescued count) tuples. Variants are counted
+    for a pair if they are HET or HOM_ALT in either sample; all pairs are compared in a single scan of the variants
+    table.
 
-        print sample_original, shared_count, deamination_count, unique_count
+    If an AFLookup is given, unique variants are rescued if the original sample data of both samples has the
+    allele at AF >= min_af. Otherwise, rescued counts are 0.
+    """
+    pairs = get_replicate_pairs(get_samples(gemini_db))
+    sample_to_idx = fast_query.get_sample_indices(gemini_db)
+    originals = [sample_to_idx[original] for original, repeat in pairs]
+    repeats = [sample_to_idx[repeat] for original, repeat in pairs]
+    shared_counts = numpy.zeros(len(pairs), dtype=numpy.int64)
+    deamination_counts = numpy.zeros(len(pairs), dtype=numpy.int64)
+    variant_counts = numpy.zeros(len(pairs), dtype=numpy.int64)
+    rescued_counts = numpy.zeros(len(pairs), dtype=numpy.int64)
+
+    cols = ['chrom', 'start', 'ref', 'alt'] if lookup else ['ref']
+    for rows, genotypes in fast_query.get_genotype_batches(gemini_db, cols, ['gt_types', 'gts']):
+        gt_types = genotypes['gt_types']
+        has_variant = (gt_types == HET) | (gt_types == HOM_ALT)
+        selected = has_variant[:, originals] | has_variant[:, repeats]
+
+        # Shared variants have the same genotype in both samples.
+        gts_original = genotypes['gts'][:, originals]
+        gts_repeat = genotypes['gts'][:, repeats]
+        shared = gts_original == gts_repeat
+
+        # Deamination causes C>T and G>A changes.
+        ref = numpy.array([row['ref'] for row in rows], dtype=object)[:, numpy.newaxis]
+        deamination = ( (ref == 'C') & ( (gts_original == 'C/T') | (gts_repeat == 'C/T') ) ) | \
+                      ( (ref == 'G') & ( (gts_original == 'G/A') | (gts_repeat == 'G/A') ) )
+
+        variant_counts += selected.sum(axis=0)
+        shared_counts += (selected & shared).sum(axis=0)
+        deamination_counts += (selected & ~shared & deamination).sum(axis=0)
+
+        # Rescue unique variants found in original sample data of both samples, e.g. 'chr7  116435999' for
+        # NATCH_FirstBatch_MRO10434-0022-M01-36124R3 where FirstBatch AF = 0.06 and Repeats AF = 0.12
+        if lookup:
+            variant_indices, pair_indices = numpy.nonzero(selected & ~shared & ~deamination)
+            queries = []
+            for i, j in zip(variant_indices, pair_indices):
+                row = rows[i]
+                alt = row['alt'].split(',')[0]
+                for sample in pairs[j]:
+                    queries.append( (sample, row['chrom'], row['start'] + 1, alt) )
+            afs = lookup.get_afs(queries)
+            for k, j in enumerate(pair_indices):
+                if all(af is not None and af >= min_af for af in afs[2 * k:2 * k + 2]):
+                    rescued_counts[j] += 1
+
+    unique_counts = variant_counts - shared_counts - deamination_counts
+    return [ (original, int(shared_counts[i]), int(deamination_counts[i]), int(unique_counts[i]),
+              int(rescued_counts[i])) for i, (original, repeat) in enumerate(pairs) ]
+
+def compare_replicates(gemini_db, lookup=None, min_af=0.05):
+    """
+    Compare all replicates for shared variants and variants likely caused by deamination and, if an AFLookup is
+    given, unique variants rescued from original sample data.
+    """
+    for sample_original, shared_count, deamination_count, unique_count, rescued_count in \
+        get_replicate_comparisons(gemini_db, lookup, min_af):
+        if lookup:
+            print sample_original, shared_count, deamination_count, unique_count, rescued_count
+        else:
+            print sample_original, shared_count, deamination_count, unique_count
 
 def query_sample_het(gemini_db, sample, cols="chrom, start, end, ref, alt, gene, cosmic_ids", min_het_count=0, addl_gt_filter=None):
     """
@@ -244,64 +486,440 @@ def query_sample_het(gemini_db, sample, cols="chrom, start, end, ref, alt, gene,
         gt_filter += ' and %s' % addl_gt_filter
     return get_query_results(gemini_db, query, gt_filter)
 
-def get_query_results(gemini_db, query, gt_filter="", out_format=DefaultRowFormat(None)):
+def run_query(gemini_db, query, gt_filter="", out_format=DefaultRowFormat(None)):
     """
-    Returns results of query.
+    Returns results of query without using the cache.
     """
 
+    # Use fast path for genotype filters if possible.
+    if gt_filter and QUERY_ENGINE != 'gemini' and out_format.name == 'default':
+        try:
+            results = fast_query.run(gemini_db, query, gt_filter)
+        except ValueError:
+            results = None
+        if results is not None:
+            if QUERY_ENGINE == 'parity':
+                results = list(results)
+                fast_only, gemini_only = fast_query.check_parity(gemini_db, query, gt_filter, results)
+                if fast_only or gemini_only:
+                    raise ValueError("Fast query results differ from GEMINI (%i fast only, %i GEMINI only) for "
+                                     "query '%s' and gt_filter '%s'" % (len(fast_only), len(gemini_only), query,
+                                                                        gt_filter))
+            return results
+
     gemini = GeminiQuery(gemini_db, out_format=out_format)
     gemini.run(query, gt_filter=gt_filter)
     return gemini
 
+def get_query_results(gemini_db, query, gt_filter="", out_format=DefaultRowFormat(None)):
+    """
+    Returns results of query, using QUERY_CACHE if it is set and recording the query with QUERY_PROFILER if it is
+    set.
+    """
+    if QUERY_PROFILER is not None:
+        return QUERY_PROFILER.profile_query(gemini_db, query, gt_filter,
+                                            lambda: get_cached_results(gemini_db, query, gt_filter, out_format))
+    return get_cached_results(gemini_db, query, gt_filter, out_format)
+
+def get_cached_results(gemini_db, query, gt_filter="", out_format=DefaultRowFormat(None)):
+    """
+    Returns results of query, using QUERY_CACHE if it is set.
+    """
+    if QUERY_CACHE is None:
+        return run_query(gemini_db, query, gt_filter, out_format)
+
+    key = query_cache.get_cache_key(gemini_db, query, gt_filter, out_format.name)
+    rows = QUERY_CACHE.get(key)
+    if rows is not None:
+        return iter(rows)
+    return QUERY_CACHE.cache_results(key, run_query(gemini_db, query, gt_filter, out_format))
+
+def get_db_name(gemini_db):
+    """
+    Returns name of a database file without directory and extension.
+    """
+    return os.path.splitext( os.path.split(gemini_db)[1] )[0]
+
+def get_vcf_header(gemini_db):
+    """
+    Returns VCF header of a database.
+    """
+    simple_struct = namedtuple('Simple', 'db')
+    return VCFRowFormat(simple_struct(db=gemini_db)).header(None)
+
+def get_uncached_results(gemini_db, query, gt_filter="", out_format=DefaultRowFormat(None)):
+    """
+    Returns results of query without using QUERY_CACHE, recording the query with QUERY_PROFILER if it is set. Used
+    for streams of results that are read once, so that caching does not hold them in memory.
+    """
+    if QUERY_PROFILER is not None:
+        return QUERY_PROFILER.profile_query(gemini_db, query, gt_filter,
+                                            lambda: run_query(gemini_db, query, gt_filter, out_format))
+    return run_query(gemini_db, query, gt_filter, out_format)
+
+def get_sqlite_results(conn, gemini_db, query):
+    """
+    Returns rows of a query on a sqlite3 connection, recording the query with QUERY_PROFILER if it is set.
+    """
+    if QUERY_PROFILER is not None:
+        return QUERY_PROFILER.profile_query(gemini_db, query, None, lambda: conn.execute(query))
+    return conn.execute(query)
+
+def get_somatic_variant_ids(gemini_db, annotations, contig_order=None, hotspot_allele_bal=0.02,
+                            novel_allele_bal=0.1):
+    """
+    Yields (variant_id, categories) for somatic variants in a database, sorted by chrom and start position, where
+    categories are all somatic categories of the variant.
+
+    Variants are classified with one query for each chromosome, ordered by start position (which GEMINI indexes),
+    on a plain sqlite3 connection, so no genotypes are read and memory does not grow with the number of variants.
+    Chromosomes are ordered by contig_order, then naturally (1-22, X, Y, M). Rows for the same chrom, start, ref
+    and alt are combined, keeping the first variant_id.
+    """
+    categories = get_somatic_categories(annotations)
+    conn = sqlite3.connect(gemini_db)
+    conn.row_factory = sqlite3.Row
+    chroms = [ str(row['chrom']) for row in conn.execute("select distinct chrom from variants") ]
+    chroms.sort(key=lambda chrom: vcf_merge.get_chrom_sort_key(chrom, contig_order))
+
+    query = get_somatic_query(annotations, hotspot_allele_bal, novel_allele_bal)
+    for chrom in chroms:
+        # Combine rows at each position, keeping variants in the order they are read.
+        position = None
+        variants = OrderedDict()
+        for row in get_sqlite_results(conn, gemini_db,
+                                      "%s AND chrom = '%s' ORDER BY start, variant_id" % (query, chrom)):
+            row_categories = classify_somatic_variant(row, annotations, hotspot_allele_bal, novel_allele_bal)
+            if not row_categories:
+                continue
+            if row['start'] != position:
+                for variant_id, variant_categories in variants.itervalues():
+                    yield variant_id, [category for category in categories if category in variant_categories]
+                position = row['start']
+                variants = OrderedDict()
+            key = (row['ref'], row['alt'])
+            if key in variants:
+                variants[key][1].update(row_categories)
+            else:
+                variants[key] = ( row['variant_id'], set(row_categories) )
+        for variant_id, variant_categories in variants.itervalues():
+            yield variant_id, [category for category in categories if category in variant_categories]
+    conn.close()
+
+def get_somatic_results(gemini_db, annotations, contig_order=None, out_format=DefaultRowFormat(None),
+                        hotspot_allele_bal=0.02, novel_allele_bal=0.1, chunk_size=5000):
+    """
+    Yields (result, categories) for somatic variants in a database, sorted by chrom and start position, where
+    result is formatted with out_format and categories are all somatic categories of the variant.
+
+    Variants are classified with get_somatic_variant_ids, and only somatic variants are then read with GeminiQuery
+    and formatted, chunk_size variants at a time. Memory is bounded by chunk_size: results bypass QUERY_CACHE,
+    which would otherwise hold them.
+    """
+    variants = get_somatic_variant_ids(gemini_db, annotations, contig_order, hotspot_allele_bal, novel_allele_bal)
+    while True:
+        chunk = list( itertools.islice(variants, chunk_size) )
+        if not chunk:
+            break
+        ids = ",".join( str(variant_id) for variant_id, variant_categories in chunk )
+        results = dict( (row['variant_id'], str(row)) for row in
+                        get_uncached_results(gemini_db, "select variant_id, chrom, start, end, ref, alt from variants "
+                                             "WHERE variant_id IN (%s)" % ids, out_format=out_format) )
+        for variant_id, variant_categories in chunk:
+            yield results[variant_id], variant_categories
+
+def write_somatic_variants(gemini_db, annotations, output_vcf, output_categories=None, contig_order=None,
+                           merge_mnps=False):
+    """
+    Writes somatic variants in a database to a VCF sorted by chrom and start position and, optionally, the
+    categories of each variant to output_categories. Returns counts for all hotspot and novel variants.
+
+    Variants are streamed from the database in sorted order (see get_somatic_results) and written as they are
+    read, without being cached. Contigs are ordered by contig_order, or by the VCF header if None, then naturally
+    (1-22, X, Y, M). If merge_mnps is set, adjacent SNVs are merged into MNPs and counts are for merged variants.
+    """
+    # Set up VCF formatter.
+    simple_struct = namedtuple('Simple', 'db')
+    vcf_format = VCFRowFormat(simple_struct(db=gemini_db))
+    header = vcf_format.header(None)
+    if contig_order is None:
+        contig_order = vcf_merge.get_header_contig_order(header)
+    output = open(output_vcf, 'w')
+    output.write(header + '\n')
+
+    categories = get_somatic_categories(annotations)
+    category_idx = dict( (category, i) for i, category in enumerate(categories) )
+    counts = [0] * len(categories)
+    results = get_somatic_results(gemini_db, annotations, contig_order, vcf_format)
+
+    # Merge adjacent SNVs into MNPs.
+    if merge_mnps:
+        results = merge_somatic_mnps(results, categories)
+
+    # Write somatic variants VCF and categories for each variant, and count variants.
+    categories_output = None
+    if output_categories:
+        categories_output = open(output_categories, 'w')
+        categories_output.write('#CHROM\tPOS\tREF\tALT\tCATEGORIES\n')
+    for variant, variant_categories in results:
+        output.write(variant + '\n')
+        if categories_output:
+            fields = variant.split('\t', 5)
+            categories_output.write( "%s\t%s\t%s\t%s\t%s\n" % ( fields[0], fields[1], fields[3], fields[4],
+                                                                  ','.join(variant_categories) ) )
+        for category in variant_categories:
+            counts[category_idx[category]] += 1
+    if categories_output:
+        categories_output.close()
+    output.close()
+    return counts
+
+def read_vcf_records(vcf_path, vcf_index, contig_order=None):
+    """
+    Yields (sort key, vcf_index, line) for records in a sorted VCF.
+    """
+    for line in open(vcf_path):
+        if not line.startswith('#'):
+            line = line.rstrip('\r\n')
+            yield (vcf_merge.get_vcf_line_key(line, contig_order), vcf_index, line)
+
+def get_header_line_id(line):
+    """
+    Returns ID of a ##INFO, ##FORMAT, ##FILTER or ##contig header line as (type, ID), or the line if it has none.
+    """
+    if line.startswith( ('##INFO=<', '##FORMAT=<', '##FILTER=<', '##contig=<') ):
+        return ( line[:line.index('<')], line[line.index('<') + 1:].split(',')[0] )
+    return line
+
+def get_genotype_values(fields, num_samples):
+    """
+    Returns list of dictionaries of FORMAT key to value for the samples of a VCF record.
+    """
+    keys = fields[8].split(':') if len(fields) > 8 else []
+    return [ dict( zip(keys, value.split(':')) ) for value in fields[9:9 + num_samples] ]
+
+def merge_somatic_vcfs(vcf_paths, output_vcf, contig_order=None):
+    """
+    Merges sorted VCFs into one multi-sample VCF, like bcftools merge: records with the same position and alleles
+    are combined, and samples without a record get './.' genotypes. Samples are merged by name, so a sample in
+    several VCFs has one column, with its values from the first VCF with the record. FORMAT keys are merged in
+    order of appearance and missing values are '.'. Other columns come from the first VCF with the record, and
+    header lines come from the first VCF, followed by INFO, FORMAT, FILTER and contig lines only in later VCFs.
+    Raises ValueError for a VCF without a #CHROM header line, e.g. one left empty or truncated by a failed worker.
+    """
+    # Merge headers and samples of all VCFs.
+    header = []
+    header_ids = set()
+    vcf_samples = []
+    samples = OrderedDict()
+    for i, vcf_path in enumerate(vcf_paths):
+        for line in open(vcf_path):
+            line = line.rstrip('\r\n')
+            fields = line.split('\t')
+            if line.startswith('#CHROM'):
+                vcf_samples.append(fields[9:])
+                for sample in fields[9:]:
+                    samples.setdefault(sample, len(samples))
+                if i == 0:
+                    columns = fields[:9]
+                break
+            if not line.startswith('##'):
+                break
+            line_id = get_header_line_id(line)
+            if i == 0 or (line_id not in header_ids and isinstance(line_id, tuple)):
+                header.append(line)
+                header_ids.add(line_id)
+        if len(vcf_samples) != i + 1:
+            raise ValueError("%s has no #CHROM header line; it may be empty or truncated" % vcf_path)
+    header.append( '\t'.join( columns + list(samples) ) )
+    if contig_order is None:
+        contig_order = vcf_merge.get_header_contig_order('\n'.join(header))
+
+    output = open(output_vcf, 'w')
+    output.write('\n'.join(header) + '\n')
+    records = vcf_merge.merge_sorted([ read_vcf_records(vcf_path, i, contig_order)
+                                       for i, vcf_path in enumerate(vcf_paths) ])
+    for key, position_records in itertools.groupby(records, key=lambda record: record[0]):
+        # Combine records with the same alleles, in order of first appearance.
+        alleles = OrderedDict()
+        for key, i, line in position_records:
+            fields = line.split('\t')
+            alleles.setdefault( (fields[3], fields[4]), [None] * len(vcf_paths) )[i] = fields
+        for allele_records in alleles.values():
+            first = [fields for fields in allele_records if fields][0]
+            format_keys = []
+            values = [None] * len(samples)
+            for i, fields in enumerate(allele_records):
+                if not fields:
+                    continue
+                for format_key in fields[8].split(':') if len(fields) > 8 else []:
+                    if format_key not in format_keys:
+                        format_keys.append(format_key)
+                for sample, sample_values in zip( vcf_samples[i], get_genotype_values(fields, len(vcf_samples[i])) ):
+                    if values[ samples[sample] ] is None:
+                        values[ samples[sample] ] = sample_values
+            missing = './.' if format_keys[:1] == ['GT'] else '.'
+            genotypes = [ ':'.join( sample_values.get(format_key, '.') for format_key in format_keys )
+                          if sample_values is not None else missing for sample_values in values ]
+            output.write( '\t'.join(first[:8] + [':'.join(format_keys) or '.'] + genotypes) + '\n' )
+    output.close()
+
+# AnnotationIndex used by find_somatic_all workers to annotate databases. It is set before the worker pool is
+# created so that it is loaded once and shared with workers.
+ANNOTATION_INDEX = None
+
+def find_somatic_worker(task):
+    """
+    Annotates a database if ANNOTATION_INDEX is set and writes its somatic variants. Returns ((database name,
+    counts), query records), where query records are those added to QUERY_PROFILER by this task.
+    """
+    gemini_db, annotations, output_vcf, contig_order, merge_mnps = task
+    first_query = len(QUERY_PROFILER.queries) if QUERY_PROFILER is not None else 0
+    if ANNOTATION_INDEX is not None:
+        annotate_gemini_db.annotate_gemini_db_with_index(gemini_db, ANNOTATION_INDEX)
+    counts = write_somatic_variants(gemini_db, annotations, output_vcf, None, contig_order, merge_mnps)
+    queries = QUERY_PROFILER.queries[first_query:] if QUERY_PROFILER is not None else []
+    return (get_db_name(gemini_db), counts), queries
+
+def find_somatic_all(gemini_dbs, annotations, output_vcf, output_dir='.', annotation_index=None, genome_file=None,
+                     merge_mnps=False, processes=None):
+    """
+    Finds somatic variants in many databases using a process pool with one process per core by default. Each
+    worker writes its database's variants to <output_dir>/<database name>_somatic.vcf, so workers do not share an
+    output file, and the parent then merges these VCFs into output_vcf (see merge_somatic_vcfs). The per-database
+    VCFs are kept, as find_somatic_with_gemini.sh kept them, so that each database's variants can be inspected.
+    If annotation_index is given, each database is first annotated with it. Returns list of (database name, counts)
+    tuples sorted by database name.
+    """
+    global ANNOTATION_INDEX
+
+    # Use the same contig order for all databases so that their variants can be merged.
+    if genome_file:
+        contig_order = vcf_merge.get_contig_order(genome_file)
+    else:
+        contig_order = vcf_merge.get_header_contig_order(get_vcf_header(gemini_dbs[0]))
+
+    vcf_paths = [ os.path.join(output_dir, '%s_somatic.vcf' % get_db_name(gemini_db)) for gemini_db in gemini_dbs ]
+    tasks = [ (gemini_db, annotations, vcf_path, contig_order, merge_mnps)
+              for gemini_db, vcf_path in zip(gemini_dbs, vcf_paths) ]
+    processes = min(processes or multiprocessing.cpu_count(), len(tasks))
+    ANNOTATION_INDEX = annotation_index
+    try:
+        if processes > 1:
+            pool = multiprocessing.Pool(processes)
+            worker_results = pool.map(find_somatic_worker, tasks, chunksize=1)
+            pool.close()
+            pool.join()
+
+            # Queries were recorded by the workers' copies of the profiler.
+            if QUERY_PROFILER is not None:
+                for result, queries in worker_results:
+                    QUERY_PROFILER.add_queries(queries)
+        else:
+            worker_results = [ find_somatic_worker(task) for task in tasks ]
+    finally:
+        ANNOTATION_INDEX = None
+    results = [ result for result, queries in worker_results ]
+
+    merge_somatic_vcfs(vcf_paths, output_vcf, contig_order)
+    return sorted(results)
+
 if __name__ == "__main__":
     # Argument setup and parsing.
     parser = argparse.ArgumentParser()
     parser.add_argument("operation", help="Operation to perform")
-    parser.add_argument("gemini_db", help="Gemini database to use")
+    parser.add_argument("gemini_dbs", nargs="+", help="Gemini database(s) to use; find_somatic_all uses all")
     parser.add_argument("--sample", help="Sample to query for")
     parser.add_argument("--cols", help="Columns to query for")
     parser.add_argument("--gt_count", help="Minimum HET count")
     parser.add_argument("--annotations", help="Annotations to query for")
     parser.add_argument("--output_vcf", help="Write variants to this file")
+    parser.add_argument("--output_dir", default=".", help="Write VCF for each database to this directory")
+    parser.add_argument("--annotations_dir",
+                        help="Annotate databases with <annotations_dir>/*/*.vcf.gz and use them as annotations")
+    parser.add_argument("--processes", type=int, help="Number of databases to process in parallel (default: cores)")
+    parser.add_argument("--output_categories", help="Write somatic categories of each variant to this file")
     parser.add_argument("--header", action="store_true", help="Print header?")
+    parser.add_argument("--no_timings", action="store_true", help="Do not time queries when preparing a database")
+    parser.add_argument("--genome_file", help="Order contigs in output VCF using this .fai or genome.len file")
+    parser.add_argument("--merge_mnps", action="store_true",
+                        help="Merge adjacent SNVs with consistent genotypes into MNPs before counting")
+    parser.add_argument("--af_files", nargs="+",
+                        help="Per-sample VCFs (plain, gzip'ed or bgzip'ed) used to rescue unique replicate variants")
+    parser.add_argument("--af_field", default="AF", help="FORMAT or INFO field with allele frequency")
+    parser.add_argument("--min_af", type=float, default=0.05, help="Minimum AF to rescue a unique replicate variant")
+    parser.add_argument("--query_engine", choices=["gemini", "fast", "parity"], default="gemini",
+                        help="Engine for genotype-filtered queries")
+    parser.add_argument("--cache", action="store_true", help="Cache query results in memory")
+    parser.add_argument("--cache_dir", help="Also cache query results in this directory")
+    parser.add_argument("--cache_rows", type=int, default=100000, help="Maximum number of rows to cache in memory")
+    parser.add_argument("--profile", choices=["jsonl", "summary"],
+                        help="Record time, rows and peak RSS of each query and write them as JSON lines or a summary")
+    parser.add_argument("--profile_output", help="Write profile to this file (default: standard error)")
+    parser.add_argument("--profile_cprofile", help="Write cProfile statistics for reading query results to this file")
     args = parser.parse_args()
     operation = args.operation
-    gemini_db = args.gemini_db
+    gemini_db = args.gemini_dbs[0]
+    QUERY_ENGINE = args.query_engine
+    if args.cache or args.cache_dir:
+        QUERY_CACHE = query_cache.QueryCache(max_rows=args.cache_rows, cache_dir=args.cache_dir)
+    if args.profile:
+        profile_output = open(args.profile_output, 'w') if args.profile_output else sys.stderr
+        QUERY_PROFILER = query_profiler.QueryProfiler(profile_output, args.profile, args.profile_cprofile)
+        QUERY_PROFILER.start_operation(operation)
     
     # Do operation.
     if operation == "find_somatic":
         annotations = args.annotations.split(',')
-        db_name, ext = os.path.splitext( os.path.split(gemini_db)[1] )
-        output = open(args.output_vcf, 'w')
-
-        # Set up VCF formatter.
-        simple_struct = namedtuple('Simple', 'db')
-        vcf_format = VCFRowFormat(simple_struct(db=gemini_db))
-        output.write(vcf_format.header(None) + '\n')
-
-        # Get counts, variants.
-        counts, variants = get_somatic_variants(gemini_db, annotations, out_format=vcf_format)
-
-        # Sort variants by chrom and start position.
-        def get_chrom_and_start(v):
-            fields = v.split('\t')
-            return (int(fields[0][3:]), int(fields[1]))
-        variants.sort(key=get_chrom_and_start)
-        
+        contig_order = vcf_merge.get_contig_order(args.genome_file) if args.genome_file else None
+        counts = write_somatic_variants(gemini_db, annotations, args.output_vcf, args.output_categories,
+                                        contig_order, args.merge_mnps)
+
         # Print header?
         if args.header:
             print '#Sample %s Novel_SNPS Novel_Indels' % ' '.join(annotations)
 
         # Print output of variant counts.
-        print '%s %s' % ( db_name, ' '.join(str(c) for c in counts) )
-
-        # Print somatic variants VCF.
-        for variant in variants:
-            output.write(variant + '\n')
+        print '%s %s' % ( get_db_name(gemini_db), ' '.join(str(c) for c in counts) )
+    elif operation == "find_somatic_all":
+        index = None
+        if args.annotations_dir:
+            annotation_files = annotate_gemini_db.get_annotation_files(args.annotations_dir)
+            index = annotate_gemini_db.get_annotation_index(annotation_files)
+            annotations = index.names
+        else:
+            annotations = args.annotations.split(',')
+        results = find_somatic_all(args.gemini_dbs, annotations, args.output_vcf, args.output_dir, index,
+                                   args.genome_file, args.merge_mnps, args.processes)
 
-        output.close()
+        # Print counts for all databases.
+        if args.header:
+            print '#Sample %s Novel_SNPS Novel_Indels' % ' '.join(annotations)
+        for db_name, counts in results:
+            print '%s %s' % ( db_name, ' '.join(str(c) for c in counts) )
+    elif operation == "prepare":
+        if args.annotations_dir:
+            annotation_files = annotate_gemini_db.get_annotation_files(args.annotations_dir)
+            annotations = [ annotate_gemini_db.get_annotation_name(path) for path in annotation_files ]
+        else:
+            annotations = args.annotations.split(',')
+
+        # Print plan and timing of each query before and after creating indexes.
+        print '\t'.join(['query', 'plan_before', 'plan_after', 'seconds_before', 'seconds_after', 'rows'])
+        for report in prepare_gemini_db(gemini_db, annotations, not args.no_timings):
+            seconds = [ '%.3f' % s if s is not None else '.' for s in [report.seconds_before, report.seconds_after] ]
+            print '\t'.join( [report.name, '; '.join(report.plan_before), '; '.join(report.plan_after)] + seconds +
+                             [str(report.rows_after) if report.rows_after is not None else '.'] )
+            if query_advisor.is_full_scan(report.plan_after):
+                sys.stderr.write("Warning: %s query still scans variants table\n" % report.name)
+            if report.rows_before != report.rows_after:
+                sys.stderr.write("Warning: %s query returned %s rows before and %s after creating indexes\n" %
+                                 (report.name, report.rows_before, report.rows_after))
     elif operation == "compare_replicates":
-        print "TODO: connect to function"
+        lookup = None
+        if args.af_files:
+            lookup = af_lookup.AFLookup(af_lookup.get_sample_files(args.af_files), args.af_field)
+        compare_replicates(gemini_db, lookup, args.min_af)
     elif operation == "print_samples":
         for sample in get_samples(gemini_db):
             print sample
@@ -313,4 +931,11 @@ if __name__ == "__main__":
         for row in query_sample_het(gemini_db, sample, cols, gt_count):
             print row
 
+    # Write profile.
+    if QUERY_PROFILER is not None:
+        QUERY_PROFILER.end_operation()
+        QUERY_PROFILER.close()
 
+    # Print cache statistics.
+    if QUERY_CACHE is not None:
+        sys.stderr.write( 'Query cache: %s\n' % ', '.join('%s=%i' % item for item in QUERY_CACHE.get_stats().items()) )
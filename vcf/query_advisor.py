@@ -0,0 +1,97 @@
+"""
+Create indexes for the queries that gemini_operations runs and check that SQLite uses them.
+
+Indexes are partial indexes whose WHERE clause is a clause that the queries share (e.g. the clause that removes
+common variants), so they hold only the rows those queries can return. SQLite only uses a partial index when the
+query contains the index's WHERE clause term for term, so callers should build both from the same functions.
+EXPLAIN QUERY PLAN and timings of each query are recorded before and after the indexes are created.
+"""
+
+import sqlite3
+import time
+
+from collections import namedtuple
+
+# Index on table(columns), optionally partial with a WHERE clause.
+Index = namedtuple('Index', ['name', 'table', 'columns', 'where'])
+
+# Result of preparing a query: plans are lists of EXPLAIN QUERY PLAN details.
+QueryReport = namedtuple('QueryReport', ['name', 'plan_before', 'plan_after', 'seconds_before', 'seconds_after',
+                                         'rows_before', 'rows_after'])
+
+def get_index_sql(index):
+    """
+    Returns CREATE INDEX statement for an index.
+    """
+    sql = 'CREATE INDEX %s ON %s (%s)' % ( index.name, index.table, ', '.join(index.columns) )
+    if index.where:
+        sql += ' WHERE %s' % index.where
+    return sql
+
+def get_query_plan(conn, query):
+    """
+    Returns list of EXPLAIN QUERY PLAN details for a query.
+    """
+    return [ str(row[-1]) for row in conn.execute('EXPLAIN QUERY PLAN %s' % query) ]
+
+def is_full_scan(plan):
+    """
+    Returns true if a query plan scans a table without an index.
+    """
+    return any( detail.startswith('SCAN') and 'INDEX' not in detail for detail in plan )
+
+def time_query(conn, query):
+    """
+    Returns (seconds, rows) to run a query and fetch all of its rows.
+    """
+    start = time.time()
+    rows = sum(1 for row in conn.execute(query))
+    return time.time() - start, rows
+
+def create_indexes(conn, indexes, prefix=None):
+    """
+    Creates indexes that do not exist, replacing indexes of the same name with a different definition, and
+    updates planner statistics. If prefix is given, other indexes whose name starts with prefix are dropped.
+    Returns names of indexes created.
+    """
+    existing = dict( conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index'") )
+    names = set(index.name for index in indexes)
+    for name in existing:
+        if prefix and name.startswith(prefix) and name not in names:
+            conn.execute('DROP INDEX %s' % name)
+
+    created = []
+    for index in indexes:
+        sql = get_index_sql(index)
+        if existing.get(index.name) == sql:
+            continue
+        if index.name in existing:
+            conn.execute('DROP INDEX %s' % index.name)
+        conn.execute(sql)
+        created.append(index.name)
+    if created:
+        conn.execute('ANALYZE')
+    conn.commit()
+    return created
+
+def prepare_db(db, indexes, queries, prefix=None, timings=True):
+    """
+    Creates indexes in a database (see create_indexes) and returns a QueryReport for each (name, query) in
+    queries. Timings and row counts are None if timings is False.
+    """
+    conn = sqlite3.connect(db)
+
+    def check_queries():
+        results = []
+        for name, query in queries:
+            seconds, rows = time_query(conn, query) if timings else (None, None)
+            results.append( (get_query_plan(conn, query), seconds, rows) )
+        return results
+
+    before = check_queries()
+    create_indexes(conn, indexes, prefix)
+    after = check_queries()
+    conn.close()
+    return [ QueryReport(name, plan_before, plan_after, seconds_before, seconds_after, rows_before, rows_after)
+             for (name, query), (plan_before, seconds_before, rows_before), (plan_after, seconds_after, rows_after)
+             in zip(queries, before, after) ]
@@ -0,0 +1,158 @@
+"""
+Cache for GEMINI query results.
+
+Results are kept in an in-memory LRU bounded by the total number of cached rows, with an optional on-disk tier
+bounded by total bytes. Keys include the database path, modification time and size so that results are
+invalidated when a database changes.
+"""
+
+import cPickle
+import hashlib
+import os
+
+from collections import OrderedDict
+
+class CachedRow(OrderedDict):
+    """
+    Cached query result; prints like the row it was created from.
+    """
+    def __init__(self, items=(), formatted=''):
+        OrderedDict.__init__(self, items)
+        self.formatted = formatted
+
+    def __str__(self):
+        return self.formatted
+
+    def __reduce__(self):
+        return (CachedRow, (self.items(), self.formatted))
+
+def to_cached_row(row):
+    """
+    Returns CachedRow for a GeminiRow or fast_query row. Blob columns are not kept.
+    """
+    if hasattr(row, 'print_fields'):
+        # GeminiRow: keep database columns and printed fields, e.g. gts.<sample>.
+        items = [ (key, row.row[key]) for key in row.row.keys() if not isinstance(row.row[key], buffer) ]
+        items += list(row.print_fields.items())
+    else:
+        items = row.items()
+    return CachedRow(items, str(row))
+
+def get_cache_key(gemini_db, query, gt_filter, out_format_name):
+    """
+    Returns cache key for a query; the key changes when the database file changes.
+    """
+    stat = os.stat(gemini_db)
+    return (os.path.abspath(gemini_db), stat.st_mtime, stat.st_size, query, gt_filter or '', out_format_name)
+
+class QueryCache(object):
+    """
+    LRU cache of query results with an optional on-disk tier.
+
+    max_rows - maximum number of rows held in memory; results with more rows are not cached
+    cache_dir - directory for on-disk tier; if None, only memory is used
+    max_disk_bytes - maximum total size of on-disk tier
+    """
+    def __init__(self, max_rows=1000000, cache_dir=None, max_disk_bytes=1 << 30):
+        self.max_rows = max_rows
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()
+        self.num_rows = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get_stats(self):
+        """
+        Returns dictionary of cache statistics.
+        """
+        return OrderedDict([ ('memory_hits', self.memory_hits), ('disk_hits', self.disk_hits),
+                             ('misses', self.misses), ('evictions', self.evictions),
+                             ('entries', len(self.entries)), ('rows', self.num_rows) ])
+
+    def _get_path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(repr(key)).hexdigest() + '.pkl')
+
+    def get(self, key):
+        """
+        Returns list of cached rows for key or None.
+        """
+        if key in self.entries:
+            rows = self.entries.pop(key)
+            self.entries[key] = rows
+            self.memory_hits += 1
+            return rows
+
+        if self.cache_dir:
+            path = self._get_path(key)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    rows = cPickle.load(f)
+                os.utime(path, None)
+                self._put_memory(key, rows)
+                self.disk_hits += 1
+                return rows
+
+        self.misses += 1
+        return None
+
+    def put(self, key, rows):
+        """
+        Caches rows for key.
+        """
+        if len(rows) > self.max_rows:
+            return
+        self._put_memory(key, rows)
+        if self.cache_dir:
+            path = self._get_path(key)
+            with open(path + '.tmp', 'wb') as f:
+                cPickle.dump(rows, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(path + '.tmp', path)
+            self._evict_disk()
+
+    def _put_memory(self, key, rows):
+        if key in self.entries:
+            self.num_rows -= len(self.entries.pop(key))
+        self.entries[key] = rows
+        self.num_rows += len(rows)
+        while self.num_rows > self.max_rows:
+            evicted_key, evicted_rows = self.entries.popitem(last=False)
+            self.num_rows -= len(evicted_rows)
+            self.evictions += 1
+
+    def _evict_disk(self):
+        """
+        Removes least recently used files until on-disk tier is within max_disk_bytes.
+        """
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.pkl'):
+                path = os.path.join(self.cache_dir, name)
+                stat = os.stat(path)
+                files.append( (stat.st_atime, stat.st_mtime, stat.st_size, path) )
+        total = sum(f[2] for f in files)
+        for atime, mtime, size, path in sorted(files, key=lambda f: max(f[0], f[1])):
+            if total <= self.max_disk_bytes:
+                break
+            os.remove(path)
+            total -= size
+            self.evictions += 1
+
+    def cache_results(self, key, results):
+        """
+        Yields results, caching them under key once all have been read. Results with more than max_rows rows
+        are yielded without being cached.
+        """
+        rows = []
+        for row in results:
+            if rows is not None:
+                rows.append(to_cached_row(row))
+                if len(rows) > self.max_rows:
+                    rows = None
+            yield row
+        if rows is not None:
+            self.put(key, rows)
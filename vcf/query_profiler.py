@@ -0,0 +1,158 @@
+"""
+Instrumentation for GEMINI queries.
+
+QueryProfiler wraps query construction and iteration and records, for each query, the SQL and gt_filter, the time
+to build the query, the time to the first row, the total time, the number of rows, rows/second and the peak RSS of
+the process. Totals are also recorded for each operation. Records are written as JSON lines when they complete or
+as a summary table when the profiler is closed. Worker processes forked with a profiler write JSON lines for their
+queries themselves; their records are then passed back to the parent's profiler with add_queries so that the summary
+and operation totals include them.
+
+Optionally, cProfile is enabled only while query results are being read, i.e. for the loops that consume query
+results, and its statistics are written to a file that can be read with pstats. cProfile statistics cover only the
+process that closes the profiler.
+"""
+
+import cProfile
+import json
+import resource
+import sys
+import time
+
+from collections import OrderedDict
+
+def get_peak_rss_kb():
+    """
+    Returns peak resident set size of the process in KB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on OS X and KB on Linux.
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+class QueryProfiler(object):
+    """
+    Records timings of queries and operations.
+
+    output - file to write records to
+    output_format - 'jsonl' to write a JSON line for each query and operation, 'summary' to write a table on close
+    cprofile_path - if given, write cProfile statistics for reading query results to this file
+    """
+    def __init__(self, output=sys.stderr, output_format='jsonl', cprofile_path=None):
+        self.output = output
+        self.output_format = output_format
+        self.cprofile_path = cprofile_path
+        self.cprofile = cProfile.Profile() if cprofile_path else None
+        self.active = 0
+        self.queries = []
+        self.operations = []
+        self.operation = None
+
+    def _write(self, record):
+        if self.output_format == 'jsonl':
+            self.output.write(json.dumps(record) + '\n')
+            self.output.flush()
+
+    def start_operation(self, name):
+        """
+        Starts recording totals for an operation; queries are attributed to the current operation.
+        """
+        self.operation = OrderedDict([ ('type', 'operation'), ('operation', name), ('start', time.time()),
+                                       ('seconds', None), ('queries', 0), ('rows', 0), ('peak_rss_kb', None) ])
+
+    def end_operation(self):
+        """
+        Completes recording of the current operation.
+        """
+        record = self.operation
+        record['seconds'] = time.time() - record.pop('start')
+        record['peak_rss_kb'] = get_peak_rss_kb()
+        self.operations.append(record)
+        self._write(record)
+        self.operation = None
+
+    def profile_query(self, gemini_db, query, gt_filter, run):
+        """
+        Returns results of run(), a function that builds a query and returns an iterator of its results, recording
+        the query as results are read.
+        """
+        record = OrderedDict([ ('type', 'query'), ('operation', self.operation['operation'] if self.operation else None),
+                               ('db', gemini_db), ('sql', query), ('gt_filter', gt_filter or None) ])
+        start = time.time()
+        results = run()
+        record['build_seconds'] = time.time() - start
+        return self._iterate(record, results, start)
+
+    def _iterate(self, record, results, start):
+        rows = 0
+        first_row_seconds = None
+        self._enable_cprofile()
+        try:
+            for result in results:
+                if rows == 0:
+                    first_row_seconds = time.time() - start
+                rows += 1
+                yield result
+        finally:
+            self._disable_cprofile()
+            seconds = time.time() - start
+            record['first_row_seconds'] = first_row_seconds
+            record['seconds'] = seconds
+            record['rows'] = rows
+            record['rows_per_second'] = rows / seconds if seconds > 0 else None
+            record['peak_rss_kb'] = get_peak_rss_kb()
+            self.queries.append(record)
+            if self.operation:
+                self.operation['queries'] += 1
+                self.operation['rows'] += rows
+            self._write(record)
+
+    def add_queries(self, records):
+        """
+        Adds query records from another process (e.g. a worker) to the queries and the current operation. Records are
+        not written again; in 'jsonl' format the other process has already written them.
+        """
+        for record in records:
+            self.queries.append(record)
+            if self.operation:
+                self.operation['queries'] += 1
+                self.operation['rows'] += record['rows']
+
+    def _enable_cprofile(self):
+        # Queries may be read while other queries are being read, so only the outermost enables cProfile.
+        if self.cprofile:
+            if self.active == 0:
+                self.cprofile.enable()
+            self.active += 1
+
+    def _disable_cprofile(self):
+        if self.cprofile:
+            self.active -= 1
+            if self.active == 0:
+                self.cprofile.disable()
+
+    def write_summary(self):
+        """
+        Writes table of queries and operations.
+        """
+        self.output.write( '%-20s %10s %10s %10s %12s %12s  %s\n' % ('operation', 'rows', 'first_row', 'seconds',
+                                                                    'rows/s', 'peak_rss_kb', 'query') )
+        for record in self.queries + self.operations:
+            query = record.get('sql', '')
+            if record.get('gt_filter'):
+                query += ' [%s]' % record['gt_filter']
+            self.output.write( '%-20s %10i %10s %10.3f %12s %12i  %s\n' %
+                               ( record['operation'], record['rows'],
+                                 '%.3f' % record['first_row_seconds'] if record.get('first_row_seconds') is not None
+                                 else '.',
+                                 record['seconds'],
+                                 '%.0f' % record['rows_per_second'] if record.get('rows_per_second') else '.',
+                                 record['peak_rss_kb'], query if len(query) <= 80 else query[:77] + '...' ) )
+
+    def close(self):
+        """
+        Writes summary table if output format is 'summary' and cProfile statistics if requested.
+        """
+        if self.output_format == 'summary':
+            self.write_summary()
+        if self.cprofile:
+            self.cprofile.dump_stats(self.cprofile_path)
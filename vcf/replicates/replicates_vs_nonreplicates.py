@@ -5,17 +5,73 @@
 
 import sys
 import re
+import argparse
 import itertools
+import multiprocessing
+import numpy
 import pandas
 from scipy import stats
 from numpy import mean, var, std, histogram
 
+# Value used for no-call genotypes in an encoded genotype matrix.
+NO_CALL = 255
+
+# Maximum number of values drawn in a single resampling batch; bounds worker memory.
+MAX_RESAMPLING_BATCH_VALUES = 2000000
+
+# Concordances shared with resampling workers, set by _init_resampling_worker.
+_resampling_data = {}
+
 class Sample:
     def __init__(self, name=None, num_vars=None):
         self.name = name
         self.num_vars = num_vars
 
 
+def encode_genotypes(genotypes_df, sample_names):
+    """
+    Encodes genotype strings into a (variants x samples) uint8 matrix. Within a variant, each distinct genotype
+    gets its own code so that genotypes can be compared by code; './.' and missing genotypes are set to NO_CALL.
+    Returns a tuple of <genotype_matrix> <num_vars> where num_vars is the number of non './.' genotypes per sample.
+    """
+    values = genotypes_df[sample_names].values
+    num_vars = (values != './.').sum(axis=0)
+
+    # Factorize genotypes globally, then rank codes within each variant so that they fit in a byte.
+    codes, uniques = pandas.factorize(values.ravel())
+    codes = codes.reshape(values.shape)
+    no_call = (codes == -1) | (values == './.')
+    order = numpy.argsort(codes, axis=1, kind='mergesort')
+    sorted_codes = numpy.take_along_axis(codes, order, axis=1)
+    ranks = numpy.zeros(codes.shape, dtype=numpy.int64)
+    ranks[:, 1:] = numpy.cumsum(sorted_codes[:, 1:] != sorted_codes[:, :-1], axis=1)
+    if ranks.size and ranks.max() >= NO_CALL:
+        raise ValueError("Too many distinct genotypes for a variant to encode in a byte")
+    genotype_matrix = numpy.empty(codes.shape, dtype=numpy.uint8)
+    numpy.put_along_axis(genotype_matrix, order, ranks, axis=1)
+    genotype_matrix[no_call] = NO_CALL
+
+    return genotype_matrix, num_vars
+
+
+def get_shared_variant_counts(genotype_matrix, block_size=100000):
+    """
+    Returns a (samples x samples) matrix with the number of variants where two samples have the same called
+    genotype. Counts are computed with one matrix product per genotype code over blocks of variants.
+    """
+    num_samples = genotype_matrix.shape[1]
+    shared = numpy.zeros((num_samples, num_samples), dtype=numpy.int64)
+    for start in range(0, genotype_matrix.shape[0], block_size):
+        block = genotype_matrix[start:start + block_size]
+        called = block[block != NO_CALL]
+        if called.size == 0:
+            continue
+        for code in range(int(called.max()) + 1):
+            indicators = (block == code).astype(numpy.float32)
+            shared += numpy.rint(numpy.dot(indicators.T, indicators)).astype(numpy.int64)
+    return shared
+
+
 def get_concordances(data, reduce_fn=mean, weighted=False):
     """
     Reads variant genotype data and returns a tuple of <replicate_concordance> <nonreplicate_concordance> where each
@@ -42,21 +98,21 @@ def get_concordances(data, reduce_fn=mean, weighted=False):
     sample_names = list(genotypes_df.columns.values)[2:]
     sample_names.sort()
 
-    # Get number of variants for each sample and create Sample objects.
+    # Encode genotypes, get number of variants for each sample, and create Sample objects.
+    genotype_matrix, num_vars = encode_genotypes(genotypes_df, sample_names)
     samples = []
-    for name in sample_names:
-        num_vars = len(genotypes_df.loc[genotypes_df[name] != './.', name])
-        samples.append( Sample(name, num_vars) )
+    for i, name in enumerate(sample_names):
+        samples.append( Sample(name, int(num_vars[i])) )
 
+    # Get number of shared variants for all pairs of samples.
+    shared_counts = get_shared_variant_counts(genotype_matrix)
 
     # Compute concordance amongst samples.
     replicate_concordance = []
     nonreplicate_concordance = []
-    for sample1, sample2 in itertools.combinations(samples, 2):
+    for (i, sample1), (j, sample2) in itertools.combinations(enumerate(samples), 2):
         # Get shared variants between samples and overall concordance.
-        num_shared_vars = len ( genotypes_df.loc[(genotypes_df[sample1.name] != './.') & \
-                                                 (genotypes_df[sample1.name] == genotypes_df[sample2.name]), \
-                                                 sample2.name] )
+        num_shared_vars = int(shared_counts[i, j])
         pct1 = num_shared_vars/float(sample1.num_vars) * 100
         pct2 = num_shared_vars/float(sample2.num_vars) * 100
         concordance = reduce_fn([pct1, pct2])
@@ -81,7 +137,129 @@ def get_concordances(data, reduce_fn=mean, weighted=False):
     return replicate_concordance, nonreplicate_concordance
 
 
+def _init_resampling_worker(shared_concordances, num_replicates):
+    """
+    Sets up a resampling worker with a view of the shared concordances; replicate concordances come first.
+    """
+    _resampling_data['concordances'] = numpy.frombuffer(shared_concordances, dtype=numpy.float64)
+    _resampling_data['num_replicates'] = num_replicates
+
+
+def _sample_without_replacement(random_state, population, k, size):
+    """
+    Returns a (size x k) array where each row is k distinct indices drawn from range(population).
+    """
+    if k * k > 4 * population:
+        # Many collisions expected; take the first k of random permutations.
+        return numpy.argsort(random_state.random_sample((size, population)), axis=1)[:, :k]
+
+    # Few collisions expected; redraw rows that have a repeated index.
+    draws = random_state.randint(0, population, size=(size, k))
+    while True:
+        sorted_draws = numpy.sort(draws, axis=1)
+        repeated = (sorted_draws[:, 1:] == sorted_draws[:, :-1]).any(axis=1)
+        if not repeated.any():
+            return draws
+        draws[repeated] = random_state.randint(0, population, size=(repeated.sum(), k))
+
+
+def _permutation_worker(task):
+    """
+    Returns differences in mean concordance (replicate - nonreplicate) for a batch of label permutations.
+    """
+    seed, batch_index, size = task
+    random_state = numpy.random.RandomState([seed, batch_index])
+    concordances = _resampling_data['concordances']
+    num_replicates = _resampling_data['num_replicates']
+    num_nonreplicates = len(concordances) - num_replicates
+
+    replicate_sums = concordances[_sample_without_replacement(random_state, len(concordances),
+                                                              num_replicates, size)].sum(axis=1)
+    return replicate_sums / num_replicates - (concordances.sum() - replicate_sums) / num_nonreplicates
+
+
+def _bootstrap_worker(task):
+    """
+    Returns a (size x 2) array of bootstrapped mean replicate and nonreplicate concordances.
+    """
+    seed, batch_index, size = task
+    random_state = numpy.random.RandomState([seed, batch_index])
+    concordances = _resampling_data['concordances']
+    num_replicates = _resampling_data['num_replicates']
+    replicates = concordances[:num_replicates]
+    nonreplicates = concordances[num_replicates:]
+
+    means = numpy.empty((size, 2))
+    means[:, 0] = replicates[random_state.randint(0, len(replicates), size=(size, len(replicates)))].mean(axis=1)
+    means[:, 1] = nonreplicates[random_state.randint(0, len(nonreplicates),
+                                                     size=(size, len(nonreplicates)))].mean(axis=1)
+    return means
+
+
+def _run_resampling(worker, replicate_concordance, nonreplicate_concordance, num_samples, processes=None, seed=0):
+    """
+    Runs a resampling worker over batches of samples using a process pool and returns the concatenated results.
+    Concordances are copied once into shared memory; each batch is seeded from (seed, batch index) so results
+    do not depend on the number of processes.
+    """
+    num_concordances = len(replicate_concordance) + len(nonreplicate_concordance)
+    shared_concordances = multiprocessing.RawArray('d', num_concordances)
+    numpy.frombuffer(shared_concordances, dtype=numpy.float64)[:] = \
+        list(replicate_concordance) + list(nonreplicate_concordance)
+
+    batch_size = max(1, min(num_samples, MAX_RESAMPLING_BATCH_VALUES // num_concordances))
+    tasks = [ (seed, i, min(batch_size, num_samples - start))
+              for i, start in enumerate(range(0, num_samples, batch_size)) ]
+
+    initargs = (shared_concordances, len(replicate_concordance))
+    if processes == 1:
+        _init_resampling_worker(*initargs)
+        results = [worker(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(processes, initializer=_init_resampling_worker, initargs=initargs)
+        try:
+            results = pool.map(worker, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    return numpy.concatenate(results)
+
+
+def permutation_test(replicate_concordance, nonreplicate_concordance, num_permutations=10000, processes=None,
+                     seed=0):
+    """
+    Permutation test for a difference in mean concordance between replicates and nonreplicates. Replicate and
+    nonreplicate labels are permuted amongst all pairs of samples. Returns a tuple of <observed difference>
+    <two-sided p-value>.
+    """
+    observed = mean(replicate_concordance) - mean(nonreplicate_concordance)
+    differences = _run_resampling(_permutation_worker, replicate_concordance, nonreplicate_concordance,
+                                  num_permutations, processes, seed)
+    extreme = numpy.sum(numpy.abs(differences) >= abs(observed) - 1e-12)
+    return observed, (extreme + 1.0) / (num_permutations + 1.0)
+
+
+def bootstrap_confidence_intervals(replicate_concordance, nonreplicate_concordance, num_bootstraps=10000,
+                                   alpha=0.05, processes=None, seed=0):
+    """
+    Percentile bootstrap confidence intervals for mean replicate concordance, mean nonreplicate concordance, and
+    their difference. Returns a tuple of (low, high) tuples in that order.
+    """
+    means = _run_resampling(_bootstrap_worker, replicate_concordance, nonreplicate_concordance,
+                            num_bootstraps, processes, seed)
+    percentiles = [100 * alpha / 2, 100 * (1 - alpha / 2)]
+    return tuple( tuple(numpy.percentile(values, percentiles)) for values in
+                  [means[:, 0], means[:, 1], means[:, 0] - means[:, 1]] )
+
+
 if __name__ == "__main__":
+    # Argument setup and parsing.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--permutations", type=int, default=0, help="Number of label permutations to run")
+    parser.add_argument("--bootstraps", type=int, default=0, help="Number of bootstrap samples to run")
+    parser.add_argument("--processes", type=int, help="Number of processes for resampling (default: all cores)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for resampling")
+    args = parser.parse_args()
 
     # Read data.
     replicate_concordance, nonreplicate_concordance = get_concordances(sys.stdin, weighted=False)
@@ -115,3 +293,18 @@ if __name__ == "__main__":
     # Mann Whitney U test.
     mann_whitney = stats.mannwhitneyu(replicate_concordance, nonreplicate_concordance)
     print "Mann Whitney U test: MW-statistic is %.3f and p-value is %.3E" % mann_whitney
+
+    # Resampling: permutation test and bootstrap confidence intervals.
+    if args.permutations:
+        observed, p_value = permutation_test(replicate_concordance, nonreplicate_concordance, args.permutations,
+                                             args.processes, args.seed)
+        print "Permutation test (%i permutations): mean difference is %.3f and p-value is %.3E" % \
+              ( args.permutations, observed, p_value )
+    if args.bootstraps:
+        rep_ci, nonrep_ci, diff_ci = bootstrap_confidence_intervals(replicate_concordance, nonreplicate_concordance,
+                                                                    args.bootstraps, processes=args.processes,
+                                                                    seed=args.seed)
+        print "Bootstrap 95%% CIs (%i samples):" % args.bootstraps
+        print "  Replicates mean: %.3f - %.3f" % rep_ci
+        print "  Nonreplicates mean: %.3f - %.3f" % nonrep_ci
+        print "  Difference in means: %.3f - %.3f" % diff_ci
@@ -0,0 +1,149 @@
+"""
+Compare first batch and repeat VCFs over a grid of depth (DP) and allele balance (AB) thresholds.
+
+This is equivalent to filtering each VCF with vcffilter -f 'DP > <dp>' -f 'AB > <ab>' for every threshold pair
+and running vcf-compare on every first batch x repeats pair of filtered files, but each VCF is read once. For each
+variant, the number of AB thresholds it passes at each DP threshold is kept, and shared/unique counts for the whole
+grid are computed from cumulative counts of these levels.
+
+Variants are matched by position, as in vcf-compare's VN lines, or by position and allele with --match alleles.
+
+Usage:
+    python sweep_compare_vcfs.py <first_batch.vcf> [...] --repeats <repeats.vcf> [...]
+"""
+
+import argparse
+import bisect
+import os
+
+import numpy
+
+from filter_vcfs import Record, to_float
+
+DEPTHS = [0, 20, 50, 100]
+ALLELE_BALANCES = [0.01, 0.02, 0.025, 0.03, 0.035, 0.04, 0.045, 0.05]
+
+class SweepCalls(object):
+    """
+    Variants in a VCF with the number of AB thresholds each passes at each DP threshold. Thresholds are given as
+    strings so that they print as given.
+    """
+    def __init__(self, path, depths, allele_balances, match_alleles=False):
+        self.path = path
+        self.depths = depths
+        self.allele_balances = sorted(allele_balances, key=float)
+        depth_values = [float(depth) for depth in depths]
+        allele_balance_values = [float(allele_balance) for allele_balance in self.allele_balances]
+        levels = {}
+        for line in open(path):
+            if line.startswith('#'):
+                continue
+            record = Record(line)
+            chrom, pos, ref = record.fields[0], int(record.fields[1]), record.fields[3]
+            alts = record.fields[4].split(',')
+            dp = to_float(record.get_value('DP', 0))
+            for allele in xrange(record.num_alleles):
+                # Number of AB thresholds passed, i.e. thresholds < AB.
+                level = bisect.bisect_left(allele_balance_values, to_float(record.get_value('AB', allele)))
+                key = (chrom, pos, ref, alts[allele]) if match_alleles else (chrom, pos)
+                key_levels = levels.setdefault(key, [0] * len(depths))
+                for i, depth in enumerate(depth_values):
+                    if dp > depth and level > key_levels[i]:
+                        key_levels[i] = level
+
+        self.keys = dict( (key, i) for i, key in enumerate(levels) )
+        self.levels = numpy.array(levels.values(), dtype=numpy.int8).reshape(len(levels), len(depths))
+
+    def get_totals(self, depth_index):
+        """
+        Returns number of variants passing each AB threshold at a DP threshold.
+        """
+        return get_passing_counts(self.levels[:, depth_index], len(self.allele_balances))
+
+def get_passing_counts(levels, num_thresholds):
+    """
+    Returns counts of levels greater than each threshold index, i.e. a reverse cumulative sum of level counts.
+    """
+    counts = numpy.bincount(levels, minlength=num_thresholds + 1)
+    return numpy.cumsum(counts[::-1])[::-1][1:]
+
+def compare_calls(first, repeat):
+    """
+    Yields (first DP, first AB, repeat DP, repeat AB, first total, shared, repeat total) for all pairs of
+    thresholds.
+    """
+    num_ab = len(first.allele_balances)
+    shared = [ (i, repeat.keys[key]) for key, i in first.keys.iteritems() if key in repeat.keys ]
+    first_shared = first.levels[[i for i, j in shared]]
+    repeat_shared = repeat.levels[[j for i, j in shared]]
+    for first_dp in range(len(first.depths)):
+        first_totals = first.get_totals(first_dp)
+        for repeat_dp in range(len(repeat.depths)):
+            repeat_totals = repeat.get_totals(repeat_dp)
+
+            # Shared counts for all AB threshold pairs from 2D reverse cumulative sum of level pairs.
+            counts = numpy.zeros( (num_ab + 1, num_ab + 1), dtype=numpy.int64 )
+            numpy.add.at(counts, (first_shared[:, first_dp], repeat_shared[:, repeat_dp]), 1)
+            counts = counts[::-1, ::-1].cumsum(axis=0).cumsum(axis=1)[::-1, ::-1][1:, 1:]
+
+            for first_ab in range(num_ab):
+                for repeat_ab in range(num_ab):
+                    yield ( first.depths[first_dp], first.allele_balances[first_ab],
+                            repeat.depths[repeat_dp], repeat.allele_balances[repeat_ab],
+                            first_totals[first_ab], counts[first_ab, repeat_ab], repeat_totals[repeat_ab] )
+
+def get_filtered_name(path, depth, allele_balance):
+    """
+    Returns name of the file that sweep_and_compare_vcfs.sh would create for a VCF and thresholds.
+    """
+    return '%s_DP%s_AB%s.vcf.sorted.gz' % (os.path.splitext(path)[0], depth, allele_balance)
+
+def get_percent(count, total):
+    """
+    Returns count as percent of total.
+    """
+    return count * 100. / total if total else 0.
+
+def print_comparisons(first_files, repeat_files, depths, allele_balances, match_alleles=False, vn=False):
+    """
+    Prints comparisons of all first batch and repeats files as a table or as vcf-compare VN lines.
+    """
+    repeats = [ SweepCalls(path, depths, allele_balances, match_alleles) for path in repeat_files ]
+    if not vn:
+        print '\t'.join(['first', 'first_dp', 'first_ab', 'repeat', 'repeat_dp', 'repeat_ab',
+                         'first_unique', 'shared', 'repeat_unique', 'first_total', 'repeat_total'])
+    for first_file in first_files:
+        first = SweepCalls(first_file, depths, allele_balances, match_alleles)
+        for repeat in repeats:
+            for first_dp, first_ab, repeat_dp, repeat_ab, first_total, shared, repeat_total in \
+                compare_calls(first, repeat):
+                if not vn:
+                    print '%s\t%s\t%s\t%s\t%s\t%s\t%i\t%i\t%i\t%i\t%i' % \
+                          ( first.path, first_dp, first_ab, repeat.path, repeat_dp, repeat_ab, first_total - shared,
+                            shared, repeat_total - shared, first_total, repeat_total )
+                    continue
+
+                first_name = get_filtered_name(first.path, first_dp, first_ab)
+                repeat_name = get_filtered_name(repeat.path, repeat_dp, repeat_ab)
+                for count, name, total in [ (first_total - shared, first_name, first_total),
+                                            (repeat_total - shared, repeat_name, repeat_total) ]:
+                    if count:
+                        print 'VN\t%i\t%s (%.1f%%)' % ( count, name, get_percent(count, total) )
+                if shared:
+                    print 'VN\t%i\t%s (%.1f%%)\t%s (%.1f%%)' % ( shared, first_name, get_percent(shared, first_total),
+                                                                repeat_name, get_percent(shared, repeat_total) )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare first batch and repeat VCFs over DP and AB thresholds.')
+    parser.add_argument("first_files", nargs="+", help="First batch VCFs")
+    parser.add_argument("--repeats", nargs="+", required=True, help="Repeat VCFs")
+    parser.add_argument("--depths", default=','.join(str(d) for d in DEPTHS), help="DP thresholds (exclusive)")
+    parser.add_argument("--allele_balances", default=','.join(str(a) for a in ALLELE_BALANCES),
+                        help="AB thresholds (exclusive)")
+    parser.add_argument("--match", choices=["position", "alleles"], default="position",
+                        help="Match variants by position (as vcf-compare) or by position and allele")
+    parser.add_argument("--vn", action="store_true", help="Print vcf-compare VN lines rather than a table")
+    args = parser.parse_args()
+
+    print_comparisons(args.first_files, args.repeats, args.depths.split(','), args.allele_balances.split(','),
+                      args.match == "alleles", args.vn)
@@ -0,0 +1,64 @@
+"""
+Natural contig ordering and streaming merge of sorted VCF lines.
+
+Contigs are ordered using a .fai or genome.len file (contig name in the first column), the ##contig lines of a
+VCF header, or, for contigs not found there, natural order: 1-22, X, Y, M, then other contigs.
+"""
+
+import heapq
+import re
+
+SPECIAL_CHROMS = { 'X': 1, 'Y': 2, 'M': 3, 'MT': 3 }
+
+def get_contig_order(genome_file):
+    """
+    Returns dictionary of contig name to rank from a .fai or genome.len file.
+    """
+    contig_order = {}
+    for line in open(genome_file):
+        fields = line.split()
+        if fields and not line.startswith('#') and fields[0] not in contig_order:
+            contig_order[fields[0]] = len(contig_order)
+    return contig_order
+
+def get_header_contig_order(header):
+    """
+    Returns dictionary of contig name to rank from the ##contig lines of a VCF header.
+    """
+    contig_order = {}
+    for contig in re.findall(r'^##contig=<ID=([^,>]+)', header, re.MULTILINE):
+        if contig not in contig_order:
+            contig_order[contig] = len(contig_order)
+    return contig_order
+
+def get_natural_chrom_key(chrom):
+    """
+    Returns sort key for natural ordering of a chromosome: 1-22, X, Y, M, then other contigs.
+    """
+    name = chrom[3:] if chrom.lower().startswith('chr') else chrom
+    if name.isdigit():
+        return (0, int(name), ())
+    if name.upper() in SPECIAL_CHROMS:
+        return (SPECIAL_CHROMS[name.upper()], 0, ())
+    return (4, 0, tuple(int(part) if part.isdigit() else part for part in re.split(r'(\d+)', name)))
+
+def get_chrom_sort_key(chrom, contig_order=None):
+    """
+    Returns sort key for a chromosome; contigs in contig_order come first, in that order.
+    """
+    if contig_order and chrom in contig_order:
+        return (contig_order[chrom], get_natural_chrom_key(chrom))
+    return (len(contig_order or ()), get_natural_chrom_key(chrom))
+
+def get_vcf_line_key(line, contig_order=None):
+    """
+    Returns sort key for a VCF line using its chromosome and position.
+    """
+    chrom, pos = line.split('\t', 2)[:2]
+    return (get_chrom_sort_key(chrom, contig_order), int(pos))
+
+def merge_sorted(streams):
+    """
+    k-way merge of streams of (key, ...) tuples that are each sorted by key.
+    """
+    return heapq.merge(*streams)